@@ -4,20 +4,32 @@ Created on Sep 17, 2019
 @author: Chris Fritz
 Initial Function Definitions for Psychophysics Experiments
 See README for more information.
+
+Importing this module only loads numpy and the project's own modules. The
+hardware and GUI backends (openvr, cv2, Spout/OpenGL, psutil) are imported when
+the objects that need them are started, and constructing an object never
+connects, launches or calibrates anything: call start() for that, e.g.
+VRInterface().start().
 '''
 
+import collections
+import functools
+import os
 import socket
-import numpy as np
-import keyboard 
-from OpenGL.GL import * #@UnusedWildImport   #stop annoying warning
-from OpenGL.GLUT import * #@UnusedWildImport   
-from OpenGL.GLU import * #@UnusedWildImport
-import openvr
 import subprocess
-import cv2
-import psutil
-import pygame
-import SpoutSDK
+import time
+import numpy as np
+
+from frame_sources import Frame, FramePool, SpoutFrameSource, VideoFrameSource, frame_checksum
+from gaze import GAZE_PACKET_FORMATS, GazeBuffer, GazeReceiver, kill_process_tree
+from instrumentation import GAZE_AGE, MOTION_TO_PHOTON, NULL_INSTRUMENTATION
+from pipeline import FramePipeline
+from pose import HeadPosePredictor, PoseHistory, pose_matrices, poses_to_arrays
+from pose_protocol import (DEFAULT_SHM_NAME, PoseEncoder, SharedMemoryPoseTransport,
+                           TcpPoseTransport)
+
+# openvr.k_unTrackedDeviceIndex_Hmd, so that sending poses does not need openvr
+_HMD_INDEX = 0
 
 
 class PositionSender(object):
@@ -25,129 +37,354 @@ class PositionSender(object):
     The PositionSender object transmits head position and rotation information to 
     the Unity Game engine. 
     First, attach the script "PythonCaller.cs" to a camera representing the subject's 
-    viewport into the environment.  Then instantiate a PositionSender. To send data,
+    viewport into the environment.  Then instantiate a PositionSender and call start()
+    to connect. To send data,
     call [object].send(head_rotation, head_position) at the beginning of every frame.
     head_rotation and head_position can be obtained from the VR Interface. 
+    Poses are sent as versioned, timestamped packets (see pose_protocol.py) from a
+    background thread, so send() never blocks the frame loop.
+    With transport='shm' the newest pose is instead published to a shared memory
+    slot that readers can poll without a syscall (see SharedMemoryPoseTransport).
     ''' 
-    def __init__(self):
+    def __init__(self, host="localhost", port=9999, transport='tcp', shm_name=DEFAULT_SHM_NAME,
+                 instrumentation=NULL_INSTRUMENTATION):
         '''
-        Initializes a  TCP socket connection with Unity.
+        Set up the pose transport to Unity; start() opens the connection.
+        '''
+        
+        self._HOST = host
+        self._PORT = port
+        self._encoder = PoseEncoder()
+        if transport == 'tcp':
+            self._transport = TcpPoseTransport(self._HOST, self._PORT)
+        elif transport == 'shm':
+            self._transport = SharedMemoryPoseTransport(shm_name)
+        else:
+            raise ValueError("Unknown pose transport: %s" % transport)
+        self._reported_error = False
+        self._instrumentation = instrumentation
+        
+    def start(self):
+        '''
+        Initializes a  TCP socket connection with Unity (or the shared memory slot).
         In its current state, you need to restart the Unity scene (stop and press play)
         in order to reconnect the PositionSender to Unity.  
         #TODO: Implement Proper error handling and open/close communication b/t this script
         and PythonCaller.cs in Unity
         '''
-        
-        self._HOST = "localhost"
-        self._PORT = 9999
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-                self._sock.connect((self._HOST, self._PORT))
-        except:
+            self._transport.connect()
+        except OSError:
             print("Could not connect to Unity Server")
+        return self
                 
-    def send(self,head_rot, head_pos):
-        ''' Send Position & Rotation Data as an array of 7 doubles,
+    def send(self,head_rot, head_pos, timestamp=None):
+        ''' Send the HMD Position & Rotation Data.
  
-        the first 4 elements are the quaternion, and the remaining
-        3 are the head position in 3d space
-        input: head_rot: a numpy array of 4 doubles representing head rotation
-               head_pos: a numpy array of 4 doubles representing head position
+        input: head_rot: a numpy array of 4 doubles representing head rotation (w, x, y, z)
+               head_pos: a numpy array of 3 doubles representing head position
+               timestamp: time.perf_counter() time the pose was captured (defaults to now)
         '''
-        try:
-            self._sock.sendall(np.array(np.hstack((head_rot,head_pos)),dtype=np.float32))
-        except:
-            print('Could not send position to Unity, make sure receiver is running')     
+        self.send_poses((_HMD_INDEX,), (head_rot,), (head_pos,), timestamp)
+        
+    def send_poses(self, device_indices, rotations, positions, timestamp=None):
+        '''
+        Send the poses of several tracked devices in one packet.
+        device_indices: n OpenVR tracked device indices
+        rotations: (n, 4) quaternions (w, x, y, z)
+        positions: (n, 3) positions
+        '''
+        if not self._transport.connected:
+            # report a dead connection once instead of printing on every frame
+            if not self._reported_error:
+                print('Could not send position to Unity, make sure receiver is running')
+                self._reported_error = True
+            return
+        start = self._instrumentation.stamp()
+        self._transport.submit(self._encoder.encode(device_indices, rotations, positions, timestamp))
+        self._instrumentation.record('pose_send', start)
+    
+    @property
+    def stats(self):
+        ''' Packets sent, packets replaced by a newer pose before sending, and send errors '''
+        return {'sent': self._transport.sent,
+                'coalesced': self._transport.coalesced,
+                'errors': self._transport.errors}
             
     def _del(self):
         try:
-            self._sock.close()
-        except:
-            print("Could not successfully close TCP socket.")           
+            self._transport.close()
+        except OSError:
+            print("Could not successfully close pose transport.")           
     
 class VRInterface(object):
     '''
     This class instantiates an interface object for the HTC Vive. It controls
     all I/O to and from the HMD, including head position tracking and video writing. 
-    To use, initialize class by instantiating, head position can then be accessed using
-    the get_head_pos() method. To upload a frame to the HMD, update the self._view_wnd display
+    To use, initialize class by instantiating and calling start(), head position can then be
+    accessed using the get_head_pos() method. To upload a frame to the HMD, update the self._view_wnd display
     with the desired frame. (This is done once on every call to update()
+    With pipelined=True, image capture and processing run on worker threads
+    (see pipeline.py) and update() only fetches the pose and shows the newest
+    finished frame.
     '''
     
-    def __init__(self):
-        ''' '''
+    def __init__(self, pipelined=False, drop_stale_frames=True, pose_history_size=256,
+                 head_prediction=False, instrumentation=NULL_INSTRUMENTATION,
+                 image_processor=None, display=True, recorder=None, debug_video=None):
+        '''
+        pipelined: overlap capture, processing and display across threads
+        drop_stale_frames: in pipelined mode, skip frames that were overtaken by a
+            newer one instead of queueing them for display
+        pose_history_size: number of frames of poses kept for all tracked devices
+            (see pose.PoseHistory), e.g. to align poses with gaze samples
+        head_prediction: extrapolate the head pose to the expected display time
+            (see pose.HeadPosePredictor); get_head_position/rotation then return
+            the predicted pose, and the horizon adapts to the measured round trip
+        instrumentation: an instrumentation.Instrumentation recording per-stage
+            latencies, frame drops and the motion-to-photon estimate; shared with
+            the ImageProcessor and EyeTracker created here
+        image_processor: use this ImageProcessor instead of creating one (which
+            launches the eye tracker and calibrates), e.g. with fakes.py stand-ins
+        display: show frames in the HMD window; False runs headless for benchmarks
+        recorder: a started recording.SessionRecorder that receives every HMD pose,
+            and the gaze and frames of the ImageProcessor created here
+        debug_video: path of a video shown (looping, at its own frame rate) instead of
+            the Unity frames received through Spout, for debugging
+        The headset, window and image processor are initialized by start().
+        '''
         #1440 x 1600 pixels per eye
         self._width = 2880
         self._height = 1600
+        self._pipelined = pipelined
+        self._drop_stale_frames = drop_stale_frames
+        self._pose_history_size = pose_history_size
+        self._head_prediction = head_prediction
+        self._instrumentation = instrumentation
+        self._img_processor = image_processor
+        self._display = display
+        self._recorder = recorder
+        self._debug_video = debug_video
+        self._view_wnd = "VR Display"
+        self._openvr = None
+        self._cv2 = None
+        self._pose_history = None
+        self._head_predictor = None
+        self._predicted_pose = None
+        self._pipeline = None
+        
+    def start(self):
+        '''
+        Initialize the headset, the display window and (unless one was passed in)
+        the image processor, then grab the first data from the headset. Returns self.
+        '''
+        import cv2
+        import openvr
+        self._openvr = openvr
+        self._cv2 = cv2
         
         try:
             openvr.init(openvr.VRApplication_Scene)
         except: Exception("Could Not Initialize VR Headset")         
-        self._poses = []
-        print("VR Interface Initialized Successfully.")
         
-        # setup capture device for debugging
-        # (video does not loop so script terminates with error when video finishes)
-        self._cap = cv2.VideoCapture("sample_vid.mp4")
-        self._view_wnd = "VR Display"
+        # poses of all tracked devices, converted together on every update
+        self._n_devices = openvr.k_unMaxTrackedDeviceCount
+        self._poses = (openvr.TrackedDevicePose_t * self._n_devices)()
+        self._pose_time = 0.0
+        self._positions = np.zeros((self._n_devices, 3))
+        self._rotations = np.zeros((self._n_devices, 4))
+        self._pose_valid = np.zeros(self._n_devices, dtype=bool)
+        self._pose_history = PoseHistory(self._pose_history_size, self._n_devices)
+        if self._head_prediction:
+            self._head_predictor = HeadPosePredictor(self._pose_history)
+        # times of poses already handed out for sending, to measure the round trip
+        self._sent_pose_times = collections.deque(maxlen=16)
+        self._frames_dropped = 0
+        print("VR Interface Initialized Successfully.")
         
         # setup vr eye display 
-        cv2.namedWindow(self._view_wnd)
-        cv2.moveWindow(self._view_wnd,2*1920,-300)  #Using VR with DirectDisplay disabled, 
-                                                    #Position the window in the HMD display
-        cv2.setWindowProperty(self._view_wnd,cv2.WND_PROP_FULLSCREEN,  cv2.WINDOW_FULLSCREEN )
+        if self._display:
+            cv2.namedWindow(self._view_wnd)
+            cv2.moveWindow(self._view_wnd,2*1920,-300)  #Using VR with DirectDisplay disabled, 
+                                                        #Position the window in the HMD display
+            cv2.setWindowProperty(self._view_wnd,cv2.WND_PROP_FULLSCREEN,  cv2.WINDOW_FULLSCREEN )
         
         
         #setup image processor 
-        self._img_processor = ImageProcessor(self._width, self._height)
+        if self._img_processor is None:
+            frame_source = None
+            if self._debug_video is not None:
+                frame_source = VideoFrameSource(self._width, self._height, self._debug_video,
+                                                realtime=True).start()
+            self._img_processor = ImageProcessor(self._width, self._height, frame_source=frame_source,
+                                                 instrumentation=self._instrumentation,
+                                                 recorder=self._recorder).start()
+        if self._pipelined:
+            self._pipeline = FramePipeline(
+                capture=lambda: self._img_processor.capture_frame(timeout=0.05),
+                process=lambda frame: self._img_processor.process_frame(frame, timeout=0.05),
+                release=self._img_processor.release_frame,
+                drop_stale=self._drop_stale_frames
+            ).start()
 
         #update to grab first data from VR Headset
         self.update()
+        return self
 
     def update(self):
         ''' 
         Update the tracking data by retreiving from HMD. Because this method captures tracking
         data relevant to the rendering scene, update should be called at the start of each frame.
+        Then capture, process and show a frame (in pipelined mode, the newest finished one).
+        '''
+        self.update_pose()
+        if self._pipeline is None:
+            image = self._img_processor.get_processed_image()
+            self.show_frame(image, self._img_processor.last_capture_time)
+            return
+        # show the newest finished frame; keep the previous one up if none is ready
+        frame = self._pipeline.get_frame(timeout=0.1)
+        if frame is not None:
+            self.show_frame(frame.data, frame.timestamp)
+            self._pipeline.done_with(frame)
+        else:
+            self.show_frame(None)
+        dropped = self._pipeline.frames_dropped
+        self._instrumentation.frame_dropped(dropped - self._frames_dropped)
+        self._frames_dropped = dropped
+        
+    def update_pose(self):
         '''
+        Fetch the poses of all tracked devices from the HMD (and predict the head pose,
+        with head_prediction). The first half of update(), for frame loops that
+        schedule capture and display themselves (see runtime.py).
+        '''
+        # with our own head prediction, fetch the measured pose and extrapolate it below
+        seconds_to_photons = 0.001 if self._head_predictor is None else 0.0
+        instrumentation = self._instrumentation
+        start = instrumentation.stamp()
+        openvr = self._openvr
         self._poses = openvr.IVRSystem().getDeviceToAbsoluteTrackingPose(
             openvr.TrackingUniverseStanding,
-            0.001,
-            openvr.TrackedDevicePose_t()
+            seconds_to_photons,
+            self._poses
         )
+        self._pose_time = time.perf_counter()
+        self._update_pose_arrays()
+        instrumentation.record('pose_fetch', start)
+        if self._recorder is not None:
+            self._recorder.record_pose(self._pose_time, self._positions[_HMD_INDEX],
+                                       self._rotations[_HMD_INDEX])
+        if self._head_predictor is not None:
+            self._head_predictor.evaluate()
+            self._predicted_pose = self._head_predictor.predict(
+                devices=[_HMD_INDEX])
+        
+    def show_frame(self, image, capture_time=None):
+        '''
+        Show a processed (height, width) image in the HMD window, or with image None
+        keep the previous one up (counted as a repeated frame). capture_time is the
+        frame's capture time, for the motion-to-photon estimate. The second half of
+        update(); the pose fetched by update_pose() counts as sent from here on.
+        '''
+        instrumentation = self._instrumentation
+        start = instrumentation.stamp()
+        cv2 = self._cv2
+        if image is None:
+            instrumentation.frame_repeated()
+        elif self._display:
+            cv2.imshow(self._view_wnd,image)
+        if self._display:
+            cv2.waitKey(1)  #need waitkey(1) for Imshow to display videos properly.
+            instrumentation.record('display', start)
+        
+        if image is not None and capture_time is not None:
+            instrumentation.frame_displayed()
+            self._record_round_trip(capture_time, time.perf_counter())
+        # the pose fetched by update_pose() is sent after the frame is shown
+        self._sent_pose_times.append(self._pose_time)
         
-        frame = self._img_processor.get_processed_image()
-        cv2.imshow(self._view_wnd,frame)
-        cv2.waitKey(1)  #need waitkey(1) for Imshow to display videos properly.
+    def _record_round_trip(self, capture_time, display_time):
+        '''
+        Estimate the pose-to-display round trip of a shown frame: Unity rendered it
+        from the newest pose sent before it was captured. Feeds the head predictor
+        and is recorded as the motion-to-photon estimate (it does not include the
+        headset's scanout).
+        '''
+        if self._head_predictor is None and not self._instrumentation.enabled:
+            return
+        for pose_time in reversed(self._sent_pose_times):
+            if pose_time < capture_time:
+                round_trip = display_time - pose_time
+                self._instrumentation.record_duration(MOTION_TO_PHOTON, round_trip)
+                if self._head_predictor is not None:
+                    self._head_predictor.record_round_trip(round_trip)
+                return
+           
+    def _update_pose_arrays(self):
+        '''
+        Convert the matrices of all tracked devices to positions and quaternions in
+        one pass and record them in the pose history.
+        '''
+        matrices, valid = pose_matrices(self._poses)
+        poses_to_arrays(matrices, self._positions, self._rotations)
+        self._pose_valid[:] = valid
+        self._pose_history.push(self._pose_time, self._positions, self._rotations, self._pose_valid)
            
     def get_head_position(self):
-        ''' Return the position of the head in a numpy vector '''
-        x = self._poses[openvr.k_unTrackedDeviceIndex_Hmd].mDeviceToAbsoluteTracking[0][3]
-        y = self._poses[openvr.k_unTrackedDeviceIndex_Hmd].mDeviceToAbsoluteTracking[1][3]
-        z = self._poses[openvr.k_unTrackedDeviceIndex_Hmd].mDeviceToAbsoluteTracking[2][3]
-         # The -z is so that the movement in physical space matches movement in virtual space
-        return np.asarray([x,y,-z])
+        ''' Return the position of the head in a numpy vector (predicted, with head_prediction) '''
+        if self._predicted_pose is not None:
+            return self._predicted_pose[0][0].copy()
+        return self._positions[_HMD_INDEX].copy()
     
     def get_head_rotation(self):
-        ''' Return the head rotation data as a quaternion object.The data is converted from the rotation
-        matrix to a quaternion object
-        a quaternion representation See http://www.allenchou.net/2014/04/game-math-quaternion-basics/
-        for detials on quaternion matricies and operations
+        ''' Return the head rotation data as a quaternion (w, x, y, z). The data is converted
+        from the rotation matrix to a quaternion, see pose.poses_to_arrays()
+        (predicted, with head_prediction)
         ''' 
-        matrix = self._poses[openvr.k_unTrackedDeviceIndex_Hmd].mDeviceToAbsoluteTracking
-        w = np.sqrt(np.fmax(0,1 + matrix[0][0]+matrix[1][1]+matrix[2][2])) / 2
-        x = np.sqrt(np.fmax(0,1 + matrix[0][0]-matrix[1][1]-matrix[2][2])) / 2
-        y = np.sqrt(np.fmax(0,1 - matrix[0][0]+matrix[1][1]-matrix[2][2])) / 2
-        z = np.sqrt(np.fmax(0,1 - matrix[0][0]-matrix[1][1]+matrix[2][2])) / 2
-        
-        x = np.copysign(x, matrix[2][1]- matrix[1][2])
-        y = np.copysign(y, matrix[0][2]- matrix[2][0])
-        z = np.copysign(z, matrix[1][0]- matrix[0][1])
-        # flip sign of w and z so that physical and virtual coordinate systems match
-        return np.array((-w,x,y,-z))
+        if self._predicted_pose is not None:
+            return self._predicted_pose[1][0].copy()
+        return self._rotations[_HMD_INDEX].copy()
+    
+    @property
+    def image_processor(self):
+        ''' The ImageProcessor in use (None before start) '''
+        return self._img_processor
+    
+    @property
+    def head_predictor(self):
+        ''' The pose.HeadPosePredictor, or None without head_prediction. Its error log is for tuning '''
+        return self._head_predictor
+    
+    def get_device_poses(self):
+        '''
+        Return (positions, rotations, valid) for all tracked devices from the last
+        update, as (n, 3), (n, 4) and (n,) arrays indexed by OpenVR device index.
+        '''
+        return self._positions.copy(), self._rotations.copy(), self._pose_valid.copy()
+    
+    @property
+    def pose_history(self):
+        ''' The pose.PoseHistory of all tracked devices, queryable by timestamp (None before start) '''
+        return self._pose_history
+    
+    @property
+    def instrumentation(self):
+        ''' The instrumentation.Instrumentation in use; call its summary() or save_json() '''
+        return self._instrumentation
+    
+    def stop_pipeline(self):
+        ''' Stop the capture/processing threads of pipelined mode and release their frames '''
+        if self._pipeline is not None:
+            self._pipeline.stop()
+            self._pipeline = None
     
     def __del__(self):
+        self.stop_pipeline()
+        if self._openvr is None:
+            return
         try:
-            openvr.shutdown()
+            self._openvr.shutdown()
             print('VR Interface Closed Successfully.')
         except:
             print("Could not close VR Interface. Restart the HMD")
@@ -158,45 +395,138 @@ class EyeTracker(object):
     eye tracker integrated into the HTC Vive Headset. Communication is via a TCP socket
     Make sure pupil_capture folder is in same directory (or update _pupil_handle with its path)
     Further, make sure that the transmitting plugin transmit_gaze.py is in the Pupil Catpure plugins
-    foler and is enabled. Initialization will halt until it receives input from Pupil Gaze Data
+    foler and is enabled. start() will halt until it receives input from Pupil Gaze Data
+    Gaze packets are read on a background thread into a ring buffer, so get_gaze_pos(),
+    latest() and since() never wait on the socket.
     '''
 
-    def __init__(self):
+    def __init__(self, host='127.0.0.1', port=8888, pupil_path="pupil_capture\\pupil_capture.exe",
+                 buffer_size=1024, first_sample_timeout=10.0, instrumentation=NULL_INSTRUMENTATION,
+                 packet_format='legacy', sample_rate=120.0):
+        '''
+        Set up the interface to the Pupil Eye Tracker; start() opens the socket and
+        launches Pupil Capture.
+        Pass pupil_path=None to skip launching Pupil Capture (e.g. when a
+        gaze.FakeGazeSender is streaming instead).
+        packet_format: 'legacy' (x, y) packets, or 'binocular' packets with both eyes,
+            confidences and Pupil timestamps (see gaze.py)
+        sample_rate: the tracker's nominal gaze rate (Hz), used to timestamp legacy
+            packets that arrive together
+        '''        
+        if packet_format not in GAZE_PACKET_FORMATS:
+            raise ValueError("Unknown gaze packet format: %s" % packet_format)
+        self._packet_format = packet_format
+        self._sample_rate = sample_rate
+        self._HOST = host
+        self._PORT = port
+        self._pupil_path = pupil_path
+        self._first_sample_timeout = first_sample_timeout
+        self._instrumentation = instrumentation
+        self._socket = None
+        self._conn = None
+        self._receiver = None
+        self._pupil_handle = None
+        self._eye_pos = (0,0,0,0)
+        self._buffer = GazeBuffer(buffer_size)
+        
+    def start(self):
         '''
         Initialize the interface to the Pupil Eye Tracker.
         The transmit_gaze.py script must be in the pupil_capture_settings\plugins
-        folder (or pupil capture plugin directory) in order to initialize
-        '''        
-        self._HOST = '127.0.0.1'
-        self._PORT = 8888
+        folder (or pupil capture plugin directory) in order to initialize.
+        Blocks until the tracker connects and the first sample arrives (or
+        first_sample_timeout passes). Returns self.
+        '''
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._socket.bind((self._HOST, self._PORT))
         self._socket.listen()
-        self._pupil_handle = subprocess.Popen("pupil_capture\\pupil_capture.exe")
+        self._pupil_handle = subprocess.Popen(self._pupil_path) if self._pupil_path else None
         self._conn, self._addr = self._socket.accept()
-        self._eye_pos = (0,0,0,0)
+        
+        self._receiver = GazeReceiver(self._conn, self._buffer,
+                                      packet_dtype=GAZE_PACKET_FORMATS[self._packet_format],
+                                      instrumentation=self._instrumentation,
+                                      sample_rate=self._sample_rate).start()
+        
+        # block once here so later reads always have a sample available
+        deadline = time.perf_counter() + self._first_sample_timeout
+        while self._buffer.latest() is None and time.perf_counter() < deadline:
+            time.sleep(0.001)
+        if self._buffer.latest() is None:
+            print("No gaze data received from Pupil Capture")
+        return self
         
     def get_gaze_pos(self):
         '''
-        Return the gaze position in normalized screen coordinates
-        bottom left is (0,0), top right is (1,1)
+        Return the most recent gaze position in normalized screen coordinates
+        bottom left is (0,0), top right is (1,1). Returns (nan, nan) if no sample
+        has arrived yet.
         '''
-        while True:
-            pos = np.frombuffer(self._conn.recv(8),dtype=np.float32)
-            if pos is not None:
-                return (pos[0], pos[1])
+        sample = self._buffer.latest()
+        if sample is None:
+            return (np.nan, np.nan)
+        return (sample[1], sample[2])
+    
+    def latest(self):
+        ''' Return the newest (timestamp, x, y) sample, or None if none has arrived '''
+        return self._buffer.latest()
+    
+    def since(self, t):
+        ''' Return an (n, 3) array of (timestamp, x, y) samples newer than t '''
+        return self._buffer.since(t)
+    
+    @property
+    def binocular(self):
+        ''' True if the tracker sends both eyes (packet_format='binocular') '''
+        return self._packet_format == 'binocular'
+    
+    def get_binocular_gaze(self):
+        '''
+        Return the most recent gaze of the left and right eye as a (2, 2) array. An
+        eye that is not valid in the newest sample (e.g. low confidence) gets the
+        combined gaze of get_gaze_pos() instead.
+        '''
+        record = self._buffer.latest_record()
+        combined = self.get_gaze_pos()
+        if record is None:
+            return np.array([combined, combined])
+        return np.where(record['valid'][:, np.newaxis], record['gaze'], combined)
+    
+    def records_since(self, t):
+        '''
+        Return the binocular samples newer than t as gaze.GAZE_RECORD_DTYPE records:
+        perf_counter and Pupil timestamps, both eyes' gaze, confidence and validity
+        '''
+        return self._buffer.records_since(t)
+    
+    @property
+    def receiver(self):
+        ''' The gaze.GazeReceiver, e.g. for its packet counters (None before start) '''
+        return self._receiver
+        
+    def stop(self):
+        ''' Stop receiving, close the sockets and kill Pupil Capture if it was launched '''
+        if self._receiver is not None:
+            self._receiver.stop()
+            self._receiver = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        
+        if self._pupil_handle is None:
+            return
+        kill_process_tree(self._pupil_handle.pid)
+        self._pupil_handle = None
         
     def __del__(self):
-        self._socket.close()
-    
-        process = psutil.Process(self._pupil_handle.pid)
-        for proc in process.children(recursive=True):
-            proc.kill()
-        process.kill()
+        self.stop()
 
-#vr_int = VRInterface()
-#sender = PositionSender()
+#vr_int = VRInterface().start()
+#sender = PositionSender().start()
 
 # running = True
 #   
@@ -207,190 +537,726 @@ class EyeTracker(object):
 #     pos = vr_int.get_head_position()
 #     rot = vr_int.get_head_rotation()
 #     sender.send(rot, pos)
+#
+# or, paced to the display rate with deadline handling (see runtime.py):
+# runtime.experiment_runtime(vr_int, sender).run()
 
 class ImageProcessor(object):
     '''
     The image processor receives the image from the Unity-rendered environment,
     the eye position from the eye tracker and processes that image accordingly.
+    Call start() to connect the eye tracker and frame source and calibrate.
     To receive the processed image, call get_processed_image(). 
     '''
 
-    def __init__(self, width, height):
+    def __init__(self, width, height, eye_tracker=None, frame_source=None, pool_size=3,
+                 gaze_predictor=None, prediction_horizon=0.02, stabilization='mask',
+                 warp_cache_size=8, warp_quantization=1.0, instrumentation=NULL_INSTRUMENTATION,
+                 calibration=None, recorder=None, clock=None, binocular=False, tiles=1, workers=None,
+                 foveated=False, roi_size=512, periphery_scale=4, incremental=False,
+                 eye_events=None, fixation_hold=0.05, gaze_process=False, calibration_model='affine',
+                 calibration_store=None, subject=None, headset='vive'):
         ''' 
-        Initialize the Image Processor
+        Initialize the Image Processor. By default start() launches its own EyeTracker and
+        receives frames from Unity over Spout; pass eye_tracker (already started) or
+        frame_source (see frame_sources.py) to substitute either, e.g. for tests and benchmarks.
+        gaze_predictor (see gaze_prediction.py) extrapolates the gaze to
+        prediction_horizon seconds after capture, the expected display time,
+        before it goes through the calibration.
+        stabilization selects the processing: 'mask' blanks a square at the gaze
+        point, 'warp' translates the whole frame with the gaze (see warp.py).
+        instrumentation (see instrumentation.py) records the capture and process
+        stages and the age of the gaze sample each frame is processed with.
+        calibration: a previously fitted calibration.Calibration (or a list of one
+            per eye), or a bare 2x2 eye_to_screen_transform, to use instead of
+            running the interactive calibrate()
+        calibration_model: model fitted by calibrate(), 'affine' or 'poly2' (see
+            calibration.py)
+        calibration_store: a calibration.CalibrationStore; start() then reuses the
+            calibration saved for subject and headset, and saves a new one after
+            calibrating
+        recorder: a started recording.SessionRecorder receiving the gaze samples and
+            (if it records frames) the captured frames before they are processed
+        clock: time source for gaze sampling and prediction, time.perf_counter by
+            default; recording.ReplaySession.clock replays a recording deterministically
+        binocular: process the left and right halves of the frame (one per eye) as
+            separate viewports, each with its own gaze and calibration transform
+            (calibration may then be a list of one Calibration per eye)
+        tiles: split each eye's viewport into this many horizontal bands
+        workers: threads processing eyes and tiles in parallel (OpenCV and numpy
+            release the GIL); None uses one per band up to the core count, 0
+            processes everything on the calling thread
+        foveated: read and process only a roi_size square at full resolution around
+            each eye's gaze, and the rest of the frame downsampled by periphery_scale
+            (a power of two); the periphery is upscaled and the regions pasted over
+            it when the frame is composited. Frames are not recorded in this mode.
+        incremental: only touch what changed since a pooled buffer was last filled.
+            Each captured image gets a signature (the source's sequence, or a CRC-32);
+            when the source reports that the next image is the one a buffer already
+            holds, reading it is skipped and only the previous and new mask
+            rectangles are rewritten, and in 'warp' mode an output buffer already
+            holding the same image at the same offsets is reused without remapping.
+            A new Unity image always gets a full update. Not with foveated.
+            Sources without a sequence (Spout) are always read: 'mask' mode gains
+            nothing from incremental updates then, and 'warp' mode pays a CRC-32 per
+            frame (about 1.6 ms at 2880x1600, against about 33 ms for the remap it
+            can save) to find output buffers it can reuse.
+        eye_events: a gaze_events.EyeMovementClassifier fed with every gaze sample.
+            Once a fixation has lasted fixation_hold seconds, frames are processed
+            with the gaze sampled at that moment until the fixation ends, so warp
+            maps (and incremental updates) are reused instead of following the
+            fixational jitter; during saccades the gaze (predicted, with a
+            gaze_predictor) is sampled fresh for every frame.
+        gaze_process: when start() launches the eye tracker, acquire gaze in a
+            separate, supervised process (gaze_service.GazeService) instead of on a
+            thread of this one, so packet parsing does not compete for the GIL
         '''
-        self._eye_tracker = EyeTracker()
+        if stabilization not in ('mask', 'warp'):
+            raise ValueError("Unknown stabilization mode: %s" % stabilization)
+        self._instrumentation = instrumentation
+        self._eye_tracker = eye_tracker
+        self._gaze_process = gaze_process
         
         # width and height here are to the Viewport in Unity; from the transmitting camera
         self._width = width
         self._height = height 
-        self._spout_name = "UnitySender"
-        self._spout_size = (width,height)
-        self.calibrate()
-        self._init_Spout()
-        self._init_GL()
-        self._processed_img = np.zeros(self._spout_size,dtype=np.ubyte)
-  
-  
-    def _init_Spout(self):
-        '''
-        Initalize a Spout receiver using Python Bindings for Spout C++ SDK. 
-        Source code from: https://github.com/spiraltechnica/Spout-for-Python
-        '''
-        # create spout receiver
-        self._spout_receiver = SpoutSDK.SpoutReceiver()
-    
-        # Its signature in c++ looks like this: bool pyCreateReceiver(const char* theName, unsigned int theWidth, unsigned int theHeight, bool bUseActive);
-        self._spout_receiver.pyCreateReceiver(self._spout_name,
-                                              self._spout_size[0],
-                                              self._spout_size[1],
-                                              False
-        )
+        self._stabilization = stabilization
+        self._frame_source = frame_source
+        self._eyes = 2 if binocular else 1
+        self._eye_width = width // self._eyes
+        # one calibration.Calibration per eye
+        self._calibrations = None
+        if calibration is not None:
+            self._calibrations = self._per_eye_calibrations(calibration)
+        self._calibration_model = calibration_model
+        self._calibration_store = calibration_store
+        self._subject = subject
+        self._headset = headset
+        bounds = np.linspace(0, height, max(int(tiles), 1) + 1).astype(int)
+        self._tile_rows = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+        if workers is None:
+            workers = min(self._eyes * len(self._tile_rows), os.cpu_count() or 1)
+        self._workers = workers
+        self._executor = None
         
-    def _init_GL(self):
-        ''' 
-        Initializes an OpenGL context via PyGame module. The window must exist for OpenGL
-        to function, but is automatically minimized via iconify to avoid cluttering screenspace.
-        ''' 
-        # OpenGL init
-        
-        # window setup
-        pygame.init() 
-        pygame.display.set_caption('Spout Receiver')
-        pygame.display.set_mode((self._width,self._height),pygame.DOUBLEBUF| pygame.OPENGL)
-        pygame.display.iconify()
-        
-        # OpenGL init
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        glOrtho(0,self._width,self._height,0,1,-1)
-        glMatrixMode(GL_MODELVIEW)
-        glDisable(GL_DEPTH_TEST)
-        glClearColor(0.0,0.0,0.0,0.0)
-        glEnable(GL_TEXTURE_2D)
-        
-    
-    
-        # create texture for spout receiver
-        self._tex_id = glGenTextures(1).item()    
-        
-        # initalise receiver texture
-        glBindTexture(GL_TEXTURE_2D, self._tex_id)
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-    
-        # copy data into texture
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_LUMINANCE, self._spout_size[0], self._spout_size[1], 0, GL_LUMINANCE, GL_UNSIGNED_BYTE, None ) 
-        glBindTexture(GL_TEXTURE_2D, 0)
+        if incremental and foveated:
+            raise ValueError("incremental updates are not supported in foveated mode")
+        self._incremental = incremental
+        # (signature, mask rectangles or warp offsets) of what each pooled buffer holds,
+        # and the pixels under its mask rectangles, keyed by id(buffer)
+        self._buffer_states = {}
+        self._masked_pixels = {}
+        self.update_counts = {'skipped_reads': 0, 'full': 0, 'partial': 0, 'unchanged': 0}
+        
+        self._foveated = foveated
+        if foveated:
+            if periphery_scale < 1 or periphery_scale & (periphery_scale - 1):
+                raise ValueError("periphery_scale must be a power of two: %s" % periphery_scale)
+            self._scale = int(periphery_scale)
+            self._roi_size = min(int(roi_size), self._eye_width, height)
+            periphery_shape = (height // self._scale, width // self._scale)
+            self._periphery_pool = FramePool(periphery_shape, dtype=np.ubyte, count=pool_size)
+            self._roi_pool = FramePool((self._eyes, self._roi_size, self._roi_size),
+                                       dtype=np.ubyte, count=pool_size)
+            # warped periphery, before it is upscaled into the output frame
+            self._periphery_scratch = np.zeros(periphery_shape, dtype=np.ubyte)
+        else:
+            self._scale = 1
+        
+        self._warp_engines = None
+        self._warp_options = (warp_cache_size, warp_quantization)
+        if stabilization == 'warp':
+            # warping is not in place, so one more buffer is in flight per frame
+            pool_size += 1
+        # frames are captured into reusable (height, width) row-major buffers
+        self._pool = FramePool((height, width), dtype=np.ubyte, count=pool_size)
+        self._processed_img = None
+        self._frame_index = 0
+        
+        self._gaze_predictor = gaze_predictor
+        self.prediction_horizon = prediction_horizon
+        self._last_gaze_time = -np.inf
+        self._eye_events = eye_events
+        self._fixation_hold = fixation_hold
+        # gaze held for the current stable fixation, and that fixation's start time
+        self._held_gaze = None
+        self._held_fixation = None
+        self._last_valid_gaze = None
+        self._clock = clock if clock is not None else time.perf_counter
+        self._recorder = recorder
+        self._last_recorded_gaze_time = -np.inf
+        
+    def start(self):
+        '''
+        Launch the eye tracker and calibrate it (unless they were passed in), and
+        open the Spout receiver. Returns self.
+        '''
+        if self._eye_tracker is None:
+            tracker_class = EyeTracker
+            if self._gaze_process:
+                from gaze_service import GazeService as tracker_class
+            self._eye_tracker = tracker_class(instrumentation=self._instrumentation).start()
+        if self._calibrations is None and self._calibration_store is not None:
+            saved = self._calibration_store.load(self._subject, self._headset)
+            if saved is not None:
+                self._calibrations = self._per_eye_calibrations(saved)
+        if self._calibrations is None:
+            self.calibrate()
+            self.save_calibration()
+        if self._frame_source is None:
+            self._frame_source = SpoutFrameSource(self._width, self._height, name="UnitySender")
+        if self._stabilization == 'warp':
+            from warp import WarpEngine
+            cache_size, quantization = self._warp_options
+            # one engine per eye, so each eye's maps can be computed on its own thread;
+            # in foveated mode they warp the downsampled periphery
+            self._warp_engines = [WarpEngine(self._eye_width // self._scale, self._height // self._scale,
+                                             cache_size=cache_size, quantization=quantization)
+                                  for _ in range(self._eyes)]
+        if self._foveated:
+            import cv2
+            self._cv2 = cv2
+        if self._workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(self._workers, thread_name_prefix='ImageProcessor')
+        return self
+        
+    @property
+    def last_capture_time(self):
+        ''' time.perf_counter() capture time of the frame last returned by get_processed_image '''
+        return self._processed_img.timestamp if self._processed_img is not None else None
+        
+    @property
+    def workers(self):
+        ''' Number of threads processing eyes and tiles (0 or 1: the calling thread) '''
+        return self._workers
+        
+    @property
+    def eye_events(self):
+        ''' The gaze_events.EyeMovementClassifier in use, if any, e.g. for its statistics() '''
+        return self._eye_events
+        
+    @property
+    def bytes_copied_per_frame(self):
+        ''' Number of bytes the frame source copied to capture the last frame '''
+        return self._frame_source.last_bytes_copied
 
-    def calibrate(self):
+    def calibrate(self, points=None, loops=2, fixation_time=0.2):
         '''
         Calibrate the eye tracker by mapping pupil gaze position to screen position in the given image.
         The coordinate space for images is (0,0) at bottom left, and (1,1) at top right
-        FUNCTION IS BUGGED AND NOT FULLY IMPLEMENTED: CALIBRATION NEEDS FURTHER WORK        
-        '''
-        NUM_LOOPS = 2
-        CALIBRATION_POINTS = [
-            (.5, .5), # center of screen
-            ( 0,  0), # bottom left
-            ( 1,  0), # bottom right
-            ( 0,  1), # top left
-            ( 1,  1)  # top right 
-            ]
-        DX = 25  
-        DY = DX
-        
-        #collect data matrix
-        num_data_points = NUM_LOOPS * len(CALIBRATION_POINTS)
-        eye_pos_data = np.zeros((2, num_data_points))
-        screen_data  = np.zeros((2, num_data_points))
-        data_idx = 0
+        Each target is shown until a key is pressed; the gaze over the last
+        fixation_time seconds then refines the calibration (see calibration.py) by
+        one recursive least squares update. points defaults to calibration.FIVE_POINTS
+        for the affine model and NINE_POINTS for poly2. In binocular mode each
+        target is shown at the same point of both eyes' viewports, and with a
+        binocular tracker each eye is fitted to its own gaze (otherwise both eyes
+        get the same calibration).
+        '''
+        import cv2
+        from calibration import FIVE_POINTS, NINE_POINTS, Calibration, CalibrationTargets
+        if points is None:
+            points = NINE_POINTS if self._calibration_model == 'poly2' else FIVE_POINTS
+        targets = CalibrationTargets(self._width, self._height, eyes=self._eyes)
+        calibrations = [Calibration(self._calibration_model) for _ in range(self._eyes)]
         cv2.namedWindow('calibration')
         cv2.resizeWindow('calibration',(500,100))
         # position window on VR display. 
         cv2.moveWindow('calibration',int(2*1920)+int(1920/2)-100,-300)
-        #for num loops     
-        for i in np.arange(NUM_LOOPS):
-            # loop through each calibration point:
-            for cp in CALIBRATION_POINTS:
-                # plot the calibration point
-                img = np.ones((self._height, self._width, 3))
-                x = int(cp[0]*self._width)
-                y = int(cp[1]*self._height)
-                
-                if cp == (.5, .5):
-                    img[ y-int(DY/2) : y+int(DY/2),  x-int(DX/2) : x+int(DX/2), 1:2] = 0
-                
-                elif cp == (0 , 0):
-                    img[ self._height - DY : self._height, 0 : DX, 1:2] = 0
-                      
-                elif cp == (1, 0):
-                     img[ self._height-DY : self._height,  x-DX : x, 1:2] = 0
-                     
-                elif cp == (0, 1):
-                    img[ 0 : DY,  0 : DX, 1:2] = 0
-                 
-                elif cp == (1, 1):
-                    img[0 : DY,  self._width-DX : self._width, 1:2] = 0
-                cv2.imshow('calibration', img)
+        for _ in range(loops):
+            for cp in points:
+                cv2.imshow('calibration', targets.show(cp))
                 # wait for user to fixate and press key when ready
                 cv2.waitKey(0)
-                # record the pupil position, and screen position
-                eye_pos_data[: , data_idx] = self._eye_tracker.get_gaze_pos()
-                screen_data[:, data_idx] = cp
-                data_idx += 1
-        # calculate least squares fit from pupil position to screen position
-        eye_to_screen_transform = np.linalg.lstsq(eye_pos_data.T , screen_data.T, rcond = None)[0]
-        
-        # set pupil transformation matrix  
-        self._eye_to_screen_transform = eye_to_screen_transform
+                gaze = self._fixation_gaze(fixation_time)
+                for eye, calibration in enumerate(calibrations):
+                    calibration.update(self._eye_gaze(gaze, eye), cp)
+        self._calibrations = calibrations
+    
+    def refine_calibration(self, target, eye=None, fixation_time=0.2):
+        '''
+        Refine the calibration with a validation fixation on target (normalized
+        screen coordinates) without recalibrating: the gaze over the last
+        fixation_time seconds is one more recursive least squares update, of one
+        eye's calibration or (eye None) of all. Returns the errors (normalized
+        units) before the update, per eye.
+        '''
+        gaze = self._fixation_gaze(fixation_time)
+        errors = []
+        for e in self._eyes_of(eye):
+            errors.append(float(self._calibrations[e].errors(self._eye_gaze(gaze, e), target)))
+            self._calibrations[e].update(self._eye_gaze(gaze, e), target)
+        return errors
+    
+    def correct_drift(self, target, eye=None, gain=1.0, fixation_time=0.2):
+        '''
+        Drift check: shift the calibration (offset only) so that the gaze over the
+        last fixation_time seconds maps onto target. Returns the errors before the
+        correction, per eye.
+        '''
+        gaze = self._fixation_gaze(fixation_time)
+        return [float(np.hypot(*self._calibrations[e].correct_drift(self._eye_gaze(gaze, e), target, gain)))
+                for e in self._eyes_of(eye)]
+    
+    def save_calibration(self):
+        ''' Save the calibrations for the subject and headset, if there is a calibration_store '''
+        if self._calibration_store is not None:
+            self._calibration_store.save(self._subject, self._headset, self._calibrations)
+    
+    @property
+    def calibrations(self):
+        ''' The calibration.Calibration of each eye (None before start) '''
+        return self._calibrations
+    
+    def _eyes_of(self, eye):
+        return range(self._eyes) if eye is None else (eye,)
+    
+    def _per_eye_calibrations(self, calibration):
+        from calibration import per_eye_calibrations
+        return per_eye_calibrations(calibration, self._eyes)
+    
+    def _fixation_gaze(self, duration):
+        '''
+        Median uncalibrated gaze over the last duration seconds (the latest sample if
+        there are none). In binocular mode with a binocular tracker, a (2, 2) array
+        of each eye's median over its valid samples (the combined median for an eye
+        that had none).
+        '''
+        since = self._clock() - duration
+        samples = self._eye_tracker.since(since)
+        if len(samples) == 0:
+            combined = np.asarray(self._eye_tracker.get_gaze_pos())
+        else:
+            combined = np.median(samples[:, 1:3], axis=0)
+        if self._eyes == 1 or not getattr(self._eye_tracker, 'binocular', False):
+            return combined
+        records = self._eye_tracker.records_since(since)
+        gaze = np.empty((2, 2))
+        for eye in range(2):
+            valid = records['gaze'][records['valid'][:, eye], eye]
+            gaze[eye] = np.median(valid, axis=0) if len(valid) else combined
+        return gaze
 
     def get_processed_image(self):
         '''
         The get_processed_image function retreives the uncalibrated gaze position from the 
-        eye tracker, then transforms it according to the calibrated eye_to_screen_transform,
+        eye tracker, then transforms it according to the eye's calibration,
         and finally processed that image according to eye position. 
         In this implementation, it is simply a black square of width 500pixels
-        centered around the eye position. The processed image is returned.
+        centered around the eye position. The processed image is returned as a
+        C-contiguous (height, width) array that stays valid until the next call.
         '''
-        (rx, ry) = (self._eye_tracker.get_gaze_pos())
-
-        # calibrate rx, ry to screen 
-        rx,ry = self._eye_to_screen_transform.T@np.array([ry,rx])
-        r_x_coord = int(rx)
-        r_y_coord = int(ry) 
-         
-        print(r_x_coord,r_y_coord)
+        frame = self.process_frame(self.capture_frame())
         
+        # the previously returned frame is no longer in use by the caller
+        if self._processed_img is not None:
+            self.release_frame(self._processed_img)
+        self._processed_img = frame
+        return frame.data
+    
+    def capture_frame(self, block=True, timeout=None):
+        '''
+        First pipeline stage: sample the latest gaze and capture the Unity image into
+        a pooled buffer. Returns a frame_sources.Frame, or None if no buffer became
+        free within timeout. The frame must be handed back with release_frame().
+        '''
+        pool = self._periphery_pool if self._foveated else self._pool
+        prefer = None
+        if self._incremental and self._stabilization == 'warp':
+            # keep the buffers holding warped output around for reuse
+            prefer = lambda buf: self._buffer_states.get(id(buf), (None, None))[1] is None
+        buf = pool.acquire(block, timeout, prefer)
+        if buf is None:
+            return None
+        gaze = self._valid_gaze(self._sample_gaze())
+        start = self._instrumentation.stamp()
+        rois = placements = None
+        if self._foveated:
+            rois = self._roi_pool.acquire()
+            placements = self._roi_placements(gaze)
+            self._frame_source.read_foveated(buf, rois, [origin for origin, _ in placements])
+            signature = None
+        else:
+            signature = self._capture_into(buf)
+        now = time.perf_counter()
+        self._instrumentation.record('capture', start, now)
+        if self._instrumentation.enabled:
+            sample = self._eye_tracker.latest()
+            if sample is not None:
+                self._instrumentation.record(GAZE_AGE, sample[0], now)
+        self._frame_index += 1
+        frame = Frame(buf, self._frame_index, now, gaze, rois, placements, signature)
+        if self._recorder is not None:
+            self._record(frame)
+        return frame
+    
+    def _capture_into(self, buf):
+        '''
+        Read the next Unity image into buf. In incremental mode, return its signature,
+        and skip the read if the source reports that buf already holds the image
+        (unless frames are being recorded).
+        '''
+        if not self._incremental:
+            self._get_unity_img(buf)
+            return None
+        source = self._frame_source
+        upcoming = source.next_sequence()
+        state = self._buffer_states.get(id(buf))
+        recording = self._recorder is not None and self._recorder.record_frames
+        # a warp output buffer holds the image shifted, not the image itself
+        if (upcoming is not None and state is not None and state[0] == upcoming
+                and (state[1] is None or self._stabilization == 'mask') and not recording):
+            source.skip()
+            self.update_counts['skipped_reads'] += 1
+            return upcoming
+        self._get_unity_img(buf)
+        if upcoming is not None:
+            signature = source.sequence
+        elif self._stabilization == 'warp':
+            # only a warp output buffer can be reused on a matching checksum
+            signature = frame_checksum(buf)
+        else:
+            # a freshly read buffer always gets a full mask update: a checksum would go unused
+            signature = None
+        self._buffer_states[id(buf)] = (signature, None)
+        return signature
+    
+    def _record(self, frame):
+        ''' Hand the gaze samples that arrived since the last frame, and the frame, to the recorder '''
+        samples = self._eye_tracker.since(self._last_recorded_gaze_time)
+        if len(samples):
+            self._recorder.record_gaze(samples)
+            self._last_recorded_gaze_time = samples[-1, 0]
+        if self._recorder.record_frames and frame.roi is None:
+            self._recorder.record_frame(frame)
+    
+    def _sample_gaze(self):
+        '''
+        Return the uncalibrated gaze position to process the next frame with. With a
+        gaze predictor, feed it the samples that arrived since the last frame and
+        extrapolate to the expected display time. With an eye movement classifier,
+        feed it the same samples and hold the gaze during stable fixations.
+        '''
+        if self._gaze_predictor is None and self._eye_events is None:
+            if self._eyes == 2 and getattr(self._eye_tracker, 'binocular', False):
+                # each eye's viewport follows that eye
+                return self._eye_tracker.get_binocular_gaze()
+            return self._eye_tracker.get_gaze_pos()
+        self.update_gaze()
+        if self._eye_events is None:
+            return self._predict_gaze()
+        if not self._eye_events.is_stable_fixation(self._fixation_hold):
+            self._held_gaze = None
+            return self._predict_gaze()
+        if self._held_gaze is None or self._held_fixation != self._eye_events.state_start:
+            self._held_gaze = self._predict_gaze()
+            self._held_fixation = self._eye_events.state_start
+        return self._held_gaze
+    
+    def _valid_gaze(self, gaze):
+        '''
+        The gaze to process a frame with: gaze itself when it is finite, otherwise
+        the last finite gaze (of each eye whose gaze is not), or None before any
+        arrived, e.g. while the tracker has not sent a sample yet. Frames with no
+        gaze are shown as captured.
+        '''
+        finite = np.isfinite(gaze)
+        if np.all(finite):
+            self._last_valid_gaze = gaze
+            return gaze
+        last = self._last_valid_gaze
+        if last is None or np.shape(last) != np.shape(gaze):
+            return last
+        # binocular gaze: keep the eyes that are still tracked
+        return np.where(np.all(finite, axis=-1, keepdims=True), gaze, last)
+    
+    def update_gaze(self):
+        '''
+        Feed the gaze samples that arrived since the last call to the gaze predictor
+        and the eye movement classifier (a no-op without either). capture_frame()
+        does this itself; a frame loop can also take in gaze earlier in the frame.
+        '''
+        if self._gaze_predictor is None and self._eye_events is None:
+            return
+        samples = self._eye_tracker.since(self._last_gaze_time)
+        if len(samples):
+            if self._gaze_predictor is not None:
+                self._gaze_predictor.update(samples)
+            if self._eye_events is not None:
+                self._eye_events.update(samples)
+            self._last_gaze_time = samples[-1, 0]
+    
+    def _predict_gaze(self):
+        if self._gaze_predictor is None:
+            return self._eye_tracker.get_gaze_pos()
+        gaze = self._gaze_predictor.predict(self._clock() + self.prediction_horizon)
+        if gaze is None:
+            return self._eye_tracker.get_gaze_pos()
+        return gaze
+    
+    def _gaze_to_screen(self, gaze, eye=0):
+        '''
+        Map an uncalibrated gaze position through the eye's calibration. The
+        calibration targets are in normalized screen coordinates with (0,0) at the
+        bottom left, so the result is scaled to pixel coordinates of the eye's
+        viewport (x to the right, y down) before it is returned.
+        '''
+        sx, sy = self._calibrations[eye].map(gaze)
+        return (sx * self._eye_width, (1 - sy) * self._height)
+    
+    @staticmethod
+    def _eye_gaze(gaze, eye):
+        ''' The gaze of one eye: frames carry either one gaze for both eyes or a (2, 2) array '''
+        gaze = np.asarray(gaze)
+        return gaze[eye] if gaze.ndim == 2 else gaze
+    
+    def _run(self, tasks):
+        ''' Run callables on the worker threads (or inline) and return their results in order '''
+        if self._executor is None or len(tasks) == 1:
+            return [task() for task in tasks]
+        futures = [self._executor.submit(task) for task in tasks]
+        return [future.result() for future in futures]
+    
+    def process_frame(self, frame, block=True, timeout=None):
+        '''
+        Second pipeline stage: process the captured frame according to the gaze
+        sampled at capture time, and return it. In 'mask' mode the frame is edited
+        in place; in 'warp' mode the whole frame is shifted with the gaze into a
+        second pooled buffer, which replaces frame.data.
+        Each eye's viewport, and each horizontal tile of it, is processed as a
+        separate task on the worker threads.
+        block and timeout apply to waiting for that second buffer, as in
+        capture_frame(); if none became free, the frame is released (dropped) and
+        None is returned.
+        '''
+        start = self._instrumentation.stamp()
+        gazes = None
+        if frame.gaze is not None:
+            gazes = [self._gaze_to_screen(self._eye_gaze(frame.gaze, eye), eye)
+                     for eye in range(self._eyes)]
+        out = None
+        if self._foveated or (self._stabilization == 'warp' and gazes is not None):
+            prefer = None
+            if self._incremental and not self._foveated:
+                target = self._warp_target(frame)
+                prefer = lambda buf: self._buffer_states.get(id(buf)) == target
+            out = self._pool.acquire(block, timeout, prefer)
+            if out is None:
+                self.release_frame(frame)
+                return None
+        if self._foveated:
+            frame = self._composite_foveated(frame, gazes, out)
+        elif gazes is None:
+            # no gaze yet: the frame is shown as captured
+            pass
+        elif self._incremental:
+            frame = self._update_incremental(frame, gazes, out)
+        elif self._stabilization == 'warp':
+            frame = self._warp_frame(frame, gazes, out)
+        else:
+            self._run([functools.partial(self._mask_tile, frame.data, eye, px, py, rows)
+                       for eye, (px, py) in enumerate(gazes) for rows in self._tile_rows])
+        self._instrumentation.record('process', start)
+        return frame
+    
+    def stabilization_uniforms(self, gaze):
+        '''
+        The per-eye parameters process_frame applies for a gaze sample, for renderers
+        that stabilize on the GPU instead (see testbed.Displayer.set_stabilization):
+        mask_rects, the (x, y, width, height) squares blanked in 'mask' mode, and
+        offsets, the (dx, dy) shifts of 'warp' mode quantized like the warp engines'.
+        Without a gaze (None), nothing is blanked or shifted.
+        '''
+        if gaze is None:
+            return {'mask_rects': [(0, 0, 0, 0)] * self._eyes, 'offsets': [(0, 0)] * self._eyes}
+        quantization = self._warp_options[1]
+        mask_rects, offsets = [], []
+        for eye in range(self._eyes):
+            px, py = self._gaze_to_screen(self._eye_gaze(gaze, eye), eye)
+            x, y, size = self._mask_bounds(px, py)
+            mask_rects.append((x, y, size, size))
+            offsets.append((round((px - self._eye_width / 2) / quantization) * quantization,
+                            round((py - self._height / 2) / quantization) * quantization))
+        return {'mask_rects': mask_rects, 'offsets': offsets}
+    
+    def _eye_view(self, data, eye, scale=1):
+        ''' The (height, eye_width) view of one eye's viewport in a frame buffer (downsampled by scale) '''
+        width = self._eye_width // scale
+        return data[:, eye * width:(eye + 1) * width]
+    
+    def _mask_bounds(self, px, py):
+        ''' (x, y, size) of the square blanked around the gaze at (px, py), in eye viewport pixels '''
         # Width/Height of Black Window
-        dx = 500 
-        dy = 500
-        self._processed_img = self._get_unity_img()
-        self._processed_img[r_x_coord:r_x_coord+dx,r_y_coord:r_y_coord+dy] = 0
-        print('xbounds zeroed:', r_x_coord,r_x_coord+dx)
-        print('ybounds zeroed:', r_y_coord,r_y_coord+dy)
-        return self._processed_img
-        
-    def _get_unity_img(self):
+        size = 500
+        r_x_coord = min(max(int(px) - size//2, 0), self._eye_width)
+        r_y_coord = min(max(int(py) - size//2, 0), self._height)
+        return r_x_coord, r_y_coord, size
+    
+    def _mask_tile(self, data, eye, px, py, rows):
+        ''' Blank the part of the square around the gaze at (px, py) that lies in the tile '''
+        r_x_coord, r_y_coord, size = self._mask_bounds(px, py)
+        top = max(r_y_coord, rows.start)
+        bottom = min(r_y_coord + size, rows.stop)
+        if top < bottom:
+            self._eye_view(data, eye)[top:bottom, r_x_coord:r_x_coord+size] = 0
+    
+    def _roi_placements(self, gaze):
+        '''
+        For each eye, where to read its full resolution region from and where it
+        ends up: ((x, y) origin in the frame, (dx, dy) shift applied by the
+        stabilization). The region is the one displayed around the gaze; in 'warp'
+        mode that content comes from the viewport center, shifted onto the gaze.
+        Without a gaze (None), the region at the viewport center is not shifted.
+        '''
+        size = self._roi_size
+        placements = []
+        for eye in range(self._eyes):
+            if gaze is None:
+                px, py = self._eye_width / 2, self._height / 2
+            else:
+                px, py = self._gaze_to_screen(self._eye_gaze(gaze, eye), eye)
+            if self._stabilization == 'warp':
+                shift = (int(round(px - self._eye_width / 2)), int(round(py - self._height / 2)))
+            else:
+                shift = (0, 0)
+            x = min(max(int(round(px - size / 2)) - shift[0], 0), self._eye_width - size)
+            y = min(max(int(round(py - size / 2)) - shift[1], 0), self._height - size)
+            placements.append(((eye * self._eye_width + x, y), shift))
+        return placements
+    
+    def _composite_foveated(self, frame, gazes, out):
+        '''
+        Stabilize the downsampled periphery and the full resolution regions of a
+        foveated frame, then upscale the periphery into a full size pooled buffer
+        and paste the regions over it (out is that buffer). The regions are shifted by whole pixels
+        only; the periphery keeps the sub-pixel offset. Without gazes (None) the
+        frame is only composited.
+        '''
+        scale = self._scale
+        periphery = frame.data
+        if gazes is None:
+            pass
+        elif self._stabilization == 'warp':
+            periphery = self._periphery_scratch
+            for eye, (px, py) in enumerate(gazes):
+                self._warp_engines[eye].translate(
+                    self._eye_view(frame.data, eye, scale), (px - self._eye_width / 2) / scale,
+                    (py - self._height / 2) / scale, self._eye_view(periphery, eye, scale))
+        else:
+            for eye, (px, py) in enumerate(gazes):
+                x, y, size = self._mask_bounds(px, py)
+                self._eye_view(periphery, eye, scale)[y // scale:-(-(y + size) // scale),
+                                                      x // scale:-(-(x + size) // scale)] = 0
+                (roi_x, roi_y), _ = frame.roi_placements[eye]
+                roi_x -= eye * self._eye_width
+                frame.roi[eye][max(y - roi_y, 0):max(y + size - roi_y, 0),
+                               max(x - roi_x, 0):max(x + size - roi_x, 0)] = 0
+        
+        self._cv2.resize(periphery, (self._width, self._height), dst=out,
+                         interpolation=self._cv2.INTER_LINEAR)
+        size = self._roi_size
+        for eye, ((roi_x, roi_y), (dx, dy)) in enumerate(frame.roi_placements):
+            x0 = roi_x - eye * self._eye_width + dx
+            y0 = roi_y + dy
+            left, top = max(x0, 0), max(y0, 0)
+            right, bottom = min(x0 + size, self._eye_width), min(y0 + size, self._height)
+            if left < right and top < bottom:
+                self._eye_view(out, eye)[top:bottom, left:right] = \
+                    frame.roi[eye][top - y0:bottom - y0, left - x0:right - x0]
+        self._release_foveated(frame)
+        frame.data = out
+        return frame
+    
+    def _release_foveated(self, frame):
+        self._periphery_pool.release(frame.data)
+        self._roi_pool.release(frame.roi)
+        frame.roi = None
+        frame.roi_placements = None
+    
+    def _update_incremental(self, frame, gazes, out=None):
+        '''
+        Incremental counterpart of process_frame. A buffer whose read was skipped
+        still holds the image masked for an earlier gaze: only its old and new mask
+        rectangles are rewritten. In 'warp' mode a new offset moves every pixel, so
+        the only saving is reusing an output buffer that already holds the result
+        (out is the buffer to warp into).
+        '''
+        counts = self.update_counts
+        if self._stabilization == 'warp':
+            target = self._warp_target(frame)
+            if self._buffer_states.get(id(out)) == target:
+                counts['unchanged'] += 1
+                self._pool.release(frame.data)
+                frame.data = out
+                return frame
+            counts['full'] += 1
+            frame = self._warp_frame(frame, gazes, out)
+            self._buffer_states[id(frame.data)] = target
+            return frame
+        
+        data = frame.data
+        rects = tuple(self._mask_bounds(px, py) for px, py in gazes)
+        state = self._buffer_states.get(id(data))
+        if state == (frame.signature, rects):
+            counts['unchanged'] += 1
+            return frame
+        if state[1] is None:
+            # freshly read
+            counts['full'] += 1
+        else:
+            counts['partial'] += 1
+            for eye, (x, y, size) in enumerate(state[1]):
+                view = self._eye_view(data, eye)[y:y+size, x:x+size]
+                view[:] = self._masked_pixels[id(data)][eye, :view.shape[0], :view.shape[1]]
+        masked = self._masked_pixels.get(id(data))
+        if masked is None:
+            size = rects[0][2]
+            masked = self._masked_pixels[id(data)] = np.empty((self._eyes, size, size), dtype=data.dtype)
+        for eye, (x, y, size) in enumerate(rects):
+            view = self._eye_view(data, eye)[y:y+size, x:x+size]
+            masked[eye, :view.shape[0], :view.shape[1]] = view
+            view[:] = 0
+        self._buffer_states[id(data)] = (frame.signature, rects)
+        return frame
+    
+    def _warp_target(self, frame):
+        ''' The state of a buffer holding frame's image warped for its gaze (incremental mode) '''
+        return (frame.signature, tuple(self.stabilization_uniforms(frame.gaze)['offsets']))
+    
+    def _warp_frame(self, frame, gazes, out):
+        '''
+        Translate each eye's viewport into the pooled buffer out, so that the point
+        rendered at its center lands on the gaze position, i.e. the image moves with
+        the eye and stays fixed on the retina.
+        '''
+        engines = self._warp_engines
+        maps = self._run([functools.partial(engines[eye].maps_for, px - self._eye_width / 2,
+                                            py - self._height / 2)
+                          for eye, (px, py) in enumerate(gazes)])
+        self._run([functools.partial(engines[eye].remap, self._eye_view(frame.data, eye), maps[eye],
+                                     self._eye_view(out, eye), rows)
+                   for eye in range(self._eyes) for rows in self._tile_rows])
+        self._pool.release(frame.data)
+        frame.data = out
+        return frame
+    
+    def release_frame(self, frame):
+        ''' Return a frame's buffer to the pool once it has been displayed (or dropped) '''
+        if frame.roi is not None:
+            # captured in foveated mode but never composited
+            self._release_foveated(frame)
+            return
+        self._pool.release(frame.data)
+        
+    def _get_unity_img(self, out):
         ''' 
-        Using OpenGL and Spout, capture the image data from the Unity Engine being transmitted
-        by the spout_sender camera.  Return this data as a numpy aray containing luminance data. 
-        (Can change GL_LUMINANCE to GL_RGB/RGBA to capture color images)
-        
-        '''
-        glBindTexture(GL_TEXTURE_2D, self._tex_id)
-        self._spout_receiver.pyReceiveTexture(self._spout_name, 
-                                              self._spout_size[0],
-                                              self._spout_size[1],
-                                              self._tex_id,
-                                               GL_TEXTURE_2D, False, 0)
-       
-
-          
-        data = glGetTexImage(GL_TEXTURE_2D, 0, GL_LUMINANCE, GL_UNSIGNED_BYTE, outputType=None) 
-        return(np.reshape(np.frombuffer(data,dtype=np.ubyte),(self._spout_size[1],self._spout_size[0]))).T
+        Capture the image data from the Unity Engine (or the substituted frame source)
+        into the pooled buffer out. Returns out, a (height, width) array of luminance data.
+        '''
+        return self._frame_source.read(out)
         
     def __del__(self):
-        self._spout_receiver.ReleaseReceiver()      
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._frame_source is not None:
+            self._frame_source.close()
@@ -26,6 +26,16 @@ public class PythonCaller : MonoBehaviour
     public float y_move_scale = 1;
     public float z_move_scale = 1;
 
+    // pose packet layout, see pose_protocol.py
+    const uint POSE_MAGIC = 0x53505256;
+    const ushort POSE_PROTOCOL_VERSION = 1;
+    const int HEADER_SIZE = 24;
+    const int DEVICE_SIZE = 32;
+    const int MAX_DEVICES = 64;
+    const uint HMD_DEVICE_INDEX = 0;
+    private uint _sequence = 0;
+    private double _capture_time = 0;
+
     string[] stringSeparators = new string[] { "*TOUCHEND*", "*MOUSEDELTA*", "*Tapped*", "*DoubleTapped*" };
 
     void Awake()
@@ -62,14 +72,14 @@ public class PythonCaller : MonoBehaviour
         NetworkStream recvStm = new NetworkStream(client);
         //tick = 0;
 
+        byte[] headerBuffer = new byte[HEADER_SIZE];
+        byte[] deviceBuffer = new byte[DEVICE_SIZE * MAX_DEVICES];
+
         while (Socket_Thread_Flag)
         {
-            byte[] receiveBuffer = new byte[4*7];
             try
             {
-
-                //print (recvStm.Read(receiveBuffer, 0, receiveBuffer.Length));
-                if (recvStm.Read(receiveBuffer, 0, receiveBuffer.Length) == 0)
+                if (!ReadExactly(recvStm, headerBuffer, HEADER_SIZE))
                 {
                     // when disconnected , wait for new connection.
                     client.Close();
@@ -85,22 +95,38 @@ public class PythonCaller : MonoBehaviour
 
                     clientep = (IPEndPoint)client.RemoteEndPoint;
                     recvStm = new NetworkStream(client);
+                    continue;
+                }
 
+                uint magic = System.BitConverter.ToUInt32(headerBuffer, 0);
+                ushort version = System.BitConverter.ToUInt16(headerBuffer, 4);
+                int deviceCount = System.BitConverter.ToUInt16(headerBuffer, 6);
+                if (magic != POSE_MAGIC || version != POSE_PROTOCOL_VERSION || deviceCount > MAX_DEVICES)
+                {
+                    throw new Exception("Unsupported pose packet");
                 }
-                else
+                if (!ReadExactly(recvStm, deviceBuffer, deviceCount * DEVICE_SIZE))
                 {
-                    
-                    this._w = System.BitConverter.ToSingle(receiveBuffer,0);
-                    this._x = System.BitConverter.ToSingle(receiveBuffer, 4);
-                    this._y = System.BitConverter.ToSingle(receiveBuffer, 8);
-                    this._z = System.BitConverter.ToSingle(receiveBuffer, 12);
-
-                    this._x_pos = System.BitConverter.ToSingle(receiveBuffer, 16);
-                    this._y_pos = System.BitConverter.ToSingle(receiveBuffer, 20);
-                    this._z_pos = System.BitConverter.ToSingle(receiveBuffer, 24);
-
-                  
+                    throw new Exception("Connection closed inside a pose packet");
+                }
+                this._sequence = System.BitConverter.ToUInt32(headerBuffer, 8);
+                this._capture_time = System.BitConverter.ToDouble(headerBuffer, 16);
 
+                for (int i = 0; i < deviceCount; i++)
+                {
+                    int offset = i * DEVICE_SIZE;
+                    if (System.BitConverter.ToUInt32(deviceBuffer, offset) != HMD_DEVICE_INDEX)
+                    {
+                        continue;
+                    }
+                    this._w = System.BitConverter.ToSingle(deviceBuffer, offset + 4);
+                    this._x = System.BitConverter.ToSingle(deviceBuffer, offset + 8);
+                    this._y = System.BitConverter.ToSingle(deviceBuffer, offset + 12);
+                    this._z = System.BitConverter.ToSingle(deviceBuffer, offset + 16);
+
+                    this._x_pos = System.BitConverter.ToSingle(deviceBuffer, offset + 20);
+                    this._y_pos = System.BitConverter.ToSingle(deviceBuffer, offset + 24);
+                    this._z_pos = System.BitConverter.ToSingle(deviceBuffer, offset + 28);
                 }
 
             }
@@ -117,6 +143,22 @@ public class PythonCaller : MonoBehaviour
 
     }
 
+    // Read exactly count bytes, returns false if the connection closed first.
+    private static bool ReadExactly(NetworkStream stream, byte[] buffer, int count)
+    {
+        int received = 0;
+        while (received < count)
+        {
+            int n = stream.Read(buffer, received, count - received);
+            if (n == 0)
+            {
+                return false;
+            }
+            received += n;
+        }
+        return true;
+    }
+
     void OnApplicationQuit()
     {
         try
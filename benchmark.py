@@ -0,0 +1,1224 @@
+'''
+Benchmarks for the experiment's data paths. They run on a single machine
+without the headset, Unity or Pupil Capture, using the stand-ins provided next
+to each component.
+
+usage: python benchmark.py <benchmark> [options]
+       python benchmark.py --help
+
+Results can be saved as a baseline (--save-baseline) and later runs compared
+against it (--compare); baselines are kept in baselines/<benchmark>.json.
+'''
+
+import argparse
+import inspect
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+
+from instrumentation import Instrumentation
+from pose_protocol import (POSE_HEADER_DTYPE, PoseDecoder, PoseEncoder, PoseReceiver,
+                           SharedMemoryPoseReader, SharedMemoryPoseTransport, TcpPoseTransport)
+
+
+def summarize(samples, scale=1e3):
+    '''
+    Percentile summary of a sequence of durations in seconds, reported in
+    milliseconds (or whatever unit scale converts to).
+    '''
+    samples = np.asarray(samples, dtype=np.float64) * scale
+    if len(samples) == 0:
+        return {'n': 0}
+    p50, p90, p99 = np.percentile(samples, (50, 90, 99))
+    return {
+        'n': len(samples),
+        'mean': float(samples.mean()),
+        'std': float(samples.std()),
+        'p50': float(p50),
+        'p90': float(p90),
+        'p99': float(p99),
+        'max': float(samples.max()),
+    }
+
+
+def _collect_echoes(sock, count, latencies, stop_event):
+    ''' Read echoed pose headers and record their round-trip time '''
+    header_size = POSE_HEADER_DTYPE.itemsize
+    pending = bytearray()
+    sock.settimeout(0.1)
+    while len(latencies) < count and not stop_event.is_set():
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            return
+        now = time.perf_counter()
+        pending += data
+        complete = len(pending) - len(pending) % header_size
+        headers = np.frombuffer(bytes(pending[:complete]), dtype=POSE_HEADER_DTYPE)
+        del pending[:complete]
+        latencies.extend(now - headers['timestamp'])
+
+
+def bench_pose_tcp(count=2000, rate=1000.0, devices=1):
+    '''
+    Round-trip latency and throughput of the TCP pose transport against the
+    PoseReceiver stand-in for PythonCaller.cs.
+
+    Latency: count packets sent at rate Hz; the receiver echoes each header and
+    the time from encoding to the echo arriving is recorded.
+    Throughput: count packets submitted back to back; reports how many the
+    receiver decoded per second and how many were coalesced away.
+    '''
+    rotations = np.tile([1.0, 0.0, 0.0, 0.0], (devices, 1))
+    positions = np.zeros((devices, 3))
+    indices = np.arange(devices)
+    results = {'devices': devices}
+
+    receiver = PoseReceiver(port=0, echo=True).start()
+    transport = TcpPoseTransport(port=receiver.port).connect()
+    encoder = PoseEncoder()
+    latencies = []
+    stop_event = threading.Event()
+    reader = threading.Thread(target=_collect_echoes,
+                              args=(transport.socket, count, latencies, stop_event), daemon=True)
+    reader.start()
+
+    period = 1.0 / rate
+    submit_times = []
+    next_send = time.perf_counter()
+    for _ in range(count):
+        t0 = time.perf_counter()
+        transport.submit(encoder.encode(indices, rotations, positions, timestamp=t0))
+        submit_times.append(time.perf_counter() - t0)
+        next_send += period
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    reader.join(2.0)
+    stop_event.set()
+    results['round_trip_ms'] = summarize(latencies)
+    results['submit_ms'] = summarize(submit_times)
+
+    received_before = receiver.packets
+    handled_before = transport.sent + transport.coalesced
+    coalesced_before = transport.coalesced
+    start = time.perf_counter()
+    for _ in range(count):
+        transport.submit(encoder.encode(indices, rotations, positions))
+    deadline = time.perf_counter() + 2.0
+    while transport.sent + transport.coalesced - handled_before < count and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    time.sleep(0.05)
+    results['throughput'] = {
+        'submitted_per_s': count / elapsed,
+        'received_per_s': (receiver.packets - received_before) / elapsed,
+        'coalesced': transport.coalesced - coalesced_before,
+    }
+
+    transport.close()
+    receiver.stop()
+    return results
+
+
+def _tcp_latency_reader(conn, count, timeout):
+    ''' Reader process for bench_pose_transports: one-way latency over TCP '''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("localhost", 0))
+    server.listen(1)
+    conn.send(server.getsockname()[1])
+    client, _ = server.accept()
+    client.settimeout(0.1)
+    decoder = PoseDecoder()
+    latencies = []
+    deadline = time.perf_counter() + timeout
+    while len(latencies) < count and time.perf_counter() < deadline:
+        try:
+            data = client.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        now = time.perf_counter()
+        latencies.extend(now - header['timestamp'] for header, _ in decoder.feed(data))
+    client.close()
+    server.close()
+    conn.send(latencies)
+
+
+def _shm_latency_reader(conn, name, count, timeout):
+    ''' Reader process for bench_pose_transports: one-way latency through shared memory '''
+    reader = SharedMemoryPoseReader(name)
+    conn.send(None)
+    latencies = []
+    deadline = time.perf_counter() + timeout
+    while len(latencies) < count and time.perf_counter() < deadline:
+        packet = reader.poll()
+        if packet is None:
+            # yield the core; a dedicated reader would spin here
+            time.sleep(0)
+            continue
+        latencies.append(time.perf_counter() - packet[0]['timestamp'])
+    retries = reader.retries
+    reader.close()
+    conn.send((latencies, retries))
+
+
+def bench_pose_transports(count=2000, rate=1000.0, devices=1):
+    '''
+    Compare the TCP and shared memory pose transports. A separate reader process
+    records the one-way latency from pose capture (the packet timestamp) to the
+    reader seeing the packet; the sender records the cost of submit().
+    time.perf_counter() is system-wide on Linux, so timestamps are comparable
+    across processes.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    rotations = np.tile([1.0, 0.0, 0.0, 0.0], (devices, 1))
+    positions = np.zeros((devices, 3))
+    indices = np.arange(devices)
+    timeout = count / rate + 10.0
+    results = {'devices': devices, 'rate': rate}
+
+    for kind in ('tcp', 'shm'):
+        parent, child = ctx.Pipe()
+        if kind == 'tcp':
+            proc = ctx.Process(target=_tcp_latency_reader, args=(child, count, timeout))
+            proc.start()
+            transport = TcpPoseTransport(port=parent.recv()).connect()
+        else:
+            transport = SharedMemoryPoseTransport("vr_pose_bench_%d" % time.perf_counter_ns()).connect()
+            proc = ctx.Process(target=_shm_latency_reader, args=(child, transport.name, count, timeout))
+            proc.start()
+            parent.recv()
+
+        encoder = PoseEncoder()
+        submit_times = []
+        next_send = time.perf_counter()
+        for _ in range(count):
+            t0 = time.perf_counter()
+            transport.submit(encoder.encode(indices, rotations, positions, timestamp=t0))
+            submit_times.append(time.perf_counter() - t0)
+            next_send += 1.0 / rate
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        received = parent.recv()
+        proc.join()
+        transport.close()
+        if kind == 'shm':
+            received, results['shm_read_retries'] = received
+        latency = summarize(received)
+        if latency['n']:
+            latency['jitter'] = latency['p99'] - latency['p50']
+        results[kind] = {'one_way_ms': latency, 'submit_ms': summarize(submit_times)}
+    return results
+
+
+def bench_experiment(count=2000, width=2880, height=1600, stabilization='mask', pipelined=False,
+                     alloc_frames=100, gaze_rate=120.0):
+    '''
+    Drive VRInterface, ImageProcessor and PositionSender headless through count
+    frames, with the fakes.py stand-ins for OpenVR, Spout and Pupil Capture and a
+    PoseReceiver in place of Unity. Reports frames per second, the per-stage
+    latencies from instrumentation.py, and the memory allocated per frame
+    (measured with tracemalloc over a further alloc_frames frames, since
+    tracing slows the loop down).
+    '''
+    import fakes
+    fakes.install()
+    import Experiment
+
+    instrumentation = Instrumentation()
+    tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate, instrumentation=instrumentation)
+    receiver = PoseReceiver(port=0).start()
+    processor = Experiment.ImageProcessor(
+        width, height, eye_tracker=tracker, frame_source=fakes.FakeSpoutFrameSource(width, height),
+        stabilization=stabilization, calibration=np.eye(2), instrumentation=instrumentation).start()
+    vr = Experiment.VRInterface(pipelined=pipelined, instrumentation=instrumentation,
+                                image_processor=processor, display=False).start()
+    sender = Experiment.PositionSender(port=receiver.port, instrumentation=instrumentation).start()
+
+    def step():
+        vr.update()
+        sender.send(vr.get_head_rotation(), vr.get_head_position())
+
+    start = time.perf_counter()
+    for _ in range(count):
+        step()
+    elapsed = time.perf_counter() - start
+    summary = instrumentation.summary()
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    peaks = []
+    for _ in range(alloc_frames):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        step()
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    vr.stop_pipeline()
+    sender._del()
+    receiver.stop()
+    gaze_sender.stop()
+    return {
+        'frames': count,
+        'resolution': [width, height],
+        'stabilization': stabilization,
+        'pipelined': pipelined,
+        'fps': count / elapsed,
+        'frames_displayed': summary['frames'],
+        'frames_dropped': summary['frames_dropped'],
+        'frames_repeated': summary['frames_repeated'],
+        'stages_ms': summary['stages'],
+        'poses_received': receiver.packets,
+        'alloc_peak_bytes_per_frame': summarize(peaks, scale=1),
+        'alloc_retained_bytes_per_frame': retained / max(alloc_frames, 1),
+    }
+
+
+def bench_recording(count=300, width=2880, height=1600, compression=None, gaze_rate=120.0):
+    '''
+    Record count frames of a headless session (fake gaze and Spout) with a
+    SessionRecorder, then replay the recording through an ImageProcessor as fast
+    as possible, twice. Reports the per-frame cost in the recording loop, records
+    dropped, bytes on disk, replay frames per second and whether the two replays
+    produced identical output.
+    '''
+    import fakes
+    fakes.install()
+    import Experiment
+    from recording import ReplaySession, SessionRecorder
+
+    directory = tempfile.mkdtemp(prefix='vr_session_')
+    path = os.path.join(directory, 'session')
+    try:
+        recorder = SessionRecorder(path, width, height, record_frames=True,
+                                   compression=compression).start()
+        tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate)
+        processor = Experiment.ImageProcessor(
+            width, height, eye_tracker=tracker, frame_source=fakes.FakeSpoutFrameSource(width, height),
+            calibration=np.eye(2), recorder=recorder).start()
+        frame_times = []
+        for _ in range(count):
+            t0 = time.perf_counter()
+            processor.get_processed_image()
+            frame_times.append(time.perf_counter() - t0)
+            # pace like a 90 Hz display so the writer is not starved of the core
+            time.sleep(max(0.0, 1 / 90.0 - frame_times[-1]))
+        t0 = time.perf_counter()
+        recorder.stop()
+        flush_time = time.perf_counter() - t0
+        gaze_sender.stop()
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        results = {
+            'frames': count,
+            'compression': compression,
+            'record_frame_ms': summarize(frame_times),
+            'records_dropped': recorder.dropped,
+            'frames_written': recorder.frames,
+            'flush_ms': flush_time * 1e3,
+            'bytes_on_disk': size,
+            'compression_ratio': count * width * height / max(size, 1),
+        }
+
+        checksums = []
+        for _ in range(2):
+            replay = ReplaySession(path)
+            processor = Experiment.ImageProcessor(
+                replay.width, replay.height, eye_tracker=replay.eye_tracker,
+                frame_source=replay.frame_source, clock=replay.clock, calibration=np.eye(2)).start()
+            crc = 0
+            t0 = time.perf_counter()
+            for _ in range(len(replay)):
+                crc = zlib.crc32(processor.get_processed_image(), crc)
+            results['replay_fps'] = len(replay) / (time.perf_counter() - t0)
+            checksums.append(crc)
+            replay.reader.close()
+        results['replay_deterministic'] = checksums[0] == checksums[1]
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_tiles(count=200, width=2880, height=1600, stabilization='warp', gaze_rate=120.0):
+    '''
+    Processing time per frame for the whole frame at once, per eye, and per eye
+    split into 2 and 4 horizontal tiles, each on the default number of worker
+    threads. Frames come from the fake Spout source and gaze from a fake tracker.
+    '''
+    import fakes
+    fakes.install()
+    import Experiment
+
+    tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate)
+    results = {'cpu_count': os.cpu_count(), 'stabilization': stabilization}
+    for binocular, tiles in ((False, 1), (True, 1), (True, 2), (True, 4)):
+        instrumentation = Instrumentation()
+        processor = Experiment.ImageProcessor(
+            width, height, eye_tracker=tracker, frame_source=fakes.FakeSpoutFrameSource(width, height),
+            stabilization=stabilization, calibration=np.eye(2), instrumentation=instrumentation,
+            binocular=binocular, tiles=tiles).start()
+        start = time.perf_counter()
+        for _ in range(count):
+            processor.get_processed_image()
+        elapsed = time.perf_counter() - start
+        name = '%s_%dtiles' % ('binocular' if binocular else 'whole', tiles)
+        results[name] = {
+            'workers': processor.workers,
+            'fps': count / elapsed,
+            'process_ms': instrumentation.summary()['stages']['process'],
+        }
+    gaze_sender.stop()
+    return results
+
+
+def bench_foveation(count=200, width=2880, height=1600, stabilization='warp', roi_size=512,
+                    periphery_scale=4, gaze_rate=120.0):
+    '''
+    Capture and processing time, and bytes read back per frame, for full
+    resolution frames against foveated ones (a roi_size region per eye plus the
+    periphery downsampled by periphery_scale). Frames come from the fake Spout
+    source, which reads back only what the real one would, and gaze from a fake
+    tracker.
+    '''
+    import fakes
+    fakes.install()
+    import Experiment
+
+    tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate)
+    results = {'stabilization': stabilization, 'roi_size': roi_size, 'periphery_scale': periphery_scale}
+    for foveated in (False, True):
+        instrumentation = Instrumentation()
+        source = fakes.FakeSpoutFrameSource(width, height)
+        processor = Experiment.ImageProcessor(
+            width, height, eye_tracker=tracker, frame_source=source, stabilization=stabilization,
+            calibration=np.eye(2), instrumentation=instrumentation, binocular=True,
+            foveated=foveated, roi_size=roi_size, periphery_scale=periphery_scale).start()
+        start = time.perf_counter()
+        for _ in range(count):
+            processor.get_processed_image()
+        elapsed = time.perf_counter() - start
+        stages = instrumentation.summary()['stages']
+        results['foveated' if foveated else 'full'] = {
+            'fps': count / elapsed,
+            'capture_ms': stages['capture'],
+            'process_ms': stages['process'],
+            'bytes_copied_per_frame': source.total_bytes_copied / source.frames_read,
+        }
+    gaze_sender.stop()
+    full, foveated = results['full'], results['foveated']
+    results['speedup'] = foveated['fps'] / full['fps']
+    results['bytes_ratio'] = foveated['bytes_copied_per_frame'] / full['bytes_copied_per_frame']
+    return results
+
+
+def bench_gpu_stabilization(count=100, width=2880, height=1600, stabilization='mask', platform='egl',
+                            gaze_rate=120.0):
+    '''
+    Stabilize the same binocular frames with ImageProcessor on the CPU and with
+    testbed.Displayer's shader in a headless context (Mesa's software rasterizer
+    unless LIBGL_ALWAYS_SOFTWARE is set otherwise), and report both times and how
+    many pixels differ. The GPU time covers setting the uniforms and rendering;
+    uploading the frame stands in for Spout and is not counted.
+    '''
+    # PyOpenGL picks its platform on first import
+    os.environ.setdefault('PYOPENGL_PLATFORM', platform)
+    os.environ.setdefault('LIBGL_ALWAYS_SOFTWARE', '1')
+    import cv2
+    from OpenGL import GL
+    import fakes
+    fakes.install()
+    import Experiment
+    import testbed
+    from frame_sources import SyntheticFrameSource
+
+    tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate)
+    processor = Experiment.ImageProcessor(
+        width, height, eye_tracker=tracker, frame_source=SyntheticFrameSource(width, height),
+        stabilization=stabilization, calibration=np.eye(2), binocular=True).start()
+    displayer = testbed.Displayer(width, height, eyes=2, headless=True).start()
+    gpu = np.empty((height, width), dtype=np.uint8)
+    diff = np.empty((height, width), dtype=np.uint8)
+    cpu_times, gpu_times = [], []
+    max_diff, mismatched = 0, 0
+    for _ in range(count):
+        frame = processor.capture_frame()
+        displayer.upload(frame.data)
+        start = time.perf_counter()
+        displayer.set_stabilization(stabilization, **processor.stabilization_uniforms(frame.gaze))
+        displayer.update()
+        GL.glFinish()
+        gpu_times.append(time.perf_counter() - start)
+        displayer.read_view(gpu)
+
+        start = time.perf_counter()
+        frame = processor.process_frame(frame)
+        cpu_times.append(time.perf_counter() - start)
+        cv2.absdiff(frame.data, gpu, dst=diff)
+        max_diff = max(max_diff, int(diff.max()))
+        # cv2.remap interpolates in fixed point, so allow one level of rounding
+        mismatched += int(np.count_nonzero(diff > 1))
+        processor.release_frame(frame)
+    displayer.close()
+    gaze_sender.stop()
+    return {
+        'stabilization': stabilization,
+        'platform': platform,
+        'cpu_process_ms': summarize(cpu_times),
+        'gpu_render_ms': summarize(gpu_times),
+        'max_abs_diff': max_diff,
+        'mismatched_fraction': mismatched / float(count * width * height),
+    }
+
+
+def bench_display_frames(count=300, width=2048, height=1280, clip_frames=24):
+    '''
+    Per-frame cost of getting a display-ready RGBA frame for testbed.Displayer:
+    the old path (imread, cvtColor and resize on every frame) against the
+    DisplayFramePrefetcher for a still image and for a looping clip of
+    clip_frames, and one memory copy of a frame, which is what the texture
+    upload itself costs.
+    '''
+    import cv2
+    from frame_sources import DecodedFrameCache, DisplayFramePrefetcher, SyntheticFrameSource
+
+    directory = tempfile.mkdtemp(prefix='display_frames_')
+    try:
+        scene = SyntheticFrameSource(width // 2, height // 2)
+        gray = np.empty(scene.shape, dtype=np.uint8)
+        image_path = os.path.join(directory, 'still.png')
+        cv2.imwrite(image_path, cv2.cvtColor(scene.read(gray), cv2.COLOR_GRAY2BGR))
+        video_path = os.path.join(directory, 'clip.avi')
+        writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'MJPG'), 30.0, (width // 2, height // 2))
+        for _ in range(clip_frames):
+            writer.write(cv2.cvtColor(scene.read(gray), cv2.COLOR_GRAY2BGR))
+        writer.release()
+
+        def per_frame(get):
+            samples = []
+            for _ in range(count):
+                start = time.perf_counter()
+                get()
+                samples.append(time.perf_counter() - start)
+            return summarize(samples)
+
+        def decode_every_frame():
+            img = cv2.imread(image_path)
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGBA)
+            return cv2.resize(img, (width, height))
+
+        results = {'decode_every_frame_ms': per_frame(decode_every_frame)}
+        still = DisplayFramePrefetcher(image_path, width, height).start()
+        results['cached_still_ms'] = per_frame(still.next)
+        results['still_frames_decoded'] = still.frames_decoded
+
+        cache = DecodedFrameCache(max_bytes=clip_frames * width * height * 4)
+        clip = DisplayFramePrefetcher(video_path, width, height, cache=cache).start()
+        results['prefetched_clip_ms'] = per_frame(lambda: clip.next(timeout=1.0))
+        clip.stop()
+        results['clip_frames_decoded'] = clip.frames_decoded
+        results['clip_cache_hits'] = cache.hits
+
+        frame = still.next()
+        texture = np.empty_like(frame)
+        results['frame_copy_ms'] = per_frame(lambda: np.copyto(texture, frame))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_video(count=300, width=2880, height=1600, stabilization='warp', video=None, realtime=False,
+                gaze_rate=120.0):
+    '''
+    Load-test the stabilization pipeline with ImageProcessor reading a video
+    (decoded on VideoFrameSource's worker thread) instead of Spout, at full
+    resolution. Without a video, a short synthetic clip is written first. Reports
+    fps, capture (waiting for the decoder plus one copy) and process times.
+    '''
+    import cv2
+    import fakes
+    fakes.install()
+    import Experiment
+    from frame_sources import SyntheticFrameSource, VideoFrameSource
+
+    directory = tempfile.mkdtemp(prefix='video_')
+    try:
+        if video is None:
+            video = os.path.join(directory, 'clip.avi')
+            scene = SyntheticFrameSource(width, height)
+            gray = np.empty(scene.shape, dtype=np.uint8)
+            writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*'MJPG'), 90.0, (width, height))
+            for _ in range(30):
+                writer.write(cv2.cvtColor(scene.read(gray), cv2.COLOR_GRAY2BGR))
+            writer.release()
+        tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate)
+        source = VideoFrameSource(width, height, video, realtime=realtime).start()
+        instrumentation = Instrumentation()
+        processor = Experiment.ImageProcessor(
+            width, height, eye_tracker=tracker, frame_source=source, stabilization=stabilization,
+            calibration=np.eye(2), instrumentation=instrumentation, binocular=True).start()
+        start = time.perf_counter()
+        for _ in range(count):
+            processor.get_processed_image()
+        elapsed = time.perf_counter() - start
+        source.close()
+        gaze_sender.stop()
+    finally:
+        shutil.rmtree(directory)
+    stages = instrumentation.summary()['stages']
+    return {
+        'fps': count / elapsed,
+        'video_fps': source.fps,
+        'frames_decoded': source.frames_decoded,
+        'loops': source.loops,
+        'capture_ms': stages['capture'],
+        'process_ms': stages['process'],
+    }
+
+
+def bench_incremental(count=200, width=2880, height=1600, stabilization='mask', gaze_rate=120.0):
+    '''
+    Frame rate, capture and processing time with full and incremental updates,
+    for a static scene (where reads can be skipped and only the mask rectangles
+    rewritten) and for a scrolling one (every frame is a full update). Gaze comes
+    from a fake tracker.
+    '''
+    import fakes
+    fakes.install()
+    import Experiment
+    from frame_sources import SyntheticFrameSource
+
+    tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate)
+    results = {'stabilization': stabilization}
+    for scene, speed in (('static', 0), ('scrolling', 8)):
+        for incremental in (False, True):
+            instrumentation = Instrumentation()
+            processor = Experiment.ImageProcessor(
+                width, height, eye_tracker=tracker, frame_source=SyntheticFrameSource(width, height, speed),
+                stabilization=stabilization, calibration=np.eye(2), instrumentation=instrumentation,
+                binocular=True, incremental=incremental).start()
+            start = time.perf_counter()
+            for _ in range(count):
+                processor.get_processed_image()
+            elapsed = time.perf_counter() - start
+            stages = instrumentation.summary()['stages']
+            results['%s_%s' % (scene, 'incremental' if incremental else 'full')] = {
+                'fps': count / elapsed,
+                'capture_ms': stages['capture'],
+                'process_ms': stages['process'],
+                'updates': dict(processor.update_counts) if incremental else None,
+            }
+    gaze_sender.stop()
+    return results
+
+
+def bench_eye_events(count=300, width=2880, height=1600, stabilization='warp', gaze_rate=120.0):
+    '''
+    Warp map recomputations and processing time with and without gating by the
+    fixation/saccade classifier, for a gaze trace alternating fixations and
+    saccades; then the classifier's throughput on its own, fed in frame-sized
+    batches of a long trace, and its session statistics.
+    '''
+    import fakes
+    fakes.install()
+    import Experiment
+    from gaze import FakeGazeSender
+    from gaze_events import EyeMovementClassifier
+
+    tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate, pattern='saccades')
+    results = {'stabilization': stabilization}
+    for gated in (False, True):
+        instrumentation = Instrumentation()
+        processor = Experiment.ImageProcessor(
+            width, height, eye_tracker=tracker, frame_source=fakes.FakeSpoutFrameSource(width, height),
+            stabilization=stabilization, calibration=np.eye(2), instrumentation=instrumentation,
+            binocular=True, eye_events=EyeMovementClassifier() if gated else None).start()
+        start = time.perf_counter()
+        for _ in range(count):
+            processor.get_processed_image()
+        elapsed = time.perf_counter() - start
+        result = {
+            'fps': count / elapsed,
+            'process_ms': instrumentation.summary()['stages']['process'],
+        }
+        if stabilization == 'warp':
+            result['warp_map_computations'] = sum(engine.misses for engine in processor._warp_engines)
+        if gated:
+            result['events'] = processor.eye_events.statistics()
+        results['gated' if gated else 'ungated'] = result
+    gaze_sender.stop()
+
+    sender = FakeGazeSender(rate=gaze_rate, pattern='saccades')
+    times = np.arange(0, 600.0, 1.0 / gaze_rate)
+    trace = np.column_stack([times] + [np.array([sender.sample(t)[axis] for t in times]) for axis in (0, 1)])
+    classifier = EyeMovementClassifier()
+    batch = max(int(round(gaze_rate / 90.0)), 1)
+    start = time.perf_counter()
+    for i in range(0, len(trace), batch):
+        classifier.update(trace[i:i + batch])
+    elapsed = time.perf_counter() - start
+    results['classifier'] = {
+        'samples': len(trace),
+        'batch': batch,
+        'us_per_batch': elapsed / (len(trace) / batch) * 1e6,
+        'statistics': classifier.statistics(),
+    }
+    return results
+
+
+def _gaze_sender_process(port, rate, pattern, duration):
+    ''' Sender process for bench_gaze_service: stream fake gaze, reconnecting whenever the receiver restarts '''
+    from gaze import FakeGazeSender
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        sender = FakeGazeSender(port=port, rate=rate, pattern=pattern)
+        try:
+            sender.start(connect_timeout=1.0)
+        except OSError:
+            time.sleep(0.01)
+            continue
+        while sender.is_alive() and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        sender.stop()
+
+
+def bench_gaze_service(count=600, width=2880, height=1600, stabilization='mask', gaze_rate=1000.0,
+                       kill=True):
+    '''
+    Frame-loop jitter with gaze acquired on a thread of the experiment process
+    (Experiment.EyeTracker) and in a separate process (gaze_service.GazeService).
+    The fake tracker streams from its own process in both cases, at a high rate
+    so that receiving and parsing packets has a visible cost. With kill, the
+    acquisition process is killed halfway through the run and the loop keeps
+    going on the last published gaze until the service restarts it.
+    '''
+    import fakes
+    fakes.install()
+    import Experiment
+    from gaze_service import GazeService
+
+    ctx = multiprocessing.get_context('spawn')
+    results = {'stabilization': stabilization, 'gaze_rate': gaze_rate, 'cpus': os.cpu_count()}
+    for mode in ('thread', 'process'):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        if mode == 'thread':
+            tracker = Experiment.EyeTracker(port=port, pupil_path=None)
+        else:
+            tracker = GazeService(port=port, pupil_path=None, restart_delay=0.05)
+        sender = ctx.Process(target=_gaze_sender_process, args=(port, gaze_rate, 'circle', 600.0),
+                             daemon=True)
+        sender.start()
+        tracker.start()
+        processor = Experiment.ImageProcessor(
+            width, height, eye_tracker=tracker, frame_source=fakes.FakeSpoutFrameSource(width, height),
+            stabilization=stabilization, calibration=np.eye(2), binocular=True).start()
+
+        intervals = []
+        gaze_reads = []
+        last = time.perf_counter()
+        for i in range(count):
+            if kill and mode == 'process' and i == count // 2:
+                tracker._process.kill()
+            processor.get_processed_image()
+            now = time.perf_counter()
+            intervals.append(now - last)
+            last = now
+            tracker.get_gaze_pos()
+            gaze_reads.append(time.perf_counter() - now)
+
+        interval = summarize(intervals)
+        result = {
+            'fps': 1.0 / np.mean(intervals),
+            'frame_interval_ms': interval,
+            'jitter_ms': interval['p99'] - interval['p50'],
+            'gaze_read_us': summarize(gaze_reads, scale=1e6),
+        }
+        if mode == 'process':
+            result['restarts'] = tracker.restarts
+            result['read_retries'] = tracker._reader.retries
+        results[mode] = result
+        sender.terminate()
+        sender.join()
+        tracker.stop()
+    return results
+
+
+def _simulated_runtime(clock, process_ms, drop_late, count, seed=0):
+    ''' FrameRuntime over stages that only advance a SimulatedClock (for bench_runtime) '''
+    from runtime import FrameRuntime
+    rng = np.random.default_rng(seed)
+
+    def process(frame, degraded):
+        # degraded: e.g. warp maps from the cache, about a quarter of the cost
+        cost = rng.lognormal(np.log(process_ms * 1e-3), 0.3)
+        clock.advance(cost / 4 if degraded else cost)
+        return frame
+
+    runtime = FrameRuntime(gaze=lambda: clock.advance(0.0001), pose=lambda: clock.advance(0.0003),
+                           capture=lambda: clock.advance(0.002) or object(), process=process,
+                           display=lambda frame: clock.advance(0.0005), clock=clock, drop_late=drop_late)
+    return runtime.run(frames=count)
+
+
+def bench_runtime(count=900, width=2880, height=1600, stabilization='warp', gaze_rate=120.0):
+    '''
+    Deadline handling of runtime.FrameRuntime at 90 Hz. First in virtual time
+    (SimulatedClock), for processing costs below, near and above the frame budget,
+    with every frame processed (drop_late=False) and with late frames skipped,
+    degraded or dropped. Then for real with the fakes.py stand-ins: missed
+    deadlines of the runtime, against the frame intervals of the legacy
+    update()/send() loop.
+    '''
+    from runtime import SimulatedClock, experiment_runtime
+    results = {'simulated': {}}
+    for process_ms in (4.0, 8.0, 14.0):
+        results['simulated']['process_%gms' % process_ms] = dict(
+            ('drop_late' if drop_late else 'process_all',
+             _simulated_runtime(SimulatedClock(), process_ms, drop_late, count))
+            for drop_late in (False, True))
+
+    import fakes
+    fakes.install()
+    import Experiment
+    tracker, gaze_sender = fakes.start_fake_eye_tracker(gaze_rate)
+    receiver = PoseReceiver(port=0).start()
+    sender = Experiment.PositionSender(port=receiver.port).start()
+    processor = Experiment.ImageProcessor(
+        width, height, eye_tracker=tracker, frame_source=fakes.FakeSpoutFrameSource(width, height),
+        stabilization=stabilization, calibration=np.eye(2), binocular=True).start()
+    vr = Experiment.VRInterface(image_processor=processor, display=False).start()
+
+    intervals = []
+    last = time.perf_counter()
+    for _ in range(count):
+        vr.update()
+        sender.send(vr.get_head_rotation(), vr.get_head_position())
+        now = time.perf_counter()
+        intervals.append(now - last)
+        last = now
+    intervals = np.asarray(intervals)
+    results['legacy_loop'] = {
+        'fps': len(intervals) / intervals.sum(),
+        'frame_interval_ms': summarize(intervals),
+        'over_budget': int((intervals > 1.0 / 90).sum()),
+    }
+    for drop_late in (False, True):
+        runtime = experiment_runtime(vr, sender, stop_key=None, drop_late=drop_late)
+        start = time.perf_counter()
+        summary = runtime.run(frames=count)
+        summary['fps'] = summary['displayed'] / (time.perf_counter() - start)
+        results['runtime_drop_late' if drop_late else 'runtime_process_all'] = summary
+
+    sender._del()
+    receiver.stop()
+    gaze_sender.stop()
+    return results
+
+
+def bench_calibration(count=200, width=2880, height=1600):
+    '''
+    Cost of showing a calibration target: a new float64 (height, width, 3) image
+    per target, as the original calibrate() drew them, against redrawing the
+    preallocated uint8 calibration.CalibrationTargets. Then the cost of one
+    recursive least squares update and of mapping a gaze sample, per model, and
+    the fit error on noisy synthetic fixations.
+    '''
+    from calibration import FIVE_POINTS, NINE_POINTS, Calibration, CalibrationTargets
+
+    points = NINE_POINTS
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(min(count, 20)):
+        x, y = points[i % len(points)]
+        img = np.ones((height, width, 3))
+        cx, cy = int(x * (width - 25)), int((1 - y) * (height - 25))
+        img[cy:cy + 25, cx:cx + 25, 1:2] = 0
+    legacy_s = (time.perf_counter() - start) / min(count, 20)
+    legacy_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del img
+
+    tracemalloc.start()
+    targets = CalibrationTargets(width, height)
+    start = time.perf_counter()
+    for i in range(count):
+        targets.show(points[i % len(points)])
+    targets_s = (time.perf_counter() - start) / count
+    targets_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results = {
+        'targets': {
+            'float64_per_target_ms': legacy_s * 1e3, 'float64_peak_mb': legacy_peak / 1e6,
+            'uint8_preallocated_ms': targets_s * 1e3, 'uint8_peak_mb': targets_peak / 1e6,
+        },
+    }
+
+    rng = np.random.default_rng(0)
+    screen = np.array(FIVE_POINTS * 2 + NINE_POINTS * 2, dtype=np.float64)
+    # a slightly rotated, offset and curved tracker space, with fixation noise
+    gazes = np.column_stack((0.05 + 0.9 * screen[:, 0] + 0.05 * screen[:, 1] ** 2,
+                             -0.03 + 0.1 * screen[:, 0] + 0.95 * screen[:, 1]))
+    gazes += rng.normal(0, 0.003, gazes.shape)
+    for model in ('affine', 'poly2'):
+        calibration = Calibration(model)
+        start = time.perf_counter()
+        for gaze, target in zip(gazes, screen):
+            calibration.update(gaze, target)
+        update_s = (time.perf_counter() - start) / len(gazes)
+        start = time.perf_counter()
+        for i in range(count):
+            calibration.map(gazes[i % len(gazes)])
+        map_s = (time.perf_counter() - start) / count
+        results[model] = {
+            'update_us': update_s * 1e6,
+            'map_us': map_s * 1e6,
+            'mean_error': float(calibration.errors(gazes, screen).mean()),
+        }
+    return results
+
+
+def _gaze_packet_sender(port, packet_format, count, rate):
+    ''' Sender process for bench_gaze_packets: count packets, one send() each, at rate (None: flat out) '''
+    from gaze import GAZE_MAGIC, GAZE_PACKET_FORMATS, GAZE_PROTOCOL_VERSION, FakeGazeSender
+    sender = FakeGazeSender()
+    packets = np.zeros(count, dtype=GAZE_PACKET_FORMATS[packet_format])
+    for i in range(count):
+        t = i / 1000.0
+        if packet_format == 'binocular':
+            sender.binocular_sample(t, packets[i])
+        else:
+            packets[i]['x'], packets[i]['y'] = sender.sample(t)
+    if packet_format == 'binocular':
+        packets['magic'] = GAZE_MAGIC
+        packets['version'] = GAZE_PROTOCOL_VERSION
+        packets['sequence'] = np.arange(1, count + 1)
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    next_send = time.perf_counter()
+    for i in range(count):
+        if packet_format == 'binocular':
+            packets[i]['pupil_timestamp'] = time.perf_counter()
+        sock.sendall(packets[i:i + 1].tobytes())
+        if rate:
+            next_send += 1.0 / rate
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    sock.close()
+
+
+def _recv8_loop(conn, buffer):
+    ''' The original gaze read: one recv(8) syscall and one buffer push per legacy sample '''
+    from gaze import GAZE_PACKET_DTYPE
+    pending = b''
+    while True:
+        data = conn.recv(8 - len(pending))
+        if not data:
+            return
+        pending += data
+        if len(pending) < 8:
+            continue
+        packet = np.frombuffer(pending, dtype=GAZE_PACKET_DTYPE)
+        buffer.push(time.perf_counter(), packet['x'], packet['y'])
+        pending = b''
+
+
+def bench_gaze_packets(count=20000, gaze_rate=2000.0):
+    '''
+    Gaze intake throughput and CPU cost per sample: the original one recv(8) per
+    legacy sample, against GazeReceiver draining all pending packets per
+    recv_into() for the legacy and the binocular packet format. A sender process
+    sends count packets, one send() each, as fast as it can and then paced at
+    gaze_rate. CPU time is that of this (receiving) process.
+    '''
+    from gaze import GAZE_PACKET_FORMATS, GazeBuffer, GazeReceiver
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for pacing, rate in (('flat_out', None), ('paced', gaze_rate)):
+        n = count if rate is None else min(count, int(gaze_rate * 5))
+        for path, packet_format in (('recv8', 'legacy'), ('batched_legacy', 'legacy'),
+                                    ('batched_binocular', 'binocular')):
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            sender = ctx.Process(target=_gaze_packet_sender,
+                                 args=(server.getsockname()[1], packet_format, n, rate))
+            sender.start()
+            conn, _ = server.accept()
+            server.close()
+            buffer = GazeBuffer(4096)
+            cpu = time.process_time()
+            start = time.perf_counter()
+            if path == 'recv8':
+                _recv8_loop(conn, buffer)
+                received, recv_calls = buffer.count, buffer.count
+            else:
+                receiver = GazeReceiver(conn, buffer, packet_dtype=GAZE_PACKET_FORMATS[packet_format])
+                receiver.run()
+                # blinks are only kept as binocular records, so count packets
+                received, recv_calls = receiver.packets_received, receiver.recv_calls
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+            conn.close()
+            sender.join()
+            results['%s.%s' % (pacing, path)] = {
+                'samples': received,
+                'samples_per_s': received / elapsed,
+                'cpu_us_per_sample': cpu / n * 1e6,
+                'recv_calls_per_sample': recv_calls / n,
+            }
+    return results
+
+
+
+def _record_synthetic_session(path, count, width, height, gaze_rate, frame_rate=90.0):
+    '''
+    Record count synthetic frames with gaze circling the screen at gaze_rate Hz
+    (frames at frame_rate Hz, each with the latest gaze sample) into a new
+    recording at path, without dropping any.
+    '''
+    from frame_sources import Frame, SyntheticFrameSource
+    from recording import SessionRecorder
+    recorder = SessionRecorder(path, width, height, record_frames=True).start()
+    t = np.arange(int(count / frame_rate * gaze_rate) + 1) / gaze_rate
+    angle = 2 * np.pi * 0.5 * t
+    samples = np.column_stack([t, 0.5 + 0.3 * np.cos(angle), 0.5 + 0.3 * np.sin(angle)])
+    recorder.record_gaze(samples)
+    source = SyntheticFrameSource(width, height)
+    data = np.empty((height, width), dtype=np.uint8)
+    for i in range(count):
+        timestamp = i / frame_rate
+        latest = samples[np.searchsorted(samples[:, 0], timestamp, side='right') - 1]
+        frame = Frame(source.read(data), i + 1, timestamp, (latest[1], latest[2]))
+        while not recorder.record_frame(frame):
+            time.sleep(0.001)
+    recorder.stop()
+
+
+def bench_offline(count=240, width=2880, height=1600, stabilization='warp', gaze_rate=120.0,
+                  workers=None, chunk_size=16):
+    '''
+    Regenerate a synthetic recording of count frames under another stabilization:
+    once by replaying it through an ImageProcessor frame by frame, then with an
+    offline.OfflineStabilizer in this process (workers=0), with one worker process
+    and with workers processes (one per core by default). Reports frames per
+    second of each and whether the offline output matches the replay exactly.
+    '''
+    import fakes
+    fakes.install()
+    import Experiment
+    from offline import OfflineStabilizer
+    from recording import ReplaySession, SessionReader
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    directory = tempfile.mkdtemp(prefix='vr_offline_')
+    source = os.path.join(directory, 'session')
+    try:
+        _record_synthetic_session(source, count, width, height, gaze_rate)
+        replay = ReplaySession(source)
+        processor = Experiment.ImageProcessor(
+            width, height, eye_tracker=replay.eye_tracker, frame_source=replay.frame_source,
+            clock=replay.clock, calibration=np.eye(2), stabilization=stabilization, workers=0).start()
+        checksums = []
+        t0 = time.perf_counter()
+        for _ in range(count):
+            checksums.append(zlib.crc32(processor.get_processed_image()))
+        results = {'cores': os.cpu_count(), 'replay_fps': count / (time.perf_counter() - t0)}
+        replay.reader.close()
+
+        runs = [('in_process', 0), ('workers_1', 1)] + ([('workers_%d' % workers, workers)] if workers > 1 else [])
+        for name, n in runs:
+            destination = os.path.join(directory, name)
+            # with the replay's gaze and calibration, so the outputs can be compared
+            stats = OfflineStabilizer(np.eye(2), stabilization, gaze='samples', chunk_size=chunk_size,
+                                      workers=n).run(source, destination)
+            output = SessionReader(destination)
+            results[name] = {
+                'fps': stats['fps'],
+                'speedup': stats['fps'] / results['replay_fps'],
+                'matches_replay': [zlib.crc32(output.frame(i)) for i in range(count)] == checksums,
+            }
+            output.close()
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+_IMPORT_PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+import numpy
+t1 = time.perf_counter()
+import Experiment
+t2 = time.perf_counter()
+heavy = ('cv2', 'openvr', 'OpenGL', 'pygame', 'SpoutSDK', 'keyboard', 'psutil')
+print(json.dumps({'numpy_s': t1 - t0, 'experiment_s': t2 - t1,
+                  'loaded': [name for name in heavy if name in sys.modules]}))
+'''
+
+
+def bench_startup(count=5, width=2880, height=1600):
+    '''
+    Time importing Experiment (in count fresh interpreters, excluding numpy)
+    and list the heavy backends the import pulled in; then, with the fakes.py
+    stand-ins, time constructing and starting each class. Construction should
+    be close to free, since all connecting and launching happens in start().
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    imports = []
+    for _ in range(count):
+        probe = subprocess.run([sys.executable, '-c', _IMPORT_PROBE], cwd=here,
+                               capture_output=True, text=True, check=True)
+        imports.append(json.loads(probe.stdout.strip().splitlines()[-1]))
+    results = {
+        'import_numpy_ms': summarize([probe['numpy_s'] for probe in imports]),
+        'import_experiment_ms': summarize([probe['experiment_s'] for probe in imports]),
+        'loaded_on_import': imports[-1]['loaded'],
+    }
+
+    import fakes
+    fakes.install()
+    import Experiment
+    timings = {}
+
+    def timed(name, create):
+        start = time.perf_counter()
+        obj = create()
+        timings[name] = (time.perf_counter() - start) * 1e3
+        return obj
+
+    receiver = PoseReceiver(port=0).start()
+    sender = timed('PositionSender()', lambda: Experiment.PositionSender(port=receiver.port))
+    timed('PositionSender.start()', sender.start)
+    tracker, gaze_sender = timed('EyeTracker.start() (fake gaze)', fakes.start_fake_eye_tracker)
+    processor = timed('ImageProcessor()', lambda: Experiment.ImageProcessor(
+        width, height, eye_tracker=tracker, frame_source=fakes.FakeSpoutFrameSource(width, height),
+        calibration=np.eye(2)))
+    timed('ImageProcessor.start()', processor.start)
+    vr = timed('VRInterface()', lambda: Experiment.VRInterface(image_processor=processor,
+                                                               display=False))
+    timed('VRInterface.start()', vr.start)
+    results['init_ms'] = timings
+
+    sender._del()
+    receiver.stop()
+    gaze_sender.stop()
+    return results
+
+
+BENCHMARKS = {
+    'experiment': bench_experiment,
+    'recording': bench_recording,
+    'startup': bench_startup,
+    'tiles': bench_tiles,
+    'foveation': bench_foveation,
+    'gpu_stabilization': bench_gpu_stabilization,
+    'display_frames': bench_display_frames,
+    'video': bench_video,
+    'incremental': bench_incremental,
+    'eye_events': bench_eye_events,
+    'gaze_service': bench_gaze_service,
+    'runtime': bench_runtime,
+    'calibration': bench_calibration,
+    'gaze_packets': bench_gaze_packets,
+    'offline': bench_offline,
+    'pose_tcp': bench_pose_tcp,
+    'pose_transports': bench_pose_transports,
+}
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+def flatten(results, prefix=''):
+    ''' Flatten nested result dicts into {'a.b.c': number} for comparison '''
+    flat = {}
+    for key, value in results.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, results):
+    '''
+    Compare two result dicts of the same benchmark. Returns {key: (baseline,
+    current, relative change)} for every numeric result present in both.
+    '''
+    old, new = flatten(baseline), flatten(results)
+    return dict((key, (old[key], new[key], (new[key] - old[key]) / old[key] if old[key] else float('nan')))
+                for key in sorted(old) if key in new)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--count', type=int, help="number of packets/frames")
+    parser.add_argument('--devices', type=int, help="tracked devices per pose packet")
+    parser.add_argument('--width', type=int, help="frame width in pixels")
+    parser.add_argument('--height', type=int, help="frame height in pixels")
+    parser.add_argument('--stabilization', choices=('mask', 'warp'), help="ImageProcessor mode")
+    parser.add_argument('--compression', choices=('zlib',), help="frame compression for recordings")
+    parser.add_argument('--roi-size', type=int, help="side of the full resolution region in foveated mode")
+    parser.add_argument('--periphery-scale', type=int, help="periphery downsampling factor in foveated mode")
+    parser.add_argument('--platform', choices=('egl', 'osmesa'), help="headless OpenGL platform")
+    parser.add_argument('--video', help="video file to play instead of a synthetic clip")
+    parser.add_argument('--realtime', action='store_true', default=None,
+                        help="pace replayed frames to their frame rate")
+    parser.add_argument('--pipelined', action='store_true', default=None,
+                        help="run VRInterface in pipelined mode")
+    parser.add_argument('--workers', type=int, help="worker processes for offline stabilization")
+    parser.add_argument('--chunk-size', type=int, help="frames per offline stabilization task")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the baseline for this benchmark")
+    parser.add_argument('--compare', action='store_true',
+                        help="compare the results against the stored baseline")
+    args = parser.parse_args()
+
+    bench = BENCHMARKS[args.benchmark]
+    accepted = inspect.signature(bench).parameters
+    kwargs = {key: value for key, value in vars(args).items()
+              if key in accepted and value is not None}
+    results = bench(**kwargs)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    baseline_path = os.path.join(BASELINE_DIR, args.benchmark + '.json')
+    if args.compare:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        print("%-50s %14s %14s %9s" % ('result', 'baseline', 'current', 'change'))
+        for key, (old, new, change) in compare(baseline, results).items():
+            print("%-50s %14.4g %14.4g %+8.1f%%" % (key, old, new, 100 * change))
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+'''
+Gaze calibration: the mapping from the eye tracker's normalized gaze position
+to normalized screen coordinates, (0,0) at the bottom left and (1,1) at the
+top right of an eye's viewport.
+
+Calibration fits an affine or second-order polynomial model by recursive least
+squares (RLS). Every fixation on a known target is one update of the weights
+and their inverse covariance, so the calibration procedure does not need to
+collect all points before fitting. Validation fixations taken later in a
+session refine the same model, and with a forgetting factor below 1 recent
+fixations count more than old ones. A drift check (a single fixation at a
+known point) only shifts the offset.
+
+CalibrationStore keeps fitted calibrations as JSON files per subject and
+headset, so a session can reuse the last calibration instead of running the
+full procedure again. CalibrationTargets draws the targets into one
+preallocated uint8 image.
+'''
+
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+# number of features (weights per output coordinate) of each model
+MODELS = {'affine': 3, 'poly2': 6}
+# index of the constant feature, which carries the offset
+_OFFSET = 2
+
+# targets in normalized screen coordinates: center and corners, and a 3x3 grid
+FIVE_POINTS = ((.5, .5), (0, 0), (1, 0), (0, 1), (1, 1))
+NINE_POINTS = tuple((x, y) for y in (.5, 0, 1) for x in (.5, 0, 1))
+
+
+def calibration_features(gaze, model):
+    '''
+    Features of gaze positions for a model: (x, y, 1) for 'affine', plus (x^2, xy,
+    y^2) for 'poly2'. gaze is an (x, y) pair or an (n, 2) array.
+    '''
+    gaze = np.asarray(gaze, dtype=np.float64)
+    x, y = gaze[..., 0], gaze[..., 1]
+    columns = [x, y, np.ones_like(x)]
+    if model == 'poly2':
+        columns += [x * x, x * y, y * y]
+    return np.stack(columns, axis=-1)
+
+
+class Calibration(object):
+    '''
+    Gaze-to-screen mapping, screen = features(gaze) @ weights, fitted by
+    recursive least squares. Starts from the identity mapping.
+    '''
+
+    def __init__(self, model='affine', forgetting=1.0, prior_variance=1e4):
+        '''
+        model: 'affine' (offset, scale, rotation and shear) or 'poly2' (adds the
+            quadratic terms, for the distortion of the headset lenses; needs at
+            least six well spread targets, e.g. NINE_POINTS)
+        forgetting: RLS forgetting factor in (0, 1]; below 1, the weight of a
+            fixation decays by this factor with every later one
+        prior_variance: variance of the initial identity weights; small values
+            keep a model with few fixations close to the identity
+        '''
+        if model not in MODELS:
+            raise ValueError("Unknown calibration model: %s" % model)
+        if not 0.0 < forgetting <= 1.0:
+            raise ValueError("forgetting must be in (0, 1]: %s" % forgetting)
+        self._model = model
+        self._forgetting = float(forgetting)
+        self._prior_variance = float(prior_variance)
+        self.reset()
+
+    def reset(self):
+        n = MODELS[self._model]
+        self.weights = np.zeros((n, 2))
+        self.weights[0, 0] = self.weights[1, 1] = 1.0
+        self._covariance = np.eye(n) * self._prior_variance
+        self.samples = 0
+        self.updated = None
+
+    @classmethod
+    def from_matrix(cls, transform):
+        '''
+        An affine calibration equivalent to a bare 2x2 eye_to_screen_transform, as
+        fitted by the original calibrate() (screen = transform.T @ gaze, no offset).
+        '''
+        calibration = cls('affine')
+        calibration.weights[:2] = np.asarray(transform, dtype=np.float64)
+        calibration.weights[_OFFSET] = 0.0
+        return calibration
+
+    @property
+    def model(self):
+        return self._model
+
+    def copy(self):
+        return Calibration.from_dict(self.to_dict())
+
+    def map(self, gaze):
+        ''' Screen position(s) of an (x, y) gaze position or an (n, 2) array of them '''
+        return calibration_features(gaze, self._model) @ self.weights
+
+    def update(self, gaze, target):
+        '''
+        Refine the weights with one or more fixations: gaze positions and the
+        screen positions of the targets fixated, as (x, y) pairs or (n, 2) arrays.
+        '''
+        features = np.atleast_2d(calibration_features(gaze, self._model))
+        targets = np.atleast_2d(np.asarray(target, dtype=np.float64))
+        weights, covariance, forgetting = self.weights, self._covariance, self._forgetting
+        for phi, t in zip(features, targets):
+            p_phi = covariance @ phi
+            gain = p_phi / (forgetting + phi @ p_phi)
+            weights += np.outer(gain, t - phi @ weights)
+            covariance -= np.outer(gain, p_phi)
+            covariance /= forgetting
+        self.samples += len(features)
+        self.updated = time.time()
+
+    def fit(self, gazes, targets):
+        ''' Fit from scratch to a set of fixations '''
+        self.reset()
+        self.update(gazes, targets)
+        return self
+
+    def correct_drift(self, gaze, target, gain=1.0):
+        '''
+        Shift the mapping so that gaze maps closer to target (all the way with
+        gain 1), e.g. after a drift check fixation on a known point. Only the
+        offset changes. Returns the error before the correction.
+        '''
+        error = np.asarray(target, dtype=np.float64) - self.map(gaze)
+        self.weights[_OFFSET] += gain * error
+        self.updated = time.time()
+        return error
+
+    def errors(self, gazes, targets):
+        ''' Distances (normalized screen units) between the mapped gazes and their targets '''
+        residuals = self.map(gazes) - np.asarray(targets, dtype=np.float64)
+        return np.hypot(residuals[..., 0], residuals[..., 1])
+
+    def to_dict(self):
+        return {
+            'model': self._model,
+            'forgetting': self._forgetting,
+            'prior_variance': self._prior_variance,
+            'weights': self.weights.tolist(),
+            'covariance': self._covariance.tolist(),
+            'samples': self.samples,
+            'updated': self.updated,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        calibration = cls(data['model'], data['forgetting'], data['prior_variance'])
+        calibration.weights[:] = data['weights']
+        calibration._covariance[:] = data['covariance']
+        calibration.samples = data['samples']
+        calibration.updated = data['updated']
+        return calibration
+
+
+def per_eye_calibrations(calibration, eyes):
+    '''
+    One Calibration per eye from a Calibration, a list of them, or a legacy 2x2
+    (or per-eye (2, 2, 2)) eye_to_screen_transform.
+    '''
+    if isinstance(calibration, Calibration):
+        calibration = [calibration]
+    elif not isinstance(calibration, (list, tuple)):
+        transform = np.asarray(calibration, dtype=np.float64)
+        calibration = [Calibration.from_matrix(t) for t in transform.reshape(-1, 2, 2)]
+    if len(calibration) == 1:
+        # one calibration for both eyes until they are calibrated separately
+        return [calibration[0].copy() for _ in range(eyes)] if eyes > 1 else list(calibration)
+    return list(calibration)
+
+
+class CalibrationStore(object):
+    '''
+    Calibrations saved as <directory>/<subject>__<headset>.json, one Calibration
+    per eye.
+    '''
+
+    def __init__(self, directory='calibrations'):
+        self._directory = directory
+
+    def path(self, subject, headset):
+        name = '__'.join(re.sub(r'[^\w.-]', '_', str(part)) for part in (subject, headset))
+        return os.path.join(self._directory, name + '.json')
+
+    def load(self, subject, headset):
+        ''' The list of per-eye Calibrations saved for subject and headset, or None '''
+        path = self.path(subject, headset)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return [Calibration.from_dict(eye) for eye in data['eyes']]
+
+    def save(self, subject, headset, calibrations):
+        os.makedirs(self._directory, exist_ok=True)
+        data = {
+            'subject': subject,
+            'headset': headset,
+            'saved': time.time(),
+            'eyes': [calibration.to_dict() for calibration in calibrations],
+        }
+        # write next to the target and rename, so an interrupted save keeps the old file
+        path = self.path(subject, headset)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+
+class CalibrationTargets(object):
+    '''
+    A preallocated (height, width, 3) uint8 BGR image showing one target at a
+    time. The image is split into eyes side-by-side viewports (one per eye of a
+    binocular frame), and the target is drawn at the same normalized point in
+    each. show() only redraws the previous and the new squares.
+    '''
+
+    def __init__(self, width, height, size=25, background=255, color=(255, 0, 255), eyes=1):
+        self._width = width
+        self._height = height
+        self._eyes = eyes
+        self._eye_width = width // eyes
+        self._size = size
+        self._background = background
+        self._color = np.array(color, dtype=np.uint8)
+        self.image = np.full((height, width, 3), background, dtype=np.uint8)
+        self._rects = []
+
+    def rect(self, point, eye=0):
+        '''
+        Pixel rows and columns (slices) of the target square at a normalized screen
+        point of an eye's viewport, (0,0) at its bottom left; squares at the edges
+        are kept inside the viewport.
+        '''
+        size = self._size
+        x = int(round(point[0] * self._eye_width)) - size // 2
+        y = int(round((1 - point[1]) * self._height)) - size // 2
+        x = min(max(x, 0), self._eye_width - size) + eye * self._eye_width
+        y = min(max(y, 0), self._height - size)
+        return slice(y, y + size), slice(x, x + size)
+
+    def show(self, point):
+        ''' Draw the target at point (erasing the previous one) and return the image '''
+        for rect in self._rects:
+            self.image[rect] = self._background
+        self._rects = [self.rect(point, eye) for eye in range(self._eyes)]
+        for rect in self._rects:
+            self.image[rect] = self._color
+        return self.image
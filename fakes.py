@@ -0,0 +1,217 @@
+'''
+Pure-Python stand-ins for the experiment's hardware: the OpenVR runtime, the
+Spout receiver and the Pupil Capture gaze stream. They let Experiment.py run
+headless, e.g. for benchmark.py, on a machine without a Vive, Windows or Unity.
+
+install() registers fake openvr and SpoutSDK modules in sys.modules; it has to
+be called before Experiment is imported.
+'''
+
+import ctypes
+import socket
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+
+from frame_sources import FrameSource, SyntheticFrameSource, crop_regions
+from gaze import FakeGazeSender
+from pose import pose_array_view
+
+MAX_TRACKED_DEVICES = 64
+
+
+class HmdMatrix34_t(ctypes.Structure):
+    _fields_ = [('m', (ctypes.c_float * 4) * 3)]
+
+
+class HmdVector3_t(ctypes.Structure):
+    _fields_ = [('v', ctypes.c_float * 3)]
+
+
+class TrackedDevicePose_t(ctypes.Structure):
+    ''' Same layout as openvr.TrackedDevicePose_t '''
+    _fields_ = [
+        ('mDeviceToAbsoluteTracking', HmdMatrix34_t),
+        ('vVelocity', HmdVector3_t),
+        ('vAngularVelocity', HmdVector3_t),
+        ('eTrackingResult', ctypes.c_int),
+        ('bPoseIsValid', ctypes.c_bool),
+        ('bDeviceIsConnected', ctypes.c_bool),
+    ]
+
+
+class FakeIVRSystem(object):
+    '''
+    Stand-in for openvr.IVRSystem. Reports a valid HMD pose whose head turns
+    from side to side (yaw amplitude in radians at frequency Hz) and sways
+    slightly; all other devices are disconnected.
+    '''
+
+    def __init__(self, amplitude=0.3, frequency=0.5):
+        self._amplitude = amplitude
+        self._frequency = frequency
+        self._t0 = time.perf_counter()
+        self.calls = 0
+
+    def hmd_matrix(self, t):
+        ''' Device-to-absolute 3x4 matrix of the HMD at time t (seconds since creation) '''
+        phase = 2 * np.pi * self._frequency * t
+        yaw = self._amplitude * np.sin(phase)
+        c, s = np.cos(yaw), np.sin(yaw)
+        return np.array([[c, 0.0, s, 0.05 * np.sin(phase)],
+                         [0.0, 1.0, 0.0, 1.7],
+                         [-s, 0.0, c, 0.02 * np.cos(phase)]], dtype=np.float32)
+
+    def getDeviceToAbsoluteTrackingPose(self, origin, seconds_to_photons, poses=None):
+        if poses is None:
+            poses = (TrackedDevicePose_t * MAX_TRACKED_DEVICES)()
+        t = time.perf_counter() - self._t0 + seconds_to_photons
+        view = pose_array_view(poses)
+        view['matrix'][0] = self.hmd_matrix(t)
+        view['valid'][0] = True
+        poses[0].bDeviceIsConnected = True
+        self.calls += 1
+        return poses
+
+
+class FakeSpoutReceiver(object):
+    '''
+    Stand-in for SpoutSDK.SpoutReceiver. Instead of sharing a GL texture with
+    Unity, pyReceiveTexture renders a scrolling test pattern into a luminance
+    array (the "texture") of the receiver's size.
+    '''
+
+    def __init__(self):
+        self.texture = None
+        self._scene = None
+        self.frames_received = 0
+
+    def pyCreateReceiver(self, name, width, height, use_active):
+        self._scene = SyntheticFrameSource(width, height)
+        self.texture = np.zeros((height, width), dtype=np.uint8)
+        return True
+
+    def pyReceiveTexture(self, name, width, height, texture_id, texture_target, invert, host_fbo):
+        self._scene.read(self.texture)
+        self.frames_received += 1
+        return True
+
+    def ReleaseReceiver(self):
+        self.texture = None
+
+
+class FakeSpoutFrameSource(FrameSource):
+    '''
+    Headless counterpart of frame_sources.SpoutFrameSource: drives a
+    SpoutReceiver the same way but reads its texture back with a plain copy
+    instead of glGetTexImage, so it costs the same two full-frame copies.
+    '''
+
+    def __init__(self, width, height, name="UnitySender", receiver=None):
+        super(FakeSpoutFrameSource, self).__init__(width, height)
+        self._spout_name = name
+        self._spout_receiver = receiver if receiver is not None else FakeSpoutReceiver()
+        self._spout_receiver.pyCreateReceiver(name, width, height, False)
+
+    def _read_into(self, out):
+        self._spout_receiver.pyReceiveTexture(self._spout_name, self._width, self._height,
+                                              0, 0, False, 0)
+        np.copyto(out, self._spout_receiver.texture)
+        return out.nbytes
+
+    def _read_foveated_into(self, periphery, rois, origins):
+        '''
+        Mirrors SpoutFrameSource: the regions are copied out of the texture and
+        the periphery is area-downsampled from it, standing in for the mipmap
+        level the GPU would generate. Only those bytes count as read back.
+        '''
+        import cv2
+        self._spout_receiver.pyReceiveTexture(self._spout_name, self._width, self._height,
+                                              0, 0, False, 0)
+        texture = self._spout_receiver.texture
+        crop_regions(texture, rois, origins)
+        cv2.resize(texture, (periphery.shape[1], periphery.shape[0]), dst=periphery,
+                   interpolation=cv2.INTER_AREA)
+        return periphery.nbytes + rois.nbytes
+
+    def close(self):
+        self._spout_receiver.ReleaseReceiver()
+
+
+def make_openvr_module(system=None):
+    ''' Build a module object exposing the parts of pyopenvr that Experiment.py uses '''
+    system = system if system is not None else FakeIVRSystem()
+    module = types.ModuleType('openvr')
+    module.__dict__.update({
+        'VRApplication_Scene': 1,
+        'TrackingUniverseSeated': 0,
+        'TrackingUniverseStanding': 1,
+        'k_unMaxTrackedDeviceCount': MAX_TRACKED_DEVICES,
+        'k_unTrackedDeviceIndex_Hmd': 0,
+        'HmdMatrix34_t': HmdMatrix34_t,
+        'HmdVector3_t': HmdVector3_t,
+        'TrackedDevicePose_t': TrackedDevicePose_t,
+        'init': lambda application_type: system,
+        'shutdown': lambda: None,
+        'IVRSystem': lambda: system,
+        'fake_system': system,
+    })
+    return module
+
+
+def make_spout_module():
+    module = types.ModuleType('SpoutSDK')
+    module.SpoutReceiver = FakeSpoutReceiver
+    return module
+
+
+def install(system=None):
+    '''
+    Register the fake openvr and SpoutSDK modules in sys.modules, replacing the
+    real ones for the rest of the process. Returns the FakeIVRSystem in use.
+    '''
+    openvr = make_openvr_module(system)
+    sys.modules['openvr'] = openvr
+    sys.modules['SpoutSDK'] = make_spout_module()
+    return openvr.fake_system
+
+
+def start_fake_eye_tracker(rate=120.0, host='127.0.0.1', port=None, pattern='circle', service=False,
+                           packet_format='legacy', **kwargs):
+    '''
+    Create an Experiment.EyeTracker (or with service=True, a
+    gaze_service.GazeService) fed by a gaze.FakeGazeSender (tracing the given
+    pattern, in the given packet format) instead of Pupil Capture. Returns
+    (eye_tracker, sender); stop the sender when done. Extra keyword arguments
+    are passed to the tracker.
+    '''
+    if service:
+        from gaze_service import GazeService as EyeTracker
+    else:
+        from Experiment import EyeTracker
+    if port is None:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind((host, 0))
+        port = probe.getsockname()[1]
+        probe.close()
+    sender = FakeGazeSender(host, port, rate, pattern, packet_format)
+
+    def connect():
+        # EyeTracker only starts listening inside start(), GazeService once its process is up
+        deadline = time.perf_counter() + 10.0
+        while time.perf_counter() < deadline:
+            try:
+                sender.start()
+                return
+            except OSError:
+                time.sleep(0.01)
+
+    connector = threading.Thread(target=connect, name='FakeGazeConnect', daemon=True)
+    connector.start()
+    kwargs.setdefault('sample_rate', rate)
+    tracker = EyeTracker(host, port, pupil_path=None, packet_format=packet_format, **kwargs).start()
+    connector.join()
+    return tracker, sender
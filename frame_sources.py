@@ -0,0 +1,700 @@
+'''
+Frame capture layer for the ImageProcessor.
+
+Frames are read into a small pool of preallocated, C-contiguous uint8 buffers
+of shape (height, width), i.e. the native row-major layout returned by the
+OpenGL readback. The same buffer travels from capture through processing to
+cv2.imshow without being reallocated, transposed or copied.
+
+Frame sources share one interface (read(out) fills a pool buffer), so the
+Spout/OpenGL receiver can be swapped for a synthetic or file-backed source in
+tests and benchmarks. For foveated processing, read_foveated() reads a
+downsampled periphery plus full resolution regions instead of the whole frame.
+
+DisplayFramePrefetcher serves the other direction, decoding image or video
+files ahead of time into display-ready RGBA frames for testbed.Displayer.
+'''
+
+import ctypes
+import math
+import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+import numpy as np
+
+
+class FramePool(object):
+    '''
+    Fixed set of preallocated frame buffers handed out with acquire() and returned
+    with release(). All buffers are C-contiguous arrays of the given shape/dtype.
+    '''
+
+    def __init__(self, shape, dtype=np.uint8, count=3):
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self._buffers = [np.zeros(self._shape, dtype=self._dtype) for _ in range(count)]
+        self._free = deque(self._buffers)
+        self._cond = threading.Condition()
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def nbytes(self):
+        ''' Size of a single frame buffer in bytes '''
+        return self._buffers[0].nbytes
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def available(self):
+        with self._cond:
+            return len(self._free)
+
+    def acquire(self, block=True, timeout=None, prefer=None):
+        '''
+        Take a free buffer from the pool. If none is free, wait up to timeout seconds
+        (forever if None) when block is True; otherwise return None immediately.
+        prefer: predicate on buffers; the first free buffer it accepts is taken
+            instead of the longest free one, e.g. one already holding a wanted result
+        '''
+        with self._cond:
+            if not self._free:
+                if not block or not self._cond.wait_for(lambda: self._free, timeout):
+                    return None
+            if prefer is not None:
+                for i, buf in enumerate(self._free):
+                    if prefer(buf):
+                        del self._free[i]
+                        return buf
+            return self._free.popleft()
+
+    def release(self, buf):
+        ''' Return a buffer obtained from acquire() to the pool '''
+        with self._cond:
+            self._free.append(buf)
+            self._cond.notify()
+
+
+class Frame(object):
+    '''
+    A captured frame travelling through the processing stages: the pooled pixel
+    buffer plus the metadata needed to process it. Foveated frames hold the
+    downsampled periphery in data and the full resolution regions in roi.
+    '''
+
+    __slots__ = ('data', 'index', 'timestamp', 'gaze', 'roi', 'roi_placements', 'signature')
+
+    def __init__(self, data, index=0, timestamp=0.0, gaze=None, roi=None, roi_placements=None,
+                 signature=None):
+        self.data = data
+        self.index = index
+        self.timestamp = timestamp
+        self.gaze = gaze
+        self.roi = roi
+        self.roi_placements = roi_placements
+        self.signature = signature
+
+
+class FrameSource(object):
+    '''
+    Base class for frame sources. Subclasses implement _read_into(out), which must
+    fill the preallocated (height, width) uint8 array in place and return the
+    number of bytes it copied.
+    Sources that know when their content repeats also implement _sequence_of(n),
+    the content version of the n-th frame read: equal versions mean identical
+    frames. Otherwise callers have to compare frames by frame_checksum().
+    '''
+
+    def __init__(self, width, height):
+        self._width = width
+        self._height = height
+        self.frames_read = 0
+        self.last_bytes_copied = 0
+        self.total_bytes_copied = 0
+        self._scratch = None
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def shape(self):
+        return (self._height, self._width)
+
+    def read(self, out):
+        ''' Fill out with the next frame and return it '''
+        nbytes = self._read_into(out)
+        self.frames_read += 1
+        self.last_bytes_copied = nbytes
+        self.total_bytes_copied += nbytes
+        return out
+
+    def read_foveated(self, periphery, rois, origins):
+        '''
+        Read the next frame as a downsampled periphery plus full resolution regions.
+        periphery: (height // s, width // s) array receiving the frame downsampled by s
+        rois: (n, h, w) array receiving n full resolution regions of the frame
+        origins: n (x, y) top-left corners of the regions, in frame pixels
+        Returns periphery.
+        '''
+        nbytes = self._read_foveated_into(periphery, rois, origins)
+        self.frames_read += 1
+        self.last_bytes_copied = nbytes
+        self.total_bytes_copied += nbytes
+        return periphery
+
+    @property
+    def sequence(self):
+        ''' Content version of the last frame read, or None if the source cannot tell '''
+        return self._sequence_of(self.frames_read - 1)
+
+    def next_sequence(self):
+        ''' Content version of the next frame to be read, or None if the source cannot tell '''
+        return self._sequence_of(self.frames_read)
+
+    def skip(self):
+        ''' Consume the next frame without reading it, e.g. when next_sequence() shows it is unchanged '''
+        self.frames_read += 1
+        self.last_bytes_copied = 0
+
+    def _sequence_of(self, n):
+        return None
+
+    def _read_into(self, out):
+        raise NotImplementedError
+
+    def _read_foveated_into(self, periphery, rois, origins):
+        '''
+        Fallback for sources that can only produce whole frames: read into a scratch
+        frame, then crop the regions and area-downsample the periphery from it.
+        '''
+        import cv2
+        if self._scratch is None:
+            self._scratch = np.empty(self.shape, dtype=np.uint8)
+        nbytes = self._read_into(self._scratch)
+        crop_regions(self._scratch, rois, origins)
+        cv2.resize(self._scratch, (periphery.shape[1], periphery.shape[0]), dst=periphery,
+                   interpolation=cv2.INTER_AREA)
+        return nbytes
+
+    def close(self):
+        pass
+
+
+def frame_checksum(data):
+    ''' CRC-32 of a frame's pixels, as a change signal for sources without a sequence '''
+    return zlib.crc32(data)
+
+
+def crop_regions(frame, rois, origins):
+    ''' Copy the (h, w) regions of frame at origins into rois '''
+    h, w = rois.shape[1:]
+    for roi, (x, y) in zip(rois, origins):
+        roi[:] = frame[y:y + h, x:x + w]
+
+
+class SpoutFrameSource(FrameSource):
+    '''
+    Receives the Unity camera through Spout into an OpenGL texture and reads it back
+    directly into the caller's buffer with glGetTexImage, avoiding the temporary
+    bytes object that PyOpenGL would otherwise allocate per frame.
+    Source code for the Spout bindings: https://github.com/spiraltechnica/Spout-for-Python
+    '''
+
+    def __init__(self, width, height, name="UnitySender"):
+        super(SpoutFrameSource, self).__init__(width, height)
+        # Spout and the GL window only exist on the experiment machine
+        import pygame
+        import SpoutSDK
+        from OpenGL import GL
+        from OpenGL.raw.GL.VERSION.GL_1_0 import glGetTexImage
+        from OpenGL.raw.GL.VERSION.GL_4_5 import glGetTextureSubImage
+        self._pygame = pygame
+        self._GL = GL
+        self._raw_glGetTexImage = glGetTexImage
+        self._raw_glGetTextureSubImage = glGetTextureSubImage
+        self._spout_name = name
+        self._spout_size = (width, height)
+        self._init_Spout(SpoutSDK)
+        self._init_GL()
+        # GL 4.5 (or ARB_get_texture_sub_image); the pygame window's compatibility
+        # context may not have it, and entry points only resolve once a context exists
+        if not bool(glGetTextureSubImage):
+            self._raw_glGetTextureSubImage = None
+
+    def _init_Spout(self, SpoutSDK):
+        '''
+        Initalize a Spout receiver using Python Bindings for Spout C++ SDK.
+        '''
+        self._spout_receiver = SpoutSDK.SpoutReceiver()
+
+        # Its signature in c++ looks like this: bool pyCreateReceiver(const char* theName, unsigned int theWidth, unsigned int theHeight, bool bUseActive);
+        self._spout_receiver.pyCreateReceiver(self._spout_name,
+                                              self._spout_size[0],
+                                              self._spout_size[1],
+                                              False
+        )
+
+    def _init_GL(self):
+        '''
+        Initializes an OpenGL context via PyGame module. The window must exist for OpenGL
+        to function, but is automatically minimized via iconify to avoid cluttering screenspace.
+        '''
+        GL = self._GL
+        pygame = self._pygame
+
+        # window setup
+        pygame.init()
+        pygame.display.set_caption('Spout Receiver')
+        pygame.display.set_mode((self._width, self._height), pygame.DOUBLEBUF | pygame.OPENGL)
+        pygame.display.iconify()
+
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glLoadIdentity()
+        GL.glOrtho(0, self._width, self._height, 0, 1, -1)
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glDisable(GL.GL_DEPTH_TEST)
+        GL.glClearColor(0.0, 0.0, 0.0, 0.0)
+        GL.glEnable(GL.GL_TEXTURE_2D)
+
+        # create texture for spout receiver
+        self._tex_id = GL.glGenTextures(1).item()
+
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self._tex_id)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameterf(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_LUMINANCE, self._spout_size[0], self._spout_size[1],
+                        0, GL.GL_LUMINANCE, GL.GL_UNSIGNED_BYTE, None)
+        # rows of the readback are tightly packed so they line up with the numpy buffer
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def _read_into(self, out):
+        '''
+        Capture the image being transmitted by the spout_sender camera into out as
+        luminance data. (Can change GL_LUMINANCE to GL_RGB/RGBA to capture color images)
+        '''
+        GL = self._GL
+        self._receive()
+        self._raw_glGetTexImage(GL.GL_TEXTURE_2D, 0, GL.GL_LUMINANCE, GL.GL_UNSIGNED_BYTE,
+                                out.ctypes.data_as(ctypes.c_void_p))
+        return out.nbytes
+
+    def _read_foveated_into(self, periphery, rois, origins):
+        '''
+        Read the regions straight out of the received texture with
+        glGetTextureSubImage, and the periphery from a mipmap level generated on
+        the GPU, so only the bytes that are used are read back. The periphery
+        must be downsampled by a power of two. Without glGetTextureSubImage, the
+        whole frame is read back and cropped on the CPU instead.
+        '''
+        if self._raw_glGetTextureSubImage is None:
+            return super(SpoutFrameSource, self)._read_foveated_into(periphery, rois, origins)
+        GL = self._GL
+        self._receive()
+        level = int(round(math.log2(self._width / periphery.shape[1])))
+        GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
+        self._raw_glGetTexImage(GL.GL_TEXTURE_2D, level, GL.GL_LUMINANCE, GL.GL_UNSIGNED_BYTE,
+                                periphery.ctypes.data_as(ctypes.c_void_p))
+        h, w = rois.shape[1:]
+        for roi, (x, y) in zip(rois, origins):
+            self._raw_glGetTextureSubImage(self._tex_id, 0, x, y, 0, w, h, 1,
+                                           GL.GL_LUMINANCE, GL.GL_UNSIGNED_BYTE, roi.nbytes,
+                                           roi.ctypes.data_as(ctypes.c_void_p))
+        return periphery.nbytes + rois.nbytes
+
+    def _receive(self):
+        ''' Bind the texture and update it with the newest frame from the Spout sender '''
+        GL = self._GL
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self._tex_id)
+        self._spout_receiver.pyReceiveTexture(self._spout_name,
+                                              self._spout_size[0],
+                                              self._spout_size[1],
+                                              self._tex_id,
+                                              GL.GL_TEXTURE_2D, False, 0)
+
+    def close(self):
+        self._spout_receiver.ReleaseReceiver()
+
+
+class SyntheticFrameSource(FrameSource):
+    '''
+    Generates a horizontally scrolling gradient with a grid overlay. The pattern is
+    precomputed at twice the frame width, so producing a frame is one slice copy.
+    With speed=0 the scene is static.
+    '''
+
+    def __init__(self, width, height, speed=8):
+        super(SyntheticFrameSource, self).__init__(width, height)
+        self._speed = speed
+        cols = np.arange(2 * width)
+        pattern = np.empty((height, 2 * width), dtype=np.uint8)
+        pattern[:] = (cols % width * 255 // max(width - 1, 1)).astype(np.uint8)
+        pattern[::64, :] = 255
+        pattern[:, ::64] = 255
+        self._pattern = pattern
+
+    def _sequence_of(self, n):
+        # the scroll offset determines the frame
+        return (n * self._speed) % self._width
+
+    def _read_into(self, out):
+        offset = (self.frames_read * self._speed) % self._width
+        np.copyto(out, self._pattern[:, offset:offset + self._width])
+        return out.nbytes
+
+
+class FileFrameSource(FrameSource):
+    '''
+    Cycles through frames stored on disk: either a list of image files, decoded to
+    grayscale and resized once at construction, or a .npy stack of shape
+    (n, height, width) that is memory-mapped rather than loaded.
+    '''
+
+    def __init__(self, width, height, paths):
+        super(FileFrameSource, self).__init__(width, height)
+        if isinstance(paths, str) and paths.endswith('.npy'):
+            self._frames = np.load(paths, mmap_mode='r')
+            if self._frames.shape[1:] != (height, width):
+                raise ValueError("Frame stack has shape %s, expected (n, %d, %d)"
+                                 % (self._frames.shape, height, width))
+        else:
+            import cv2
+            if isinstance(paths, str):
+                paths = [paths]
+            self._frames = np.empty((len(paths), height, width), dtype=np.uint8)
+            for i, path in enumerate(paths):
+                img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+                if img is None:
+                    raise IOError("Could not read frame image %s" % path)
+                cv2.resize(img, (width, height), dst=self._frames[i], interpolation=cv2.INTER_AREA)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _sequence_of(self, n):
+        return n % len(self._frames)
+
+    def _read_into(self, out):
+        np.copyto(out, self._frames[self.frames_read % len(self._frames)])
+        return out.nbytes
+
+
+class VideoFrameSource(FrameSource):
+    '''
+    Reads a video file, decoded to grayscale at the frame size on a worker thread
+    into a bounded queue of preallocated buffers, so read() only waits for a
+    frame and copies it. With realtime=True frames are paced to fps (by default
+    the video's own frame rate); otherwise they are delivered as fast as they
+    are decoded. At the end of the video it starts over with loop=True (the
+    queue hides the rewind), or reading raises EOFError.
+    Nothing is opened until start() is called. If the decoder fails, reading
+    raises its error; reading from a closed source raises EOFError.
+    '''
+
+    def __init__(self, width, height, path, realtime=False, loop=True, fps=None, queue_size=4):
+        super(VideoFrameSource, self).__init__(width, height)
+        self._path = path
+        self._realtime = realtime
+        self._loop = loop
+        self._fps = fps
+        # one extra buffer for the frame the decoder is writing
+        self._pool = FramePool((height, width), dtype=np.uint8, count=queue_size + 1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # bumped by seek(); queued frames of an older generation are discarded
+        self._generation = 0
+        self._seek_to = None
+        self._position = 0
+        self._frame_count = 0
+        self._capture = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._next_time = None
+        # generation in which the decoder reached the end of the video
+        self._ended = None
+        self.frames_decoded = 0
+        self.loops = 0
+        self.error = None
+
+    def start(self):
+        import cv2
+        self._cv2 = cv2
+        self._capture = cv2.VideoCapture(self._path)
+        if not self._capture.isOpened():
+            raise IOError("Could not open video %s" % self._path)
+        self._frame_count = int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if self._fps is None:
+            self._fps = self._capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self._thread = threading.Thread(target=self._decode_loop, name='VideoFrameSource', daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def position(self):
+        ''' Index (into the video) of the next frame to be read '''
+        return self._position
+
+    @property
+    def frame_count(self):
+        ''' Number of frames in the video, as reported by its container '''
+        return self._frame_count
+
+    @property
+    def fps(self):
+        return self._fps
+
+    def seek(self, position):
+        ''' Continue reading from frame position; frames already decoded are discarded '''
+        with self._lock:
+            self._generation += 1
+            self._seek_to = position
+        self._position = position
+        self._next_time = None
+
+    def _read_into(self, out):
+        while True:
+            if self._ended == self._generation:
+                raise EOFError("End of video %s" % self._path)
+            try:
+                generation, index, buf = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                self._check_decoder()
+                continue
+            if buf is None:
+                self._ended = generation
+            elif generation == self._generation:
+                break
+            else:
+                self._pool.release(buf)
+        if self._realtime:
+            now = time.perf_counter()
+            if self._next_time is None or now - self._next_time > 1.0 / self._fps:
+                # (re)start the clock rather than catching up in a burst
+                self._next_time = now
+            elif self._next_time > now:
+                time.sleep(self._next_time - now)
+            self._next_time += 1.0 / self._fps
+        np.copyto(out, buf)
+        self._pool.release(buf)
+        self._position = index + 1
+        return out.nbytes
+
+    def _check_decoder(self):
+        ''' Raise if no frame can arrive any more: the decoder failed, stopped or was closed '''
+        if self.error is not None:
+            raise self.error
+        if self._stopped.is_set():
+            raise EOFError("Video source %s was closed" % self._path)
+        if self._thread is None or not self._thread.is_alive():
+            raise IOError("Video decoder for %s is not running" % self._path)
+
+    def _decode_loop(self):
+        try:
+            self._decode()
+        except Exception as err:
+            self.error = err
+
+    def _decode(self):
+        cv2 = self._cv2
+        capture = self._capture
+        index = 0
+        generation = self._generation
+        # decoded image at the video's size, reused once its shape is known
+        image = gray = None
+        while not self._stopped.is_set():
+            with self._lock:
+                if self._seek_to is not None:
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, self._seek_to)
+                    index, generation = self._seek_to, self._generation
+                    self._seek_to = None
+            buf = self._pool.acquire(timeout=0.1)
+            if buf is None:
+                continue
+            ok, image = capture.read(image)
+            if not ok:
+                self._pool.release(buf)
+                if not self._loop or index == 0:
+                    # nothing (more) to decode: the reader gets EOFError, until a seek
+                    self._queue.put((generation, index, None))
+                    while self._seek_to is None and not self._stopped.wait(0.05):
+                        pass
+                    continue
+                capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                index = 0
+                self.loops += 1
+                continue
+            if image.shape[:2] == buf.shape:
+                cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=buf)
+            else:
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
+                cv2.resize(gray, (self._width, self._height), dst=buf, interpolation=cv2.INTER_AREA)
+            self.frames_decoded += 1
+            self._queue.put((generation, index, buf))
+            index += 1
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+
+
+class DecodedFrameCache(object):
+    '''
+    LRU cache of decoded frames keyed by (path, frame index), so a still image,
+    or a clip short enough to fit, is only decoded once. Bounded by the bytes the
+    frames hold rather than their number, since a display-size RGBA frame is
+    10 MB or more; the newest frame is kept even if it alone is larger. Thread safe.
+    '''
+
+    def __init__(self, max_bytes=64 << 20):
+        self._max_bytes = int(max_bytes)
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def put(self, key, frame):
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._frames[key] = frame
+            self.nbytes += frame.nbytes
+            while self.nbytes > self._max_bytes and len(self._frames) > 1:
+                self.nbytes -= self._frames.popitem(last=False)[1].nbytes
+
+
+class DisplayFramePrefetcher(object):
+    '''
+    Decodes an image or video file into (height, width, 4) RGBA frames of the
+    display size. A still image is decoded once; video is decoded on a background
+    thread into a bounded queue of up to queue_size frames. Decoded frames go
+    through a DecodedFrameCache, so a looping clip that fits in the cache is only
+    decoded on its first pass. Frames are shared with the cache: treat them as
+    read-only.
+    '''
+
+    def __init__(self, path, width, height, cache=None, queue_size=4, loop=True):
+        self._path = path
+        self._width = width
+        self._height = height
+        self._cache = cache if cache is not None else DecodedFrameCache()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._loop = loop
+        self._still = None
+        self._capture = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self.frames_decoded = 0
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def start(self):
+        import cv2
+        self._cv2 = cv2
+        img = cv2.imread(self._path)
+        if img is not None:
+            self._still = self._cache.get((self._path, 0))
+            if self._still is None:
+                self._still = self._decode(img)
+                self._cache.put((self._path, 0), self._still)
+            return self
+        self._capture = cv2.VideoCapture(self._path)
+        if not self._capture.isOpened():
+            raise IOError("Could not open image or video %s" % self._path)
+        self._thread = threading.Thread(target=self._run, name='DisplayFramePrefetcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def next(self, timeout=0.0):
+        '''
+        The next frame, or None if none has been decoded within timeout seconds
+        (or the video ended without loop); the display should then keep showing
+        the previous frame.
+        '''
+        if self._still is not None:
+            return self._still
+        try:
+            return self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._capture is not None:
+            self._capture.release()
+            self._capture = None
+
+    def _decode(self, img):
+        cv2 = self._cv2
+        # resize the 3 channel image first, then expand to RGBA straight into the frame
+        img = cv2.resize(img, (self._width, self._height), interpolation=cv2.INTER_AREA)
+        frame = np.empty((self._height, self._width, 4), dtype=np.uint8)
+        cv2.cvtColor(img, cv2.COLOR_BGR2RGBA, dst=frame)
+        self.frames_decoded += 1
+        return frame
+
+    def _run(self):
+        index = 0
+        # the capture falls behind while frames come from the cache
+        in_sync = True
+        while not self._stopped.is_set():
+            key = (self._path, index)
+            frame = self._cache.get(key)
+            if frame is None:
+                if not in_sync:
+                    self._capture.set(self._cv2.CAP_PROP_POS_FRAMES, index)
+                ok, img = self._capture.read()
+                if not ok:
+                    if not self._loop or index == 0:
+                        return
+                    index = 0
+                    in_sync = False
+                    continue
+                in_sync = True
+                frame = self._decode(img)
+                self._cache.put(key, frame)
+            else:
+                in_sync = False
+            while not self._stopped.is_set():
+                try:
+                    self._queue.put(frame, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            index += 1
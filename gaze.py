@@ -0,0 +1,505 @@
+'''
+Gaze sample buffering and acquisition for the Pupil-labs eye tracker.
+
+The Pupil Capture plugin (transmit_gaze.py) connects to the EyeTracker's TCP
+socket and streams gaze packets. A GazeReceiver drains those packets on its own
+thread into a GazeBuffer, so the frame loop can query the most recent samples
+without ever blocking on the socket.
+
+Two packet formats are understood. The legacy packet is just the normalized
+gaze (x, y) as two float32. The binocular packet (40 bytes, little endian)
+carries both eyes:
+
+    magic            uint16   b'GZ'
+    version          uint8    GAZE_PROTOCOL_VERSION
+    flags            uint8    bit 0: left eye valid, bit 1: right eye valid
+    sequence         uint32   increments by one per packet
+    pupil_timestamp  float64  Pupil Capture time of the sample, seconds
+    gaze             2 x 2 float32  normalized (x, y) of the left and right eye
+    confidence       2 x float32    Pupil detection confidence per eye, 0 to 1
+
+Either way, each recv_into() drains every pending packet straight into a
+preallocated structured array, without intermediate copies.
+'''
+
+import collections
+
+import socket
+import threading
+import time
+
+import numpy as np
+
+from instrumentation import NULL_INSTRUMENTATION
+
+# legacy packet: normalized gaze (x, y) as two little endian float32
+GAZE_PACKET_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4')])
+
+GAZE_MAGIC = 0x5A47  # b'GZ' read as a little endian uint16
+GAZE_PROTOCOL_VERSION = 1
+LEFT_EYE_VALID = 1
+RIGHT_EYE_VALID = 2
+
+BINOCULAR_GAZE_PACKET_DTYPE = np.dtype([
+    ('magic', '<u2'),
+    ('version', 'u1'),
+    ('flags', 'u1'),
+    ('sequence', '<u4'),
+    ('pupil_timestamp', '<f8'),
+    ('gaze', '<f4', (2, 2)),
+    ('confidence', '<f4', (2,)),
+])
+
+GAZE_PACKET_FORMATS = {'legacy': GAZE_PACKET_DTYPE, 'binocular': BINOCULAR_GAZE_PACKET_DTYPE}
+
+# a received binocular sample, as kept by GazeBuffer
+GAZE_RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),          # time.perf_counter() time of the sample
+    ('pupil_timestamp', '<f8'),
+    ('gaze', '<f4', (2, 2)),
+    ('confidence', '<f4', (2,)),
+    ('valid', '?', (2,)),
+])
+
+
+def kill_process_tree(pid):
+    ''' Kill a process (e.g. Pupil Capture) and all of its children '''
+    import psutil
+    process = psutil.Process(pid)
+    for proc in process.children(recursive=True):
+        proc.kill()
+    process.kill()
+
+
+class GazeBuffer(object):
+    '''
+    Fixed-size ring buffer of timestamped gaze samples. Each row holds
+    (timestamp, x, y), with timestamps taken from time.perf_counter().
+    One thread writes via push(); any number of threads may read via latest()
+    and since(). Readers only hold the lock long enough to copy rows out.
+    Binocular samples are also kept in full (both eyes, confidence, Pupil
+    timestamp) in a second ring of GAZE_RECORD_DTYPE records.
+    '''
+
+    def __init__(self, capacity=1024):
+        '''
+        Preallocate storage for capacity samples.
+        '''
+        self._capacity = int(capacity)
+        self._data = np.zeros((self._capacity, 3), dtype=np.float64)
+        self._count = 0   # total number of samples ever written
+        self._records = np.zeros(self._capacity, dtype=GAZE_RECORD_DTYPE)
+        self._record_count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self._capacity)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def count(self):
+        ''' Total number of samples pushed since creation (including overwritten ones) '''
+        return self._count
+
+    def push(self, timestamps, xs, ys, records=None):
+        '''
+        Append a batch of samples. timestamps, xs and ys are equal length sequences
+        (or scalars). If the batch is larger than the buffer, only its tail is kept.
+        records: the batch's binocular GAZE_RECORD_DTYPE records, if any (they may
+        include samples left out of the (x, y) stream, e.g. during blinks)
+        '''
+        if records is not None and len(records):
+            self._push_records(records[-self._capacity:])
+        timestamps = np.atleast_1d(timestamps)
+        xs = np.atleast_1d(xs)
+        ys = np.atleast_1d(ys)
+        n = len(timestamps)
+        if n == 0:
+            return
+        if n > self._capacity:
+            timestamps, xs, ys = timestamps[-self._capacity:], xs[-self._capacity:], ys[-self._capacity:]
+            skipped = n - self._capacity
+            n = self._capacity
+        else:
+            skipped = 0
+
+        with self._lock:
+            start = (self._count + skipped) % self._capacity
+            # at most two contiguous runs: up to the end of the ring, then from its start
+            for rows, part in self._runs(start, n):
+                self._data[rows, 0] = timestamps[part]
+                self._data[rows, 1] = xs[part]
+                self._data[rows, 2] = ys[part]
+            self._count += skipped + n
+
+    def _runs(self, start, n):
+        first = min(n, self._capacity - start)
+        runs = [(slice(start, start + first), slice(0, first))]
+        if first < n:
+            runs.append((slice(0, n - first), slice(first, n)))
+        return runs
+
+    def _push_records(self, records):
+        n = len(records)
+        with self._lock:
+            for rows, part in self._runs(self._record_count % self._capacity, n):
+                self._records[rows] = records[part]
+            self._record_count += n
+
+    def latest_record(self):
+        ''' The newest binocular GAZE_RECORD_DTYPE record (a copy), or None '''
+        with self._lock:
+            if self._record_count == 0:
+                return None
+            return self._records[(self._record_count - 1) % self._capacity].copy()
+
+    def records_since(self, t):
+        ''' Binocular records with timestamp strictly greater than t, oldest first (a copy) '''
+        with self._lock:
+            n = min(self._record_count, self._capacity)
+            start = (self._record_count - n) % self._capacity
+            ordered = np.roll(self._records, -start)[:n]
+        first = np.searchsorted(ordered['timestamp'], t, side='right')
+        return ordered[first:].copy()
+
+    def latest(self):
+        '''
+        Return the newest sample as a (timestamp, x, y) tuple, or None if the buffer
+        is still empty. Never blocks on the socket.
+        '''
+        with self._lock:
+            if self._count == 0:
+                return None
+            t, x, y = self._data[(self._count - 1) % self._capacity]
+        return (t, x, y)
+
+    def since(self, t):
+        '''
+        Return all buffered samples with timestamp strictly greater than t as an
+        (n, 3) array ordered oldest to newest. The result is a copy.
+        '''
+        with self._lock:
+            n = min(self._count, self._capacity)
+            if n == 0:
+                return np.empty((0, 3), dtype=np.float64)
+            start = (self._count - n) % self._capacity
+            ordered = np.roll(self._data, -start, axis=0)[:n]
+        # timestamps are monotonic so a binary search finds the cutoff
+        first = np.searchsorted(ordered[:, 0], t, side='right')
+        return ordered[first:].copy()
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+            self._record_count = 0
+
+
+class PupilClock(object):
+    '''
+    Maps Pupil Capture timestamps to time.perf_counter(). The offset between the
+    clocks is estimated as the smallest (arrival time - Pupil timestamp) seen over
+    the last window seconds: the sample that was delayed least in transit bounds
+    it most tightly, and the window lets the estimate follow clock drift.
+    '''
+
+    def __init__(self, window=2.0):
+        self._window = window
+        # (arrival, offset) pairs with increasing offsets: a sliding window minimum
+        self._candidates = collections.deque()
+
+    @property
+    def offset(self):
+        ''' perf_counter() - Pupil time, or None before any sample '''
+        return self._candidates[0][1] if self._candidates else None
+
+    def observe(self, arrival, pupil_timestamp):
+        offset = arrival - pupil_timestamp
+        candidates = self._candidates
+        while candidates and candidates[-1][1] >= offset:
+            candidates.pop()
+        candidates.append((arrival, offset))
+        while candidates[0][0] < arrival - self._window:
+            candidates.popleft()
+
+    def to_local(self, pupil_timestamps):
+        return pupil_timestamps + self.offset
+
+
+class GazeReceiver(object):
+    '''
+    Background thread that reads complete gaze packets from a connected socket
+    and pushes them into a GazeBuffer. Each recv_into() fills a preallocated
+    structured array with as many packets as are pending; a trailing partial
+    packet is carried over to the front of the array until the rest arrives, so
+    a short read never produces a bogus sample.
+
+    Legacy packets carry no timestamp: the last one drained by a recv_into() is
+    stamped with its arrival time and the earlier ones spread back from it at
+    the tracker's nominal sample rate, so a batch does not collapse onto one
+    instant (which would read as infinite or zero gaze velocity).
+    Binocular samples get their Pupil timestamp mapped to time.perf_counter()
+    (see PupilClock), and their (x, y) is the confidence-weighted mean of the
+    valid eyes; samples with no valid eye (blinks) only go to the records.
+    '''
+
+    def __init__(self, conn, buffer, packet_dtype=GAZE_PACKET_DTYPE, poll_interval=0.1,
+                 instrumentation=NULL_INSTRUMENTATION, batch_size=256, min_confidence=0.6,
+                 sample_rate=120.0):
+        '''
+        conn: connected socket streaming packets of packet_dtype (GAZE_PACKET_DTYPE
+            or BINOCULAR_GAZE_PACKET_DTYPE)
+        buffer: GazeBuffer receiving the decoded samples
+        poll_interval: socket timeout (s) used to check for a stop request
+        instrumentation: records the time from recv() returning to the samples
+            being buffered as the 'gaze_receive' stage (see instrumentation.py)
+        batch_size: most packets drained by one recv_into()
+        min_confidence: binocular eyes below this confidence count as not valid
+        sample_rate: nominal rate (Hz) of legacy packets, used to timestamp them
+        '''
+        self._conn = conn
+        self._buffer = buffer
+        self._dtype = packet_dtype
+        self._binocular = packet_dtype == BINOCULAR_GAZE_PACKET_DTYPE
+        self._poll_interval = poll_interval
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._packets = np.zeros(batch_size, dtype=packet_dtype)
+        self._records = np.zeros(batch_size, dtype=GAZE_RECORD_DTYPE) if self._binocular else None
+        self._min_confidence = min_confidence
+        self._sample_period = 1.0 / sample_rate
+        self._last_stamp = -np.inf
+        self._instrumentation = instrumentation
+        self.clock = PupilClock()
+        self.error = None
+        self.packets_received = 0
+        self.recv_calls = 0
+        self.bad_packets = 0
+        self.lost_packets = 0
+        self._sequence = None
+
+    def start(self):
+        self._conn.settimeout(self._poll_interval)
+        self._thread = threading.Thread(target=self._run, name='GazeReceiver', daemon=True)
+        self._thread.start()
+        return self
+
+    def run(self):
+        ''' Receive on the calling thread until the sender disconnects or stop() is called '''
+        self._conn.settimeout(self._poll_interval)
+        self._run()
+
+    def stop(self, timeout=1.0):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        raw = self._packets.view(np.uint8)
+        view = memoryview(raw)
+        packet_size = self._dtype.itemsize
+        filled = 0
+        while not self._stop_event.is_set():
+            try:
+                nbytes = self._conn.recv_into(view[filled:])
+            except socket.timeout:
+                continue
+            except OSError as err:
+                self.error = err
+                break
+            if nbytes == 0:
+                # sender closed the connection
+                break
+            stamp = time.perf_counter()
+            self.recv_calls += 1
+            filled += nbytes
+            while filled >= packet_size:
+                complete = filled // packet_size
+                packets = self._packets[:complete]
+                if self._binocular:
+                    consumed = self._push_binocular(packets, stamp)
+                else:
+                    self._buffer.push(self._legacy_timestamps(complete, stamp), packets['x'], packets['y'])
+                    self.packets_received += complete
+                    consumed = complete * packet_size
+                # carry the rest (a partial packet, or packets after a realignment) to the front
+                raw[:filled - consumed] = raw[consumed:filled]
+                filled -= consumed
+                if consumed == complete * packet_size:
+                    break
+            self._instrumentation.record('gaze_receive', stamp)
+
+    def _legacy_timestamps(self, n, stamp):
+        '''
+        Timestamps of n legacy packets drained at stamp: sample_period apart and
+        ending at stamp, or squeezed in evenly after the previous sample if that
+        would reach back past it, so timestamps always increase.
+        '''
+        timestamps = stamp - np.arange(n - 1, -1, -1) * self._sample_period
+        if timestamps[0] <= self._last_stamp:
+            timestamps = self._last_stamp + (stamp - self._last_stamp) * np.arange(1, n + 1) / n
+        self._last_stamp = stamp
+        return timestamps
+
+    def _push_binocular(self, packets, stamp):
+        '''
+        Validate, timestamp and buffer a batch of binocular packets. Returns the
+        number of bytes consumed: all of them, or on a bad magic or version, the
+        packets before it and the bytes up to the next magic, so the stream realigns.
+        '''
+        good = (packets['magic'] == GAZE_MAGIC) & (packets['version'] == GAZE_PROTOCOL_VERSION)
+        if not good.all():
+            first_bad = int(np.argmin(good))
+            consumed = self._push_binocular(packets[:first_bad], stamp) if first_bad else 0
+            return consumed + self._skip_to_magic(packets.view(np.uint8)[consumed:])
+        n = len(packets)
+        sequences = packets['sequence']
+        if self._sequence is not None:
+            self.lost_packets += int((int(sequences[0]) - self._sequence - 1) & 0xFFFFFFFF)
+        self._sequence = int(sequences[-1])
+        self.packets_received += n
+
+        pupil_timestamps = packets['pupil_timestamp']
+        gaze = packets['gaze']
+        confidence = packets['confidence']
+        flags = packets['flags']
+        self.clock.observe(stamp, pupil_timestamps[-1])
+        records = self._records[:n]
+        timestamps = records['timestamp']
+        timestamps[:] = self.clock.to_local(pupil_timestamps)
+        records['pupil_timestamp'] = pupil_timestamps
+        records['gaze'] = gaze
+        records['confidence'] = confidence
+        valid = records['valid']
+        valid[:, 0] = flags & LEFT_EYE_VALID
+        valid[:, 1] = flags & RIGHT_EYE_VALID
+        valid &= confidence >= self._min_confidence
+
+        weights = confidence * valid
+        total = weights.sum(axis=1)
+        seen = total > 0
+        if seen.all():
+            combined = (weights[:, :, np.newaxis] * gaze).sum(axis=1) / total[:, np.newaxis]
+        else:
+            combined = ((weights[seen, :, np.newaxis] * gaze[seen]).sum(axis=1)
+                        / total[seen, np.newaxis])
+            timestamps = timestamps[seen]
+        self._buffer.push(timestamps, combined[:, 0], combined[:, 1], records)
+        return n * packets.itemsize
+
+    def _skip_to_magic(self, raw):
+        ''' Number of bytes of raw (starting with a bad packet) before the next packet magic '''
+        self.bad_packets += 1
+        self._sequence = None
+        low, high = GAZE_MAGIC & 0xFF, GAZE_MAGIC >> 8
+        found = np.flatnonzero((raw[1:-1] == low) & (raw[2:] == high))
+        if len(found):
+            return int(found[0]) + 1
+        # keep a last byte that may start the next magic
+        return len(raw) - 1
+
+
+class FakeGazeSender(object):
+    '''
+    Stand-in for the Pupil Capture transmit_gaze.py plugin, used for testing
+    without the eye tracker. Connects to an EyeTracker's listening socket and
+    streams legacy gaze packets at a fixed rate, tracing a slow circle, or with
+    pattern='saccades', fixating on a cycle of targets and jumping between them.
+    With packet_format='binocular' it sends binocular packets instead: the eyes
+    are slightly apart, confidences vary, the eyes blink (both invalid) for
+    BLINK_DURATION every BLINK_INTERVAL, and Pupil timestamps run on a clock
+    PUPIL_CLOCK_OFFSET seconds behind time.perf_counter().
+    '''
+
+    # fixation targets of the 'saccades' pattern, and how long each fixation and jump takes
+    SACCADE_TARGETS = np.array([[0.3, 0.3], [0.7, 0.35], [0.5, 0.7], [0.25, 0.6], [0.65, 0.65]])
+    FIXATION_DURATION = 0.3
+    SACCADE_DURATION = 0.04
+    BLINK_INTERVAL = 4.0
+    BLINK_DURATION = 0.15
+    PUPIL_CLOCK_OFFSET = 1000.0
+
+    def __init__(self, host='127.0.0.1', port=8888, rate=120.0, pattern='circle', packet_format='legacy'):
+        if pattern not in ('circle', 'saccades'):
+            raise ValueError("Unknown gaze pattern: %s" % pattern)
+        if packet_format not in GAZE_PACKET_FORMATS:
+            raise ValueError("Unknown gaze packet format: %s" % packet_format)
+        self._host = host
+        self._port = port
+        self._rate = float(rate)
+        self._pattern = pattern
+        self._packet_format = packet_format
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.sent = 0
+
+    def start(self, connect_timeout=5.0):
+        self._sock = socket.create_connection((self._host, self._port), timeout=connect_timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._thread = threading.Thread(target=self._run, name='FakeGazeSender', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._sock.close()
+
+    def is_alive(self):
+        ''' False once stopped or the receiver has disconnected '''
+        return self._thread is not None and self._thread.is_alive()
+
+    def sample(self, t):
+        ''' Gaze position (x, y) in normalized coordinates at time t '''
+        if self._pattern == 'saccades':
+            period = self.SACCADE_DURATION + self.FIXATION_DURATION
+            k, phase = divmod(t, period)
+            targets = self.SACCADE_TARGETS
+            start, end = targets[int(k) % len(targets)], targets[(int(k) + 1) % len(targets)]
+            x, y = start + (end - start) * min(phase / self.SACCADE_DURATION, 1.0)
+            # fixational tremor, well below saccadic velocities
+            return (x + 0.001 * np.sin(2 * np.pi * 40 * t), y)
+        return (0.5 + 0.25 * np.cos(2 * np.pi * 0.5 * t),
+                0.5 + 0.25 * np.sin(2 * np.pi * 0.5 * t))
+
+    def binocular_sample(self, t, packet):
+        ''' Fill a BINOCULAR_GAZE_PACKET_DTYPE packet with the binocular sample at time t '''
+        x, y = self.sample(t)
+        packet['gaze'] = ((x - 0.005, y), (x + 0.005, y))
+        packet['confidence'] = (0.9 + 0.1 * np.sin(2 * np.pi * 3 * t), 0.9 + 0.1 * np.cos(2 * np.pi * 3 * t))
+        blinking = t % self.BLINK_INTERVAL > self.BLINK_INTERVAL - self.BLINK_DURATION
+        packet['flags'] = 0 if blinking else LEFT_EYE_VALID | RIGHT_EYE_VALID
+
+    def _run(self):
+        period = 1.0 / self._rate
+        binocular = self._packet_format == 'binocular'
+        packet = np.zeros(1, dtype=GAZE_PACKET_FORMATS[self._packet_format])
+        if binocular:
+            packet['magic'] = GAZE_MAGIC
+            packet['version'] = GAZE_PROTOCOL_VERSION
+        t0 = time.perf_counter()
+        next_send = t0
+        while not self._stop_event.is_set():
+            if binocular:
+                self.binocular_sample(next_send - t0, packet[0])
+                packet['sequence'] = self.sent + 1
+                packet['pupil_timestamp'] = time.perf_counter() - self.PUPIL_CLOCK_OFFSET
+            else:
+                packet['x'], packet['y'] = self.sample(next_send - t0)
+            try:
+                self._sock.sendall(packet.tobytes())
+            except OSError:
+                break
+            self.sent += 1
+            next_send += period
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
@@ -0,0 +1,181 @@
+'''
+Online classification of the gaze stream into fixations and saccades.
+
+The classifier consumes the same (timestamp, x, y) sample batches as the gaze
+predictors (see gaze_prediction.py) and labels every sample with a velocity
+threshold (I-VT), optionally also requiring a small dispersion over a sliding
+window of recent samples for a fixation (I-DT). Each batch is labelled in a
+few vectorized numpy operations; Python only loops over the event boundaries
+found in it, which are rare at gaze rates.
+
+State is a fixed number of scalars, the dispersion window and a ring of the
+most recent events, so memory does not grow with the session. Per-session
+statistics are accumulated as events end.
+'''
+
+import numpy as np
+
+FIXATION = 0
+SACCADE = 1
+EVENT_NAMES = {FIXATION: 'fixation', SACCADE: 'saccade'}
+
+EVENT_DTYPE = np.dtype([
+    ('type', np.int8),
+    ('start', np.float64),
+    ('end', np.float64),
+    ('amplitude', np.float64),      # distance from start to end position
+    ('peak_velocity', np.float64),
+])
+
+
+class EyeMovementClassifier(object):
+    '''
+    Streaming I-VT classifier, with optional I-DT confirmation of fixations.
+    update() consumes an (n, 3) array of (timestamp, x, y) samples ordered
+    oldest to newest. Positions and thresholds are in normalized screen units.
+    '''
+
+    def __init__(self, velocity_threshold=0.3, dispersion_threshold=None, dispersion_window=12,
+                 event_capacity=64):
+        '''
+        velocity_threshold: speed (normalized units / s) above which a sample is part of
+            a saccade; 0.3 is roughly 30 deg/s across a 100 degree field of view
+        dispersion_threshold: if set, a sample below the velocity threshold only counts
+            as fixation if the x plus y extent of the last dispersion_window samples is
+            at most this (normalized units)
+        event_capacity: number of completed events kept for events()
+        '''
+        self._velocity_threshold = float(velocity_threshold)
+        self._dispersion_threshold = dispersion_threshold
+        self._window_size = max(int(dispersion_window), 2)
+        # positions of the last window_size - 1 samples, oldest first
+        self._window = np.zeros((self._window_size - 1, 2))
+        self._events = np.zeros(max(int(event_capacity), 1), dtype=EVENT_DTYPE)
+        self.reset()
+
+    def reset(self):
+        self._last = None
+        self._state = None
+        self._state_start = 0.0
+        self._start_position = np.zeros(2)
+        self._peak_velocity = 0.0
+        self._velocity = 0.0
+        self._event_count = 0
+        # per event type: count, total duration, total amplitude, total and max peak velocity
+        self._totals = np.zeros((2, 5))
+        self._first_time = None
+
+    @property
+    def state(self):
+        ''' FIXATION or SACCADE for the latest sample, None before any sample '''
+        return self._state
+
+    @property
+    def state_start(self):
+        ''' Timestamp of the first sample of the current event '''
+        return self._state_start
+
+    @property
+    def state_duration(self):
+        if self._last is None:
+            return 0.0
+        return self._last[0] - self._state_start
+
+    @property
+    def velocity(self):
+        ''' Speed at the latest sample, in normalized units / s '''
+        return self._velocity
+
+    @property
+    def event_count(self):
+        ''' Number of completed events so far; a change means an event boundary '''
+        return self._event_count
+
+    def is_stable_fixation(self, min_duration):
+        ''' True if the eye has been fixating for at least min_duration seconds '''
+        return self._state == FIXATION and self.state_duration >= min_duration
+
+    def update(self, samples):
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        if len(samples) == 0:
+            return
+        if self._last is None:
+            self._last = samples[0].copy()
+            self._first_time = samples[0, 0]
+            self._state = FIXATION
+            self._state_start = samples[0, 0]
+            self._start_position[:] = samples[0, 1:]
+            self._window[:] = samples[0, 1:]
+            samples = samples[1:]
+            if len(samples) == 0:
+                return
+
+        t = samples[:, 0]
+        xy = samples[:, 1:]
+        previous = np.concatenate((self._last[np.newaxis], samples[:-1]))
+        dt = t - previous[:, 0]
+        speed = np.hypot(*(xy - previous[:, 1:]).T) / np.where(dt > 0, dt, np.inf)
+        labels = (speed > self._velocity_threshold).astype(np.int8)
+
+        window = np.concatenate((self._window, xy))
+        if self._dispersion_threshold is not None:
+            views = np.lib.stride_tricks.sliding_window_view(window, self._window_size, axis=0)
+            dispersion = (views.max(axis=2) - views.min(axis=2)).sum(axis=1)
+            labels[dispersion > self._dispersion_threshold] = SACCADE
+        self._window[:] = window[len(window) - len(self._window):]
+
+        # split the batch into runs of equal labels; the first run continues the current event
+        starts = np.concatenate(([0], np.flatnonzero(labels[1:] != labels[:-1]) + 1))
+        peaks = np.maximum.reduceat(speed, starts)
+        for run, start in enumerate(starts):
+            if labels[start] != self._state:
+                end = t[start - 1] if start > 0 else self._last[0]
+                end_position = xy[start - 1] if start > 0 else self._last[1:]
+                self._close_event(end, end_position)
+                self._state = int(labels[start])
+                self._state_start = t[start]
+                # measured from where the previous event ended
+                self._start_position[:] = end_position
+                self._peak_velocity = 0.0
+            self._peak_velocity = max(self._peak_velocity, peaks[run])
+
+        self._last[:] = samples[-1]
+        self._velocity = speed[-1]
+
+    def _close_event(self, end, end_position):
+        event = self._events[self._event_count % len(self._events)]
+        event['type'] = self._state
+        event['start'] = self._state_start
+        event['end'] = end
+        event['amplitude'] = np.hypot(*(end_position - self._start_position))
+        event['peak_velocity'] = self._peak_velocity
+        totals = self._totals[self._state]
+        totals[0] += 1
+        totals[1] += end - self._state_start
+        totals[2] += event['amplitude']
+        totals[3] += self._peak_velocity
+        totals[4] = max(totals[4], self._peak_velocity)
+        self._event_count += 1
+
+    def events(self):
+        ''' The most recent completed events (up to event_capacity), oldest first, as an EVENT_DTYPE array '''
+        n = min(self._event_count, len(self._events))
+        start = (self._event_count - n) % len(self._events)
+        return np.roll(self._events, -start)[:n]
+
+    def statistics(self):
+        ''' Session statistics of the completed events, durations in milliseconds '''
+        elapsed = self._last[0] - self._first_time if self._last is not None else 0.0
+        stats = {'elapsed_s': elapsed}
+        for kind, name in EVENT_NAMES.items():
+            count, duration, amplitude, peak_total, peak_max = self._totals[kind]
+            stats[name + 's'] = {
+                'count': int(count),
+                'rate_hz': count / elapsed if elapsed > 0 else 0.0,
+                'mean_duration_ms': duration / count * 1e3 if count else float('nan'),
+                'time_fraction': duration / elapsed if elapsed > 0 else 0.0,
+                'mean_amplitude': amplitude / count if count else float('nan'),
+                'mean_peak_velocity': peak_total / count if count else float('nan'),
+                'max_peak_velocity': peak_max,
+            }
+        return stats
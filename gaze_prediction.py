@@ -0,0 +1,226 @@
+'''
+Gaze prediction for latency compensation.
+
+By the time a frame reaches the display the eye has moved on from the last
+gaze sample, which makes the stabilized image trail the eye during saccades.
+The predictors here consume (timestamp, x, y) samples from the EyeTracker
+buffer and extrapolate gaze to the expected display time.
+
+Both predictors keep their state in small numpy arrays and update the x and y
+axes together in one vectorized step.
+'''
+
+import numpy as np
+
+
+class GazePredictor(object):
+    '''
+    Base class for gaze predictors. update() consumes an (n, 3) array of
+    (timestamp, x, y) samples ordered oldest to newest; predict(t) returns the
+    extrapolated (x, y) at time t, or None before any sample has been seen.
+    '''
+
+    def update(self, samples):
+        raise NotImplementedError
+
+    def predict(self, t):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+
+class ConstantVelocityPredictor(GazePredictor):
+    '''
+    Fits position = p + v * (t - t_last) by least squares over the most recent
+    window samples of both axes at once, then extrapolates along that line.
+    A window of 2 is plain two-point extrapolation; larger windows trade a
+    little lag for noise robustness.
+    '''
+
+    def __init__(self, window=4, max_velocity=None):
+        '''
+        window: number of recent samples used for the velocity fit
+        max_velocity: optional clamp on the estimated speed (normalized units / s)
+        '''
+        self._window = max(int(window), 2)
+        self._max_velocity = max_velocity
+        self._samples = np.zeros((self._window, 3))
+        self._count = 0
+        self._velocity = np.zeros(2)
+
+    def reset(self):
+        self._count = 0
+        self._velocity[:] = 0
+
+    @property
+    def velocity(self):
+        return self._velocity.copy()
+
+    def update(self, samples):
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        n = len(samples)
+        if n == 0:
+            return
+        if n >= self._window:
+            self._samples[:] = samples[-self._window:]
+        else:
+            self._samples[:-n] = self._samples[n:]
+            self._samples[-n:] = samples
+        self._count = min(self._count + n, self._window)
+
+        recent = self._samples[-self._count:]
+        dt = recent[:, 0] - recent[-1, 0]
+        dt_centered = dt - dt.mean()
+        denom = np.dot(dt_centered, dt_centered)
+        if denom <= 0:
+            self._velocity[:] = 0
+            return
+        # slope of both axes in a single matrix-vector product
+        self._velocity[:] = dt_centered @ (recent[:, 1:] - recent[:, 1:].mean(axis=0)) / denom
+        if self._max_velocity is not None:
+            speed = np.hypot(*self._velocity)
+            if speed > self._max_velocity:
+                self._velocity *= self._max_velocity / speed
+
+    def predict(self, t):
+        if self._count == 0:
+            return None
+        last = self._samples[-1]
+        x, y = last[1:] + self._velocity * (t - last[0])
+        return (x, y)
+
+
+class KalmanGazePredictor(GazePredictor):
+    '''
+    Constant-velocity Kalman filter with state [position, velocity] per axis.
+    Both axes share the same dynamics and noise model, so they share one 2x2
+    covariance and the state is a 2x2 array (rows: position, velocity;
+    columns: x, y) updated with a single set of matrix operations per sample.
+    '''
+
+    def __init__(self, process_noise=50.0, measurement_noise=1e-4):
+        '''
+        process_noise: spectral density of the (white) gaze acceleration, in
+            normalized units^2 / s^3. Larger values follow saccades faster.
+        measurement_noise: variance of a gaze sample, in normalized units^2
+        '''
+        self._q = float(process_noise)
+        self._r = float(measurement_noise)
+        self._state = np.zeros((2, 2))
+        self._cov = np.eye(2)
+        self._t = None
+        self._F = np.eye(2)
+        self._Q = np.zeros((2, 2))
+        self._H = np.array([1.0, 0.0])
+
+    def reset(self):
+        self._state[:] = 0
+        self._cov = np.eye(2)
+        self._t = None
+
+    @property
+    def velocity(self):
+        return self._state[1].copy()
+
+    def _transition(self, dt):
+        F, Q, q = self._F, self._Q, self._q
+        F[0, 1] = dt
+        Q[0, 0] = q * dt ** 3 / 3
+        Q[0, 1] = Q[1, 0] = q * dt ** 2 / 2
+        Q[1, 1] = q * dt
+        return F, Q
+
+    def update(self, samples):
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        if len(samples) == 0:
+            return
+        start = 0
+        if self._t is None:
+            self._state[0] = samples[0, 1:]
+            self._state[1] = 0
+            self._cov = np.diag([self._r, 1.0])
+            self._t = samples[0, 0]
+            start = 1
+
+        state, cov, H, r = self._state, self._cov, self._H, self._r
+        for t, x, y in samples[start:]:
+            dt = t - self._t
+            if dt > 0:
+                F, Q = self._transition(dt)
+                state[:] = F @ state
+                cov = F @ cov @ F.T + Q
+                self._t = t
+            # measurement update for both axes at once
+            gain = cov @ H / (H @ cov @ H + r)
+            state += np.outer(gain, (x, y) - state[0])
+            cov = cov - np.outer(gain, H @ cov)
+        self._cov = cov
+
+    def predict(self, t):
+        if self._t is None:
+            return None
+        x, y = self._state[0] + self._state[1] * (t - self._t)
+        return (x, y)
+
+
+def load_gaze_trace(path):
+    '''
+    Load a recorded gaze trace as an (n, 3) array of (timestamp, x, y) from a .npy
+    file or a comma-separated text file with those three columns.
+    '''
+    if path.endswith('.npy'):
+        trace = np.load(path)
+    else:
+        trace = np.loadtxt(path, delimiter=',', ndmin=2)
+    return np.asarray(trace, dtype=np.float64)[:, :3]
+
+
+def evaluate_predictor(predictor, trace, horizon, batch=1):
+    '''
+    Replay a recorded gaze trace through predictor and report the error of its
+    predictions horizon seconds ahead, compared with simply holding the last
+    sample. The ground truth at each target time is linearly interpolated from
+    the trace; targets past the end of the trace are skipped.
+
+    predictor: a GazePredictor (it is reset first)
+    trace: (n, 3) array of (timestamp, x, y), or a path for load_gaze_trace()
+    horizon: prediction horizon in seconds
+    batch: number of samples delivered per update, mimicking several packets
+        arriving between two frames
+
+    Returns a dict of error statistics in normalized screen units.
+    '''
+    if isinstance(trace, str):
+        trace = load_gaze_trace(trace)
+    trace = np.asarray(trace, dtype=np.float64)
+    times = trace[:, 0]
+    predictor.reset()
+
+    ends = np.arange(batch, len(trace) + 1, batch)
+    ends = ends[times[ends - 1] + horizon <= times[-1]]
+    predicted = np.empty((len(ends), 2))
+    start = 0
+    for i, end in enumerate(ends):
+        predictor.update(trace[start:end])
+        predicted[i] = predictor.predict(times[end - 1] + horizon)
+        start = end
+
+    targets = times[ends - 1] + horizon
+    truth = np.column_stack((np.interp(targets, times, trace[:, 1]),
+                             np.interp(targets, times, trace[:, 2])))
+    error = np.hypot(*(predicted - truth).T)
+    hold_error = np.hypot(*(trace[ends - 1, 1:] - truth).T)
+    if len(error) == 0:
+        return {'n': 0}
+    return {
+        'n': len(error),
+        'horizon': horizon,
+        'mean': float(error.mean()),
+        'median': float(np.median(error)),
+        'p95': float(np.percentile(error, 95)),
+        'max': float(error.max()),
+        'rmse': float(np.sqrt(np.mean(error ** 2))),
+        'hold_mean': float(hold_error.mean()),
+        'hold_p95': float(np.percentile(hold_error, 95)),
+    }
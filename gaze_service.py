@@ -0,0 +1,381 @@
+'''
+Out-of-process gaze acquisition.
+
+Experiment.EyeTracker receives and parses gaze packets on a thread of the
+experiment's own interpreter, where it competes for the GIL with image
+processing. GazeService moves that work into a separate process, which
+publishes the most recent samples through a seqlock-protected shared memory
+slot (see seqlock.py). Reading gaze is then a short memory copy, with no lock
+or syscall, on the frame loop's side.
+
+The slot is owned by the GazeService, so it outlives the acquisition process.
+A supervisor thread restarts the process if it dies or the tracker
+disconnects; the new process resumes from the samples already published.
+
+Timestamps are time.perf_counter() values of the acquisition process, which
+share a system-wide clock with the experiment process (CLOCK_MONOTONIC on
+Linux, QueryPerformanceCounter on Windows).
+
+Slot payload:
+    uint64 count          (total number of samples ever written)
+    uint64 record_count   (total number of binocular records ever written)
+    uint64 receive_count  (total number of receive timings ever written)
+    float64[capacity, 3]  ring of (timestamp, x, y) rows
+    float64[capacity]     ring of receive timings in seconds (see GazeReceiver)
+    GAZE_RECORD_DTYPE[capacity]  ring of binocular records
+'''
+
+import multiprocessing
+import socket
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+from gaze import GAZE_PACKET_FORMATS, GAZE_RECORD_DTYPE, GazeReceiver, kill_process_tree
+from instrumentation import NULL_INSTRUMENTATION
+from seqlock import SeqlockSlot
+
+_COUNTS_SIZE = 24
+# indices of the payload counters
+_SAMPLES, _RECORDS, _RECEIVES = range(3)
+
+
+def payload_size(capacity):
+    ''' Size in bytes of the slot payload for rings of capacity entries '''
+    return _COUNTS_SIZE + capacity * (24 + 8 + GAZE_RECORD_DTYPE.itemsize)
+
+
+def _payload_views(payload, capacity):
+    ''' (counts, samples, receive timings, records) views of a slot payload array '''
+    counts = payload[:_COUNTS_SIZE].view(np.uint64)
+    start = _COUNTS_SIZE
+    ring = payload[start:start + capacity * 24].view(np.float64).reshape(capacity, 3)
+    start += capacity * 24
+    receives = payload[start:start + capacity * 8].view(np.float64)
+    start += capacity * 8
+    records = payload[start:start + capacity * GAZE_RECORD_DTYPE.itemsize].view(GAZE_RECORD_DTYPE)
+    return counts, ring, receives, records
+
+
+def _ordered(ring, count, capacity):
+    ''' The entries of a ring that count entries were ever written to, oldest first '''
+    n = min(count, capacity)
+    return np.roll(ring, -((count - n) % capacity), axis=0)[:n]
+
+
+class SharedMemoryGazeWriter(object):
+    '''
+    Has the GazeBuffer push() interface, so a GazeReceiver can feed it, but
+    publishes the rings of recent samples and binocular records into a seqlock
+    slot after every batch. Starts from whatever the slot already holds.
+    Passed as the receiver's instrumentation, it also keeps its 'gaze_receive'
+    timings, which go out with the next batch.
+    '''
+
+    enabled = True
+
+    def __init__(self, slot, capacity):
+        self._slot = slot
+        self._capacity = capacity
+        self._payload = np.zeros(slot.size, dtype=np.uint8)
+        slot.read(self._payload)
+        self._counts, self._ring, self._receives, self._records = _payload_views(self._payload, capacity)
+
+    def push(self, timestamps, xs, ys, records=None):
+        capacity = self._capacity
+        counts = self._counts
+        timestamps = np.atleast_1d(timestamps)[-capacity:]
+        n = len(timestamps)
+        if records is not None and len(records):
+            records = records[-capacity:]
+            self._records[(int(counts[_RECORDS]) + np.arange(len(records))) % capacity] = records
+            counts[_RECORDS] += len(records)
+        elif n == 0:
+            return
+        if n:
+            idx = (int(counts[_SAMPLES]) + np.arange(n)) % capacity
+            self._ring[idx, 0] = timestamps
+            self._ring[idx, 1] = np.atleast_1d(xs)[-capacity:]
+            self._ring[idx, 2] = np.atleast_1d(ys)[-capacity:]
+            counts[_SAMPLES] += n
+        self._slot.write(self._payload)
+
+    def record(self, stage, start, end=None):
+        if end is None:
+            end = time.perf_counter()
+        self._receives[int(self._counts[_RECEIVES]) % self._capacity] = end - start
+        self._counts[_RECEIVES] += 1
+
+
+class SharedMemoryGazeReader(object):
+    '''
+    Reads the samples published by a SharedMemoryGazeWriter, with the same
+    get_gaze_pos(), latest(), since() and records_since() as
+    Experiment.EyeTracker. Each call takes a new snapshot if one was published,
+    into the buffer that the call before last read from, so calls must not
+    overlap: use it from one thread, or serialize the calls as GazeService does.
+    '''
+
+    def __init__(self, name, capacity):
+        self._slot = SeqlockSlot(name)
+        self._capacity = capacity
+        # snapshots are taken into the spare payload, so a failed read never tears the current one
+        self._payloads = [np.zeros(self._slot.size, dtype=np.uint8) for _ in range(2)]
+        self._views = [_payload_views(payload, capacity) for payload in self._payloads]
+        self._current = 0
+        self._counts, self._ring, self._receives, self._records = self._views[0]
+        self._last_sequence = None
+        self._receives_taken = None
+
+    def _refresh(self):
+        spare = 1 - self._current
+        sequence = self._slot.read(self._payloads[spare], self._last_sequence)
+        if sequence is not None:
+            self._last_sequence = sequence
+            self._current = spare
+            self._counts, self._ring, self._receives, self._records = self._views[spare]
+
+    def latest(self):
+        self._refresh()
+        count = int(self._counts[_SAMPLES])
+        if count == 0:
+            return None
+        t, x, y = self._ring[(count - 1) % self._capacity]
+        return (t, x, y)
+
+    def get_gaze_pos(self):
+        sample = self.latest()
+        if sample is None:
+            return (np.nan, np.nan)
+        return (sample[1], sample[2])
+
+    def since(self, t):
+        self._refresh()
+        ordered = _ordered(self._ring, int(self._counts[_SAMPLES]), self._capacity)
+        first = np.searchsorted(ordered[:, 0], t, side='right')
+        return ordered[first:].copy()
+
+    def latest_record(self):
+        ''' The newest binocular gaze.GAZE_RECORD_DTYPE record (a copy), or None '''
+        self._refresh()
+        count = int(self._counts[_RECORDS])
+        if count == 0:
+            return None
+        return self._records[(count - 1) % self._capacity].copy()
+
+    def records_since(self, t):
+        ''' Binocular records with timestamp strictly greater than t, oldest first (a copy) '''
+        self._refresh()
+        ordered = _ordered(self._records, int(self._counts[_RECORDS]), self._capacity)
+        first = np.searchsorted(ordered['timestamp'], t, side='right')
+        return ordered[first:].copy()
+
+    def take_receive_timings(self):
+        '''
+        The receive timings (seconds) of the current snapshot that no earlier call
+        returned; the first call returns none, so only timings of this reader's
+        lifetime are reported.
+        '''
+        count = int(self._counts[_RECEIVES])
+        if self._receives_taken is None:
+            self._receives_taken = count
+        n = min(count - self._receives_taken, self._capacity)
+        self._receives_taken = count
+        ordered = _ordered(self._receives, count, self._capacity)
+        return ordered[len(ordered) - n:]
+
+    @property
+    def retries(self):
+        ''' Number of reads that had to be retried because a write was in progress '''
+        return self._slot.retries
+
+    def close(self):
+        self._slot.close()
+
+
+def run_acquisition(slot_name, host, port, capacity, packet_format='legacy', sample_rate=120.0,
+                    instrumented=False):
+    '''
+    Entry point of the acquisition process: accept a connection from the Pupil
+    Capture plugin and publish its samples until it disconnects. instrumented
+    also publishes the receiver's timings.
+    '''
+    slot = SeqlockSlot(slot_name)
+    writer = SharedMemoryGazeWriter(slot, capacity)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen()
+    conn, _ = listener.accept()
+    listener.close()
+    try:
+        GazeReceiver(conn, writer, packet_dtype=GAZE_PACKET_FORMATS[packet_format],
+                     instrumentation=writer if instrumented else NULL_INSTRUMENTATION,
+                     sample_rate=sample_rate).run()
+    finally:
+        conn.close()
+        slot.close()
+
+
+class GazeService(object):
+    '''
+    Acquires gaze in a child process, with the interface of Experiment.EyeTracker
+    (except receiver: the packet counters live in the child process). Pupil
+    Capture (if launched) is a child of this process, so it is not restarted
+    along with the acquisition process. Its methods may be called from any thread.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8888, pupil_path="pupil_capture\\pupil_capture.exe",
+                 capacity=64, first_sample_timeout=10.0, restart=True, restart_delay=0.5,
+                 max_restarts=None, packet_format='legacy', sample_rate=120.0,
+                 instrumentation=NULL_INSTRUMENTATION):
+        '''
+        capacity: number of recent samples (and binocular records) published;
+            since() and records_since() can only return those newer than the oldest
+        restart: restart the acquisition process when it exits while running
+        restart_delay: seconds to wait before restarting
+        max_restarts: give up after this many restarts (None: never)
+        packet_format: gaze packet format sent by the tracker (see gaze.py)
+        sample_rate: the tracker's nominal gaze rate (Hz), see Experiment.EyeTracker
+        instrumentation: receives the acquisition process's 'gaze_receive' timings,
+            as they are read along with the gaze
+        start() creates the slot, launches Pupil Capture and the acquisition process.
+        '''
+        if packet_format not in GAZE_PACKET_FORMATS:
+            raise ValueError("Unknown gaze packet format: %s" % packet_format)
+        self._host = host
+        self._port = port
+        self._pupil_path = pupil_path
+        self._capacity = int(capacity)
+        self._first_sample_timeout = first_sample_timeout
+        self._restart = restart
+        self._restart_delay = restart_delay
+        self._max_restarts = max_restarts
+        self._packet_format = packet_format
+        self._sample_rate = sample_rate
+        self._instrumentation = instrumentation
+        # spawn rather than fork: the experiment process runs threads, and Windows can only spawn
+        self._context = multiprocessing.get_context('spawn')
+        self._slot = None
+        self._reader = None
+        # the reader's snapshots are shared by all callers, e.g. the capture and main threads
+        self._lock = threading.Lock()
+        self._process = None
+        self._pupil_handle = None
+        self._supervisor = None
+        self._stopping = threading.Event()
+        self.restarts = 0
+        self.last_exitcode = None
+
+    def start(self):
+        '''
+        Start acquiring. Blocks until the first sample arrives (or
+        first_sample_timeout passes). Returns self.
+        '''
+        self._slot = SeqlockSlot(size=payload_size(self._capacity), create=True)
+        self._reader = SharedMemoryGazeReader(self._slot.name, self._capacity)
+        self._pupil_handle = subprocess.Popen(self._pupil_path) if self._pupil_path else None
+        self._spawn()
+        self._supervisor = threading.Thread(target=self._supervise, name='GazeServiceSupervisor',
+                                            daemon=True)
+        self._supervisor.start()
+
+        deadline = time.perf_counter() + self._first_sample_timeout
+        while self.latest() is None and time.perf_counter() < deadline:
+            time.sleep(0.001)
+        if self.latest() is None:
+            print("No gaze data received from Pupil Capture")
+        return self
+
+    def _spawn(self):
+        self._process = self._context.Process(
+            target=run_acquisition,
+            args=(self._slot.name, self._host, self._port, self._capacity, self._packet_format,
+                  self._sample_rate, self._instrumentation.enabled),
+            name='GazeAcquisition', daemon=True)
+        self._process.start()
+
+    def _supervise(self):
+        from multiprocessing.connection import wait
+        while not self._stopping.is_set():
+            wait([self._process.sentinel], timeout=0.1)
+            if self._process.is_alive() or self._stopping.is_set():
+                continue
+            self.last_exitcode = self._process.exitcode
+            if not self._restart or (self._max_restarts is not None
+                                     and self.restarts >= self._max_restarts):
+                return
+            self._slot.recover()
+            if self._stopping.wait(self._restart_delay):
+                return
+            self.restarts += 1
+            self._spawn()
+
+    def _read(self, method, *args):
+        ''' Call a reader method, and hand the receive timings it brought in to the instrumentation '''
+        with self._lock:
+            result = method(*args)
+            if self._instrumentation.enabled:
+                for seconds in self._reader.take_receive_timings():
+                    self._instrumentation.record_duration('gaze_receive', seconds)
+            return result
+
+    def is_alive(self):
+        ''' True while the acquisition process is running '''
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def pid(self):
+        ''' Process id of the current acquisition process '''
+        return self._process.pid if self._process is not None else None
+
+    def get_gaze_pos(self):
+        return self._read(self._reader.get_gaze_pos)
+
+    def latest(self):
+        return self._read(self._reader.latest)
+
+    def since(self, t):
+        return self._read(self._reader.since, t)
+
+    @property
+    def binocular(self):
+        ''' True if the tracker sends both eyes (packet_format='binocular') '''
+        return self._packet_format == 'binocular'
+
+    def get_binocular_gaze(self):
+        ''' The most recent gaze of each eye as a (2, 2) array, as Experiment.EyeTracker.get_binocular_gaze '''
+        reader = self._reader
+        record, combined = self._read(lambda: (reader.latest_record(), reader.get_gaze_pos()))
+        if record is None:
+            return np.array([combined, combined])
+        return np.where(record['valid'][:, np.newaxis], record['gaze'], combined)
+
+    def records_since(self, t):
+        ''' The binocular gaze.GAZE_RECORD_DTYPE records newer than t, as Experiment.EyeTracker.records_since '''
+        return self._read(self._reader.records_since, t)
+
+    def stop(self):
+        ''' Stop the supervisor and the acquisition process, free the slot and kill Pupil Capture '''
+        self._stopping.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+            self._supervisor = None
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._slot is not None:
+            self._slot.close()
+            self._slot = None
+        if self._pupil_handle is not None:
+            kill_process_tree(self._pupil_handle.pid)
+            self._pupil_handle = None
+
+    def __del__(self):
+        self.stop()
@@ -0,0 +1,206 @@
+'''
+Per-stage latency instrumentation for the frame loop.
+
+Each stage of the loop (gaze receive, pose fetch, pose send, Spout capture,
+processing, display submit) records its duration into its own log-binned
+histogram. Every stage is only ever recorded from one thread, so histograms
+are updated without locks. Summaries report percentiles per stage, frame drop
+counters and an estimate of the motion-to-photon latency, and can be exported
+to JSON or CSV after a session.
+
+Pass NULL_INSTRUMENTATION (the default everywhere) to turn instrumentation
+off: its methods do nothing and stamp() does not even read the clock.
+'''
+
+import csv
+import json
+import math
+import time
+
+import numpy as np
+
+STAGES = ('gaze_receive', 'pose_fetch', 'pose_send', 'capture', 'process', 'display')
+# derived measurements recorded alongside the stages
+GAZE_AGE = 'gaze_age'
+MOTION_TO_PHOTON = 'motion_to_photon'
+
+
+class StageHistogram(object):
+    '''
+    Histogram of durations with logarithmically spaced bins between min_time and
+    max_time seconds, plus a ring of the most recent raw samples. Not thread
+    safe: record() must only be called from one thread. Counts are kept in plain
+    lists, which are cheaper to update one sample at a time than numpy arrays.
+    '''
+
+    def __init__(self, min_time=1e-6, max_time=1.0, bins_per_decade=50, sample_capacity=4096):
+        self._min_time = min_time
+        self._scale = bins_per_decade / math.log(10)
+        n_bins = int(math.ceil(math.log(max_time / min_time) * self._scale)) + 1
+        self._edges = min_time * np.exp(np.arange(n_bins + 1) / self._scale)
+        self._counts = [0] * n_bins
+        self._samples = [0.0] * sample_capacity
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration):
+        if duration > self._min_time:
+            i = min(int(math.log(duration / self._min_time) * self._scale), len(self._counts) - 1)
+        else:
+            i = 0
+        self._counts[i] += 1
+        if len(self._samples):
+            self._samples[self.count % len(self._samples)] = duration
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, q):
+        ''' Approximate q-th percentile (0-100) in seconds, from the bin geometric centers '''
+        if self.count == 0:
+            return float('nan')
+        cumulative = np.cumsum(self._counts)
+        i = min(int(np.searchsorted(cumulative, q / 100.0 * self.count)), len(self._counts) - 1)
+        return float(min(math.sqrt(self._edges[i] * self._edges[i + 1]), self.max))
+
+    def samples(self):
+        ''' Most recent raw samples in seconds, oldest first '''
+        n = min(self.count, len(self._samples))
+        start = (self.count - n) % max(len(self._samples), 1)
+        return np.roll(np.array(self._samples), -start)[:n]
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1e3,
+            'p50_ms': self.percentile(50) * 1e3,
+            'p90_ms': self.percentile(90) * 1e3,
+            'p99_ms': self.percentile(99) * 1e3,
+            'max_ms': self.max * 1e3,
+        }
+
+    def to_dict(self):
+        counts = np.array(self._counts)
+        nonzero = np.nonzero(counts)[0]
+        return {
+            'summary': self.summary(),
+            'bin_upper_edges_s': self._edges[nonzero + 1].tolist(),
+            'bin_counts': counts[nonzero].tolist(),
+        }
+
+
+class Instrumentation(object):
+    '''
+    Collects stage timings for a session. Usage from a stage:
+
+        start = instrumentation.stamp()
+        ... do the work ...
+        instrumentation.record('capture', start)
+    '''
+
+    enabled = True
+
+    def __init__(self, stages=STAGES, sample_capacity=4096):
+        names = tuple(stages) + (GAZE_AGE, MOTION_TO_PHOTON)
+        self._histograms = dict((name, StageHistogram(sample_capacity=sample_capacity)) for name in names)
+        self._started = time.perf_counter()
+        self.frames = 0
+        self.frames_dropped = 0
+        self.frames_repeated = 0
+
+    def stamp(self):
+        ''' Current time for use as a stage start '''
+        return time.perf_counter()
+
+    def record(self, stage, start, end=None):
+        ''' Record that stage ran from start until end (default now) '''
+        if end is None:
+            end = time.perf_counter()
+        self._histograms[stage].record(float(end - start))
+
+    def record_duration(self, stage, seconds):
+        self._histograms[stage].record(float(seconds))
+
+    def frame_displayed(self):
+        self.frames += 1
+
+    def frame_dropped(self, n=1):
+        ''' Count frames that were captured but never displayed '''
+        self.frames_dropped += n
+
+    def frame_repeated(self):
+        ''' Count display updates that had no new frame to show '''
+        self.frames_repeated += 1
+
+    def histogram(self, stage):
+        return self._histograms[stage]
+
+    def summary(self):
+        elapsed = time.perf_counter() - self._started
+        stages = dict((name, hist.summary()) for name, hist in self._histograms.items())
+        return {
+            'elapsed_s': elapsed,
+            'frames': self.frames,
+            'fps': self.frames / elapsed if elapsed > 0 else 0.0,
+            'frames_dropped': self.frames_dropped,
+            'frames_repeated': self.frames_repeated,
+            'motion_to_photon_ms': stages[MOTION_TO_PHOTON],
+            'stages': stages,
+        }
+
+    def save_json(self, path, include_samples=False):
+        ''' Write the summary and the per-stage histograms (and raw samples) to JSON '''
+        data = self.summary()
+        data['histograms'] = dict((name, hist.to_dict()) for name, hist in self._histograms.items())
+        if include_samples:
+            data['samples_s'] = dict((name, hist.samples().tolist())
+                                     for name, hist in self._histograms.items())
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def save_csv(self, path):
+        ''' Write one row of summary statistics per stage to CSV '''
+        columns = ['count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage'] + columns)
+            for name, hist in self._histograms.items():
+                summary = hist.summary()
+                writer.writerow([name] + [summary.get(column, '') for column in columns])
+
+
+class NullInstrumentation(object):
+    '''
+    Disabled instrumentation with the same interface; every call is a no-op.
+    '''
+
+    enabled = False
+    frames = frames_dropped = frames_repeated = 0
+
+    def stamp(self):
+        return 0.0
+
+    def record(self, stage, start, end=None):
+        pass
+
+    def record_duration(self, stage, seconds):
+        pass
+
+    def frame_displayed(self):
+        pass
+
+    def frame_dropped(self, n=1):
+        pass
+
+    def frame_repeated(self):
+        pass
+
+    def summary(self):
+        return {}
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
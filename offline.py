@@ -0,0 +1,237 @@
+'''
+Offline stabilization of recorded sessions.
+
+Regenerating what a subject saw under other stabilization parameters (another
+calibration, the mask instead of the warp, more gaze latency) by replaying a
+recording through an ImageProcessor processes one frame at a time, on one
+core. OfflineStabilizer works on the whole recording instead. Every frame's
+gaze is mapped through the calibration in one vectorized pass. The frames are
+then split into chunks that a pool of processes stabilizes independently.
+Each process opens the recorded frames and the output file with np.memmap and
+writes its chunk straight into the output, so frames never go through a pipe
+and the processes share nothing but the page cache.
+
+The output is itself an uncompressed recording (see recording.py) with the
+source's gaze samples and poses, so it can be replayed, or stabilized again.
+'''
+
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+from calibration import Calibration, per_eye_calibrations
+from recording import SessionReader, write_metadata
+
+# per worker process: recordings and warp engines, reused by the chunks it processes
+_worker_cache = {}
+
+
+def _cached(key, create):
+    value = _worker_cache.get(key)
+    if value is None:
+        value = _worker_cache[key] = create()
+    return value
+
+
+def stabilize_chunk(source, destination, start, positions, options):
+    '''
+    Stabilize frames start to start + len(positions) of the recording at source
+    into the preallocated frames.bin of destination. positions holds each frame's
+    calibrated gaze per eye, as (n, eyes, 2) pixel coordinates of the eye's
+    viewport (NaN where there was no usable gaze: those frames are copied
+    unchanged). Runs in the worker processes; returns the number of frames.
+    '''
+    reader = _cached(('reader', source), lambda: SessionReader(source))
+    n, eyes = positions.shape[:2]
+    height, width = reader.height, reader.width
+    eye_width = width // eyes
+    out = np.memmap(os.path.join(destination, 'frames.bin'), dtype=np.uint8, mode='r+',
+                    offset=start * reader.frame_bytes, shape=(n, height, width))
+    frames = reader.frame_block(start, start + n)
+    valid = np.isfinite(positions).all(axis=(1, 2))
+
+    if options['stabilization'] == 'mask':
+        if frames is None:
+            for k in range(n):
+                reader.frame(start + k, out[k])
+        else:
+            np.copyto(out, frames)
+        # same square as ImageProcessor._mask_bounds, for the whole chunk at once
+        size = options['mask_size']
+        corners = np.trunc(np.where(valid[:, np.newaxis, np.newaxis], positions, 0)) - size // 2
+        xs = np.clip(corners[..., 0], 0, eye_width).astype(int)
+        ys = np.clip(corners[..., 1], 0, height).astype(int)
+        for k in np.flatnonzero(valid):
+            for eye in range(eyes):
+                x, y = xs[k, eye], ys[k, eye]
+                out[k, :, eye * eye_width:(eye + 1) * eye_width][y:y + size, x:x + size] = 0
+    else:
+        from warp import WarpEngine, shift
+        quantization = options['warp_quantization']
+        # same offsets as ImageProcessor._warp_frame (the viewport center moves onto the
+        # gaze), quantized like WarpEngine.quantize
+        offsets = np.round((positions - (eye_width / 2, height / 2)) / quantization) * quantization
+        if float(quantization).is_integer():
+            # whole-pixel offsets: a remap would only copy pixels
+            translators = [shift] * eyes
+        else:
+            translators = [_cached(('warp', eye, eye_width, height, options['warp_cache_size'], quantization),
+                                   lambda: WarpEngine(eye_width, height, cache_size=options['warp_cache_size'],
+                                                      quantization=quantization)).translate
+                           for eye in range(eyes)]
+        scratch = None
+        for k in range(n):
+            if frames is not None:
+                frame = frames[k]
+            else:
+                if scratch is None:
+                    scratch = np.empty((height, width), dtype=np.uint8)
+                frame = reader.frame(start + k, scratch)
+            if not valid[k]:
+                np.copyto(out[k], frame)
+                continue
+            for eye, (dx, dy) in enumerate(offsets[k]):
+                view = slice(eye * eye_width, (eye + 1) * eye_width)
+                translators[eye](frame[:, view], dx, dy, out[k, :, view])
+    # no flush: the mapping shares the page cache, so the output is visible to other
+    # processes as it is written, and the kernel writes it back in its own time
+    del out
+    return n
+
+
+class OfflineStabilizer(object):
+    '''
+    Applies a stabilization to every frame of a recording made with
+    record_frames, writing the result as a new recording:
+
+        stabilizer = OfflineStabilizer(calibration, stabilization='warp')
+        stats = stabilizer.run('sessions/s01', 'sessions/s01_warp')
+    '''
+
+    def __init__(self, calibration=None, stabilization='mask', binocular=False, mask_size=500,
+                 warp_cache_size=8, warp_quantization=1.0, gaze='recorded', gaze_latency=0.0,
+                 chunk_size=16, workers=None):
+        '''
+        calibration: a calibration.Calibration (or a list of one per eye), or a bare
+            2x2 eye_to_screen_transform; the identity mapping by default
+        stabilization: 'mask' or 'warp', as in Experiment.ImageProcessor
+        binocular: the left and right halves of the frames are the eyes' viewports
+        mask_size: side of the square blanked in 'mask' mode, in pixels
+        warp_cache_size, warp_quantization: see warp.WarpEngine
+        gaze: 'recorded' processes each frame with the gaze it was processed with
+            during the session, 'samples' with the last gaze sample recorded
+            gaze_latency seconds before the frame was captured (with gaze_latency 0,
+            what replaying the recording through an ImageProcessor does)
+        chunk_size: frames per task handed to a worker process
+        workers: worker processes; None uses one per core, 0 processes all chunks
+            in this process
+        '''
+        if stabilization not in ('mask', 'warp'):
+            raise ValueError("Unknown stabilization mode: %s" % stabilization)
+        if gaze not in ('recorded', 'samples'):
+            raise ValueError("Unknown gaze source: %s" % gaze)
+        self._eyes = 2 if binocular else 1
+        self._calibrations = per_eye_calibrations(
+            calibration if calibration is not None else Calibration(), self._eyes)
+        self._gaze = gaze
+        self._gaze_latency = float(gaze_latency)
+        self._chunk_size = max(int(chunk_size), 1)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._workers = int(workers)
+        self._options = {
+            'stabilization': stabilization,
+            'mask_size': int(mask_size),
+            'warp_cache_size': int(warp_cache_size),
+            'warp_quantization': float(warp_quantization),
+        }
+
+    @property
+    def parameters(self):
+        ''' The stabilization parameters, as stored in the output's session.json '''
+        parameters = dict(self._options, eyes=self._eyes, gaze=self._gaze,
+                          gaze_latency=self._gaze_latency)
+        parameters['calibrations'] = [calibration.to_dict() for calibration in self._calibrations]
+        return parameters
+
+    def frame_gaze(self, reader):
+        ''' The uncalibrated gaze of each frame of a SessionReader, as an (n, 2, 2) array (one row per eye) '''
+        records = reader.frame_records
+        if self._gaze == 'recorded':
+            return np.array(records['gaze'])
+        samples = reader.gaze
+        latest = np.searchsorted(samples['timestamp'], records['timestamp'] - self._gaze_latency,
+                                 side='right') - 1
+        gaze = np.full((len(records), 2, 2), np.nan)
+        found = latest >= 0
+        gaze[found, :, 0] = samples['x'][latest[found], np.newaxis]
+        gaze[found, :, 1] = samples['y'][latest[found], np.newaxis]
+        return gaze
+
+    def positions(self, reader):
+        '''
+        The calibrated gaze of each frame and eye in pixels of the eye's viewport (x
+        to the right, y down), as an (n, eyes, 2) array, as
+        ImageProcessor._gaze_to_screen computes it for one frame.
+        '''
+        gaze = self.frame_gaze(reader)
+        eye_width = reader.width // self._eyes
+        positions = np.empty((len(gaze), self._eyes, 2))
+        for eye, calibration in enumerate(self._calibrations):
+            screen = calibration.map(gaze[:, eye])
+            positions[:, eye, 0] = screen[:, 0] * eye_width
+            positions[:, eye, 1] = (1 - screen[:, 1]) * reader.height
+        return positions
+
+    def run(self, source, destination):
+        '''
+        Stabilize every frame of the recording at source into a new recording at
+        destination (a directory that must not exist yet). Returns statistics: the
+        number of frames and chunks, the seconds taken and frames per second.
+        '''
+        reader = SessionReader(source)
+        n = len(reader)
+        if n == 0:
+            raise ValueError("Recording has no frames: %s" % source)
+        positions = self.positions(reader)
+        frame_bytes = reader.frame_bytes
+
+        os.makedirs(destination)
+        counts = {'gaze': len(reader.gaze), 'poses': len(reader.poses), 'frames': 0, 'dropped': 0}
+        write_metadata(destination, reader.width, reader.height, True, None, False, counts,
+                       source=os.path.abspath(source), stabilization=self.parameters)
+        for name in ('gaze.bin', 'poses.bin'):
+            if os.path.exists(os.path.join(source, name)):
+                shutil.copyfile(os.path.join(source, name), os.path.join(destination, name))
+        # preallocate the output, which the workers map and fill in place
+        with open(os.path.join(destination, 'frames.bin'), 'wb') as f:
+            f.truncate(n * frame_bytes)
+
+        starts = range(0, n, self._chunk_size)
+        tasks = [(source, destination, start, positions[start:start + self._chunk_size], self._options)
+                 for start in starts]
+        t0 = time.perf_counter()
+        if self._workers == 0:
+            for task in tasks:
+                stabilize_chunk(*task)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn, as everywhere else in the project, so this also runs on Windows
+            with ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                list(pool.map(stabilize_chunk, *zip(*tasks)))
+        elapsed = time.perf_counter() - t0
+
+        # the index goes last, so an interrupted run does not look like a complete recording
+        records = np.array(reader.frame_records)
+        records['offset'] = np.arange(n) * frame_bytes
+        records['size'] = frame_bytes
+        records.tofile(os.path.join(destination, 'frames.idx'))
+        counts['frames'] = n
+        write_metadata(destination, reader.width, reader.height, True, None, True, counts,
+                       source=os.path.abspath(source), stabilization=self.parameters)
+        reader.close()
+        return {'frames': n, 'chunks': len(tasks), 'workers': self._workers,
+                'seconds': elapsed, 'fps': n / elapsed}
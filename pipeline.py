@@ -0,0 +1,212 @@
+'''
+Pipelined frame loop. Capture and processing run on their own worker threads,
+connected by bounded queues, while display stays on the caller's thread (cv2
+windows must be driven from the thread that created them). Frame N can be
+processed while frame N+1 is captured and frame N-1 is on screen, so the frame
+time approaches the slowest stage instead of the sum of all of them.
+
+Frames are pooled buffers (see frame_sources.FramePool); with a pool of three
+buffers one is being captured, one processed and one displayed, i.e. triple
+buffering. Once all are in flight, capture waits for display to hand one back.
+'''
+
+import queue
+import threading
+
+_STOP = object()
+
+
+class StageQueue(object):
+    '''
+    Bounded hand-off between two stages. With drop_stale set, putting into a full
+    queue discards the oldest waiting frame (returning its buffer through
+    release) instead of blocking the producer, so consumers always see the
+    freshest frame.
+    '''
+
+    def __init__(self, maxsize, release, drop_stale=True):
+        self._queue = queue.Queue(maxsize)
+        self._release = release
+        self._drop_stale = drop_stale
+        self.dropped = 0
+
+    def put(self, item, stop_event, poll_interval=0.05):
+        while not stop_event.is_set():
+            try:
+                if self._drop_stale:
+                    self._queue.put_nowait(item)
+                else:
+                    self._queue.put(item, timeout=poll_interval)
+                return True
+            except queue.Full:
+                if not self._drop_stale:
+                    continue
+            try:
+                stale = self._queue.get_nowait()
+            except queue.Empty:
+                continue
+            self._release(stale)
+            self.dropped += 1
+        return False
+
+    def put_nowait(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            pass
+
+    def get(self, timeout=None):
+        ''' Return the next item, or None on timeout '''
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_latest(self, timeout=None):
+        '''
+        Return the newest item, releasing any older ones that are still queued.
+        Returns None on timeout.
+        '''
+        item = self.get(timeout)
+        while item is not None and item is not _STOP:
+            try:
+                newer = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if newer is _STOP:
+                self._queue.put_nowait(_STOP)
+                break
+            self._release(item)
+            self.dropped += 1
+            item = newer
+        return item
+
+    def drain(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP:
+                self._release(item)
+
+
+class FramePipeline(object):
+    '''
+    Runs capture() and process(frame) on two worker threads. The display side calls
+    get_frame() to receive finished frames and done_with(frame) once it has shown
+    them. release(frame) returns a frame's buffer to its pool and is also used for
+    frames dropped as stale.
+    '''
+
+    def __init__(self, capture, process, release, depth=1, drop_stale=True, poll_interval=0.05):
+        '''
+        capture: callable returning a new Frame (or None if no frame is available)
+        process: callable processing a Frame and returning the Frame to display, or
+            None if it had to drop (and release) the frame
+        release: callable returning a Frame's buffer to the pool
+        depth: capacity of each inter-stage queue
+        drop_stale: drop the oldest queued frame instead of waiting when a queue is full
+        '''
+        self._capture = capture
+        self._process = process
+        self._release = release
+        self._drop_stale = drop_stale
+        self._poll_interval = poll_interval
+        self._captured = StageQueue(depth, release, drop_stale)
+        self._processed = StageQueue(depth, release, drop_stale)
+        self._stop_event = threading.Event()
+        self._threads = []
+        self.error = None
+        self.frames_captured = 0
+        self.frames_processed = 0
+        self._process_dropped = 0
+
+    @property
+    def frames_dropped(self):
+        return self._captured.dropped + self._processed.dropped + self._process_dropped
+
+    def start(self):
+        self._stop_event.clear()
+        self._threads = [
+            threading.Thread(target=self._capture_loop, name='CaptureStage', daemon=True),
+            threading.Thread(target=self._process_loop, name='ProcessStage', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=2.0):
+        '''
+        Stop both stages, wait for them to exit and return every frame still held
+        by the pipeline to the pool.
+        '''
+        self._stop_event.set()
+        self._captured.put_nowait(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._captured.drain()
+        self._processed.drain()
+
+    def is_running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def get_frame(self, timeout=None):
+        '''
+        Return the next processed frame, or None if none became ready within timeout.
+        With drop_stale, older finished frames are skipped in favour of the newest.
+        Re-raises the error of a failed stage.
+        '''
+        if self.error is not None:
+            raise self.error
+        if self._drop_stale:
+            frame = self._processed.get_latest(timeout)
+        else:
+            frame = self._processed.get(timeout)
+        if frame is _STOP:
+            if self.error is not None:
+                raise self.error
+            return None
+        return frame
+
+    def done_with(self, frame):
+        ''' Hand a displayed frame back to the pool '''
+        self._release(frame)
+
+    def _fail(self, err):
+        if self.error is None:
+            self.error = err
+        self._stop_event.set()
+        self._captured.put_nowait(_STOP)
+        self._processed.put_nowait(_STOP)
+
+    def _capture_loop(self):
+        try:
+            while not self._stop_event.is_set():
+                frame = self._capture()
+                if frame is None:
+                    continue
+                self.frames_captured += 1
+                if not self._captured.put(frame, self._stop_event, self._poll_interval):
+                    self._release(frame)
+        except Exception as err:
+            self._fail(err)
+
+    def _process_loop(self):
+        try:
+            while not self._stop_event.is_set():
+                frame = self._captured.get(self._poll_interval)
+                if frame is None:
+                    continue
+                if frame is _STOP:
+                    break
+                frame = self._process(frame)
+                if frame is None:
+                    self._process_dropped += 1
+                    continue
+                self.frames_processed += 1
+                if not self._processed.put(frame, self._stop_event, self._poll_interval):
+                    self._release(frame)
+        except Exception as err:
+            self._fail(err)
@@ -0,0 +1,395 @@
+'''
+Vectorized tracked-device pose conversion and pose history.
+
+OpenVR reports every tracked device (HMD, controllers, trackers) as a 3x4
+device-to-absolute matrix. poses_to_arrays() converts all of them to positions
+and quaternions in one numpy pass, and PoseHistory keeps a timestamped ring
+buffer of the results that can be interpolated at any time, e.g. to align
+poses with gaze samples.
+
+Conventions match what PositionSender sends to Unity: quaternions are
+(w, x, y, z) and, like positions, are converted from OpenVR's right-handed
+frame to Unity's left-handed one by flipping the z axis.
+'''
+
+import collections
+import ctypes
+import threading
+
+import numpy as np
+
+_POSE_DTYPES = {}
+
+
+def _pose_dtype(struct_type):
+    '''
+    numpy dtype viewing the fields of an OpenVR TrackedDevicePose_t ctypes structure
+    that are needed here, built from the structure's own field offsets.
+    '''
+    dtype = _POSE_DTYPES.get(struct_type)
+    if dtype is None:
+        dtype = np.dtype({
+            'names': ['matrix', 'velocity', 'angular_velocity', 'valid'],
+            'formats': [('<f4', (3, 4)), ('<f4', (3,)), ('<f4', (3,)), '?'],
+            'offsets': [struct_type.mDeviceToAbsoluteTracking.offset,
+                        struct_type.vVelocity.offset,
+                        struct_type.vAngularVelocity.offset,
+                        struct_type.bPoseIsValid.offset],
+            'itemsize': ctypes.sizeof(struct_type),
+        })
+        _POSE_DTYPES[struct_type] = dtype
+    return dtype
+
+
+def pose_array_view(poses):
+    '''
+    Zero-copy structured view (fields matrix, velocity, angular_velocity, valid)
+    of the ctypes TrackedDevicePose_t array returned by
+    IVRSystem.getDeviceToAbsoluteTrackingPose.
+    '''
+    return np.frombuffer(poses, dtype=_pose_dtype(poses._type_))
+
+
+def pose_matrices(poses):
+    '''
+    Return the device-to-absolute matrices of all devices as an (n, 3, 4) array,
+    together with an (n,) boolean array of pose validity. Accepts the ctypes
+    array from OpenVR or an array-like of shape (n, 3, 4) (assumed valid).
+    '''
+    if isinstance(poses, ctypes.Array):
+        view = pose_array_view(poses)
+        return view['matrix'], view['valid']
+    matrices = np.asarray(poses, dtype=np.float32)
+    return matrices, np.ones(len(matrices), dtype=bool)
+
+
+def poses_to_arrays(matrices, positions=None, rotations=None):
+    '''
+    Convert (n, 3, 4) device-to-absolute matrices to (n, 3) positions and (n, 4)
+    (w, x, y, z) quaternions in one pass. positions and rotations may be
+    preallocated float arrays to write into. See
+    http://www.allenchou.net/2014/04/game-math-quaternion-basics/ for details
+    on the matrix to quaternion conversion.
+    '''
+    m = np.asarray(matrices)
+    n = len(m)
+    if positions is None:
+        positions = np.empty((n, 3))
+    if rotations is None:
+        rotations = np.empty((n, 4))
+
+    positions[:] = m[:, :, 3]
+    # The -z is so that the movement in physical space matches movement in virtual space
+    positions[:, 2] *= -1
+
+    m00, m11, m22 = m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]
+    rotations[:, 0] = 1 + m00 + m11 + m22
+    rotations[:, 1] = 1 + m00 - m11 - m22
+    rotations[:, 2] = 1 - m00 + m11 - m22
+    rotations[:, 3] = 1 - m00 - m11 + m22
+    np.fmax(rotations, 0, out=rotations)
+    np.sqrt(rotations, out=rotations)
+    rotations *= 0.5
+    np.copysign(rotations[:, 1], m[:, 2, 1] - m[:, 1, 2], out=rotations[:, 1])
+    np.copysign(rotations[:, 2], m[:, 0, 2] - m[:, 2, 0], out=rotations[:, 2])
+    np.copysign(rotations[:, 3], m[:, 1, 0] - m[:, 0, 1], out=rotations[:, 3])
+    # flip sign of w and z so that physical and virtual coordinate systems match
+    rotations[:, 0] *= -1
+    rotations[:, 3] *= -1
+    return positions, rotations
+
+
+def slerp(q0, q1, alpha):
+    '''
+    Spherical linear interpolation between arrays of (w, x, y, z) quaternions
+    q0 and q1 (shape (..., 4)) by alpha (scalar or broadcastable to (...)).
+    Takes the shorter arc and falls back to normalized lerp for nearly equal
+    rotations.
+    '''
+    q0 = np.asarray(q0, dtype=np.float64)
+    q1 = np.asarray(q1, dtype=np.float64)
+    alpha = np.asarray(alpha, dtype=np.float64)[..., np.newaxis]
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    small = sin_theta < 1e-6
+    safe = np.where(small, 1.0, sin_theta)
+    w0 = np.where(small, 1 - alpha, np.sin((1 - alpha) * theta) / safe)
+    w1 = np.where(small, alpha, np.sin(alpha * theta) / safe)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=-1, keepdims=True)
+
+
+class PoseHistory(object):
+    '''
+    Preallocated ring buffer of timestamped poses for all tracked devices.
+    Each entry stores (n_devices, 3) positions, (n_devices, 4) rotations and a
+    validity mask, so tracking controllers and trackers costs the same single
+    array copy per frame as tracking the HMD alone.
+    '''
+
+    def __init__(self, capacity=256, n_devices=64):
+        self._capacity = int(capacity)
+        self._n_devices = int(n_devices)
+        self._timestamps = np.zeros(self._capacity)
+        self._positions = np.zeros((self._capacity, self._n_devices, 3))
+        self._rotations = np.zeros((self._capacity, self._n_devices, 4))
+        self._valid = np.zeros((self._capacity, self._n_devices), dtype=bool)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self._capacity)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def push(self, timestamp, positions, rotations, valid=True):
+        ''' Record the poses of all devices at timestamp (seconds, time.perf_counter()) '''
+        with self._lock:
+            i = self._count % self._capacity
+            self._timestamps[i] = timestamp
+            self._positions[i] = positions
+            self._rotations[i] = rotations
+            self._valid[i] = valid
+            self._count += 1
+
+    def latest(self):
+        '''
+        Return (timestamp, positions, rotations, valid) of the newest entry (copies),
+        or None if the history is empty.
+        '''
+        with self._lock:
+            if self._count == 0:
+                return None
+            i = (self._count - 1) % self._capacity
+            return (self._timestamps[i], self._positions[i].copy(),
+                    self._rotations[i].copy(), self._valid[i].copy())
+
+    def window(self, n=None):
+        '''
+        Return the newest n entries (all if None) ordered oldest to newest as
+        (timestamps, positions, rotations, valid) arrays.
+        '''
+        with self._lock:
+            size = min(self._count, self._capacity)
+            n = size if n is None else min(n, size)
+            idx = (self._count - n + np.arange(n)) % self._capacity
+            return (self._timestamps[idx], self._positions[idx],
+                    self._rotations[idx], self._valid[idx])
+
+    def interpolate(self, t, devices=None):
+        '''
+        Estimate the poses at time t by interpolating between the two entries
+        around it (linear for positions, slerp for rotations). Times outside the
+        recorded range are clamped to the oldest/newest entry.
+        devices: optional index array selecting devices; all devices otherwise.
+        Returns (positions, rotations, valid), or None if the history is empty.
+        '''
+        timestamps, positions, rotations, valid = self.window()
+        if len(timestamps) == 0:
+            return None
+        if devices is not None:
+            positions = positions[:, devices]
+            rotations = rotations[:, devices]
+            valid = valid[:, devices]
+        hi = int(np.searchsorted(timestamps, t))
+        if hi <= 0:
+            return positions[0].copy(), rotations[0].copy(), valid[0].copy()
+        if hi >= len(timestamps):
+            return positions[-1].copy(), rotations[-1].copy(), valid[-1].copy()
+        lo = hi - 1
+        span = timestamps[hi] - timestamps[lo]
+        alpha = (t - timestamps[lo]) / span if span > 0 else 1.0
+        position = positions[lo] + alpha * (positions[hi] - positions[lo])
+        rotation = slerp(rotations[lo], rotations[hi], alpha)
+        return position, rotation, valid[lo] & valid[hi]
+
+
+def quaternion_multiply(q, r):
+    ''' Hamilton product of (w, x, y, z) quaternion arrays of shape (..., 4) '''
+    q = np.asarray(q, dtype=np.float64)
+    r = np.asarray(r, dtype=np.float64)
+    w0, x0, y0, z0 = np.moveaxis(q, -1, 0)
+    w1, x1, y1, z1 = np.moveaxis(r, -1, 0)
+    return np.stack((w0 * w1 - x0 * x1 - y0 * y1 - z0 * z1,
+                     w0 * x1 + x0 * w1 + y0 * z1 - z0 * y1,
+                     w0 * y1 - x0 * z1 + y0 * w1 + z0 * x1,
+                     w0 * z1 + x0 * y1 - y0 * x1 + z0 * w1), axis=-1)
+
+
+def quaternion_conjugate(q):
+    q = np.array(q, dtype=np.float64)
+    q[..., 1:] *= -1
+    return q
+
+
+def angular_velocity(q0, q1, dt):
+    '''
+    Angular velocity vectors (rad/s, shape (..., 3)) that rotate unit quaternions
+    q0 into q1 over dt seconds, i.e. q1 = exp(omega * dt) * q0.
+    '''
+    delta = quaternion_multiply(q1, quaternion_conjugate(q0))
+    # q and -q are the same rotation; take the shorter way round
+    delta *= np.where(delta[..., :1] < 0, -1.0, 1.0)
+    sin_half = np.linalg.norm(delta[..., 1:], axis=-1, keepdims=True)
+    angle = 2 * np.arctan2(sin_half, delta[..., :1])
+    axis = delta[..., 1:] / np.where(sin_half > 1e-12, sin_half, 1.0)
+    return axis * angle / dt
+
+
+def quaternion_from_rotation_vector(v):
+    ''' Unit quaternions (..., 4) for rotation vectors v (..., 3) (axis * angle) '''
+    v = np.asarray(v, dtype=np.float64)
+    angle = np.linalg.norm(v, axis=-1, keepdims=True)
+    half = angle / 2
+    scale = np.where(angle > 1e-12, np.sin(half) / np.where(angle > 1e-12, angle, 1.0), 0.5)
+    return np.concatenate((np.cos(half), v * scale), axis=-1)
+
+
+def quaternion_angle(q0, q1):
+    ''' Angle in radians of the rotation between unit quaternions q0 and q1 '''
+    dot = np.abs(np.sum(np.asarray(q0) * np.asarray(q1), axis=-1))
+    return 2 * np.arccos(np.clip(dot, 0.0, 1.0))
+
+
+class HeadPosePredictor(object):
+    '''
+    Extrapolates tracked device poses from a PoseHistory to the time the frame
+    rendered from them will be displayed. Linear velocity comes from finite
+    differences of positions and angular velocity from the relative rotation
+    between quaternions, both over the last velocity_window history entries.
+
+    The prediction horizon adapts to the measured round trip of the capture loop
+    (pose sent to Unity until the frame rendered from it is displayed): pass
+    each measurement to record_round_trip(). Every prediction is kept until its
+    target time has passed, then compared with the recorded pose to log the
+    prediction error for tuning.
+    '''
+
+    def __init__(self, history, initial_horizon=0.03, min_horizon=0.0, max_horizon=0.1,
+                 smoothing=0.1, display_latency=1 / 90, velocity_window=3, log_size=4096):
+        '''
+        history: the PoseHistory to predict from
+        initial_horizon: horizon (s) used until round trips have been measured
+        min_horizon, max_horizon: clamp on the adaptive horizon
+        smoothing: weight of a new round-trip measurement in the moving average
+        display_latency: fixed time from display submit to photons (about one
+            refresh at 90 Hz), added to the measured round trip
+        velocity_window: number of history entries spanned by velocity estimates
+        log_size: number of prediction errors kept
+        '''
+        self._history = history
+        self._min_horizon = min_horizon
+        self._max_horizon = max_horizon
+        self._smoothing = smoothing
+        self._display_latency = display_latency
+        self._velocity_window = max(int(velocity_window), 2)
+        self._round_trip = None
+        self._horizon = initial_horizon
+
+        # pending predictions, checked once their target time has been recorded; ones
+        # that can never be checked (history overwritten) drop off the front
+        self._pending = collections.deque(maxlen=self._history.capacity)
+        self._log_size = int(log_size)
+        self._log = np.zeros((self._log_size, 4))  # target time, horizon, position error, angle error
+        self._log_count = 0
+
+    @property
+    def horizon(self):
+        ''' Current prediction horizon in seconds '''
+        return self._horizon
+
+    @property
+    def round_trip(self):
+        ''' Smoothed measured round trip in seconds, or None before the first measurement '''
+        return self._round_trip
+
+    def record_round_trip(self, seconds):
+        ''' Feed one measured pose-to-display round trip and update the horizon '''
+        if self._round_trip is None:
+            self._round_trip = seconds
+        else:
+            self._round_trip += self._smoothing * (seconds - self._round_trip)
+        self._horizon = min(max(self._round_trip + self._display_latency, self._min_horizon),
+                            self._max_horizon)
+
+    def predict(self, target_time=None, devices=None):
+        '''
+        Return predicted (positions, rotations) of the selected devices (all by
+        default) at target_time, which defaults to the newest pose time plus the
+        current horizon. Returns None if the history is empty.
+        '''
+        timestamps, positions, rotations, _ = self._history.window(self._velocity_window)
+        if len(timestamps) == 0:
+            return None
+        if devices is not None:
+            positions = positions[:, devices]
+            rotations = rotations[:, devices]
+        if target_time is None:
+            target_time = timestamps[-1] + self._horizon
+        ahead = target_time - timestamps[-1]
+        dt = timestamps[-1] - timestamps[0]
+        if len(timestamps) < 2 or dt <= 0:
+            position, rotation = positions[-1].copy(), rotations[-1].copy()
+        else:
+            velocity = (positions[-1] - positions[0]) / dt
+            omega = angular_velocity(rotations[0], rotations[-1], dt)
+            position = positions[-1] + velocity * ahead
+            rotation = quaternion_multiply(quaternion_from_rotation_vector(omega * ahead), rotations[-1])
+        self._pending.append((target_time, ahead, devices, position, rotation))
+        return position, rotation
+
+    def evaluate(self):
+        '''
+        Compare predictions whose target time has been reached with the recorded
+        poses and log their errors. Call once per frame after the history update.
+        Returns the number of predictions evaluated.
+        '''
+        latest = self._history.latest()
+        if latest is None:
+            return 0
+        evaluated = 0
+        while self._pending and self._pending[0][0] <= latest[0]:
+            target, ahead, devices, position, rotation = self._pending.popleft()
+            actual = self._history.interpolate(target, devices)
+            position_error = np.linalg.norm(np.atleast_2d(actual[0] - position), axis=-1)
+            angle_error = quaternion_angle(actual[1], rotation)
+            self._log[self._log_count % self._log_size] = (
+                target, ahead, np.max(position_error), np.max(angle_error))
+            self._log_count += 1
+            evaluated += 1
+        return evaluated
+
+    def error_log(self):
+        '''
+        Return the logged prediction errors, oldest first, as an (n, 4) array of
+        (target time, horizon, position error, angle error in radians). With
+        several devices the largest error among them is logged.
+        '''
+        n = min(self._log_count, self._log_size)
+        start = (self._log_count - n) % self._log_size
+        return np.roll(self._log, -start, axis=0)[:n].copy()
+
+    def error_summary(self):
+        ''' Mean and 95th percentile of the logged position and angle errors '''
+        log = self.error_log()
+        if len(log) == 0:
+            return {'n': 0, 'horizon': self._horizon}
+        return {
+            'n': len(log),
+            'horizon': self._horizon,
+            'round_trip': self._round_trip,
+            'position_mean': float(log[:, 2].mean()),
+            'position_p95': float(np.percentile(log[:, 2], 95)),
+            'angle_mean_deg': float(np.degrees(log[:, 3].mean())),
+            'angle_p95_deg': float(np.degrees(np.percentile(log[:, 3], 95))),
+        }
+
+    def save_error_log(self, path):
+        ''' Write the prediction error log to a CSV file for offline tuning '''
+        np.savetxt(path, self.error_log(), delimiter=',',
+                   header='target_time,horizon,position_error,angle_error_rad', comments='')
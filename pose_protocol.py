@@ -0,0 +1,361 @@
+'''
+Binary pose protocol between the Python VR interface and Unity (PythonCaller.cs).
+
+Every packet is a fixed header followed by one record per tracked device:
+
+    header  (24 bytes, little endian)
+        magic         uint32   b'VRPS'
+        version       uint16   POSE_PROTOCOL_VERSION
+        device_count  uint16   number of device records that follow
+        sequence      uint32   increments by one per packet
+        reserved      uint32
+        timestamp     float64  pose capture time, time.perf_counter() seconds
+    device record (32 bytes)
+        device_index  uint32   OpenVR tracked device index (0 is the HMD)
+        rotation      4 x float32  quaternion (w, x, y, z)
+        position      3 x float32
+
+TcpPoseTransport sends packets from a background thread with Nagle's algorithm
+disabled. submit() never blocks: if the socket falls behind, the pending packet
+is replaced by the newer one, so Unity always receives the freshest pose.
+PoseReceiver is a pure-Python stand-in for PythonCaller.cs used for testing
+and benchmarking.
+
+SharedMemoryPoseTransport is an alternative to TCP: it publishes the newest
+packet into a seqlock-protected shared memory slot (see seqlock.py), which
+SharedMemoryPoseReader polls without any syscall.
+'''
+
+import socket
+import threading
+import time
+
+import numpy as np
+
+from seqlock import SeqlockSlot
+
+POSE_MAGIC = 0x53505256  # b'VRPS' read as a little endian uint32
+POSE_PROTOCOL_VERSION = 1
+MAX_DEVICES = 64  # openvr.k_unMaxTrackedDeviceCount
+DEFAULT_SHM_NAME = "vr_pose"
+
+POSE_HEADER_DTYPE = np.dtype([
+    ('magic', '<u4'),
+    ('version', '<u2'),
+    ('device_count', '<u2'),
+    ('sequence', '<u4'),
+    ('reserved', '<u4'),
+    ('timestamp', '<f8'),
+])
+
+POSE_DEVICE_DTYPE = np.dtype([
+    ('device_index', '<u4'),
+    ('rotation', '<f4', (4,)),
+    ('position', '<f4', (3,)),
+])
+
+
+class PosePacketError(ValueError):
+    pass
+
+
+class PoseEncoder(object):
+    '''
+    Encodes pose packets into a preallocated buffer, assigning sequence numbers.
+    '''
+
+    def __init__(self, max_devices=MAX_DEVICES):
+        self._buffer = np.zeros(POSE_HEADER_DTYPE.itemsize + max_devices * POSE_DEVICE_DTYPE.itemsize,
+                                dtype=np.uint8)
+        self._header = self._buffer[:POSE_HEADER_DTYPE.itemsize].view(POSE_HEADER_DTYPE)
+        self._devices = self._buffer[POSE_HEADER_DTYPE.itemsize:].view(POSE_DEVICE_DTYPE)
+        self._header['magic'] = POSE_MAGIC
+        self._header['version'] = POSE_PROTOCOL_VERSION
+        self._sequence = 0
+
+    @property
+    def sequence(self):
+        ''' Sequence number of the last encoded packet '''
+        return self._sequence
+
+    def encode(self, device_indices, rotations, positions, timestamp=None):
+        '''
+        Encode one packet and return it as bytes.
+        device_indices: sequence of n device indices
+        rotations: (n, 4) quaternions (w, x, y, z)
+        positions: (n, 3) positions
+        timestamp: capture time of the poses, defaults to now
+        '''
+        n = len(device_indices)
+        if n > len(self._devices):
+            raise PosePacketError("Too many devices in one packet: %d" % n)
+        self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+        header = self._header[0]
+        header['device_count'] = n
+        header['sequence'] = self._sequence
+        header['timestamp'] = time.perf_counter() if timestamp is None else timestamp
+        devices = self._devices[:n]
+        devices['device_index'] = device_indices
+        devices['rotation'] = np.reshape(rotations, (n, 4))
+        devices['position'] = np.reshape(positions, (n, 3))
+        return self._buffer[:POSE_HEADER_DTYPE.itemsize + n * POSE_DEVICE_DTYPE.itemsize].tobytes()
+
+
+class PoseDecoder(object):
+    '''
+    Incrementally splits a byte stream into pose packets. feed() accepts
+    arbitrary chunks and returns the list of complete (header, devices) pairs.
+    '''
+
+    def __init__(self):
+        self._pending = bytearray()
+
+    def feed(self, data):
+        self._pending += data
+        packets = []
+        offset = 0
+        header_size = POSE_HEADER_DTYPE.itemsize
+        while len(self._pending) - offset >= header_size:
+            header = np.frombuffer(self._pending, POSE_HEADER_DTYPE, 1, offset)[0].copy()
+            if header['magic'] != POSE_MAGIC:
+                raise PosePacketError("Bad pose packet magic: %#x" % header['magic'])
+            if header['version'] != POSE_PROTOCOL_VERSION:
+                raise PosePacketError("Unsupported pose protocol version %d" % header['version'])
+            size = header_size + int(header['device_count']) * POSE_DEVICE_DTYPE.itemsize
+            if len(self._pending) - offset < size:
+                break
+            devices = np.frombuffer(self._pending, POSE_DEVICE_DTYPE,
+                                    int(header['device_count']), offset + header_size).copy()
+            packets.append((header, devices))
+            offset += size
+        del self._pending[:offset]
+        return packets
+
+
+class TcpPoseTransport(object):
+    '''
+    Sends encoded pose packets over a TCP connection with TCP_NODELAY set. A
+    background thread performs the (possibly blocking) sends; submit() only
+    stores the packet in a single pending slot, replacing any packet that has
+    not been sent yet.
+    '''
+
+    def __init__(self, host="localhost", port=9999):
+        self._host = host
+        self._port = port
+        self._sock = None
+        self._cond = threading.Condition()
+        self._pending = None
+        self._closed = False
+        self._thread = None
+        self.connected = False
+        self.sent = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.last_error = None
+
+    def connect(self, timeout=None):
+        self._sock = socket.create_connection((self._host, self._port), timeout=timeout)
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connected = True
+        self._thread = threading.Thread(target=self._run, name='PoseSender', daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def socket(self):
+        return self._sock
+
+    def submit(self, packet):
+        ''' Queue packet (bytes) for sending without blocking '''
+        with self._cond:
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = packet
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self.connected = False
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None or self._closed)
+                if self._closed:
+                    return
+                packet, self._pending = self._pending, None
+            try:
+                self._sock.sendall(packet)
+                self.sent += 1
+            except OSError as err:
+                self.errors += 1
+                self.last_error = err
+                self.connected = False
+                return
+
+
+class SharedMemoryPoseTransport(object):
+    '''
+    Publishes encoded pose packets into a shared memory slot. Each submit()
+    overwrites the previous packet in place, so there is no queue to back up and
+    readers always see the newest pose. Has the same interface as TcpPoseTransport.
+    '''
+
+    def __init__(self, name=DEFAULT_SHM_NAME, max_devices=MAX_DEVICES):
+        self._name = name
+        self._size = POSE_HEADER_DTYPE.itemsize + max_devices * POSE_DEVICE_DTYPE.itemsize
+        self._slot = None
+        self.connected = False
+        self.sent = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.last_error = None
+
+    def connect(self, timeout=None):
+        ''' Create the shared memory slot; timeout is accepted for interface parity '''
+        self._slot = SeqlockSlot(self._name, self._size, create=True)
+        self.connected = True
+        return self
+
+    @property
+    def name(self):
+        return self._slot.name if self._slot is not None else self._name
+
+    def submit(self, packet):
+        self._slot.write(packet)
+        self.sent += 1
+
+    def close(self):
+        if self._slot is not None:
+            self._slot.close()
+            self._slot = None
+        self.connected = False
+
+
+class SharedMemoryPoseReader(object):
+    '''
+    Polls the shared memory slot written by a SharedMemoryPoseTransport.
+    '''
+
+    def __init__(self, name=DEFAULT_SHM_NAME):
+        self._slot = SeqlockSlot(name)
+        self._buffer = np.zeros(self._slot.size, dtype=np.uint8)
+        self._header_size = POSE_HEADER_DTYPE.itemsize
+        self._last_sequence = None
+
+    def poll(self):
+        '''
+        Return the newest (header, devices) packet if it has not been returned
+        before, otherwise None.
+        '''
+        sequence = self._slot.read(self._buffer, self._last_sequence)
+        if sequence is None:
+            return None
+        self._last_sequence = sequence
+        header = self._buffer[:self._header_size].view(POSE_HEADER_DTYPE)[0].copy()
+        if header['magic'] != POSE_MAGIC or header['version'] != POSE_PROTOCOL_VERSION:
+            raise PosePacketError("Unsupported pose packet in shared memory")
+        end = self._header_size + int(header['device_count']) * POSE_DEVICE_DTYPE.itemsize
+        devices = self._buffer[self._header_size:end].view(POSE_DEVICE_DTYPE).copy()
+        return header, devices
+
+    @property
+    def retries(self):
+        ''' Number of reads that had to be retried because a write was in progress '''
+        return self._slot.retries
+
+    def close(self):
+        self._slot.close()
+
+
+class PoseReceiver(object):
+    '''
+    Pure-Python stand-in for PythonCaller.cs. Listens for a PositionSender,
+    decodes pose packets on a background thread and keeps the newest HMD pose.
+    With echo=True every packet header is sent straight back, so the sender can
+    measure round-trip latency.
+    '''
+
+    def __init__(self, host="localhost", port=9999, echo=False):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(1)
+        self._echo = echo
+        self._thread = None
+        self._stop_event = threading.Event()
+        self.port = self._server.getsockname()[1]
+        self.packets = 0
+        self.last_sequence = None
+        self.sequence_gaps = 0
+        self.rotation = np.zeros(4, dtype=np.float32)
+        self.position = np.zeros(3, dtype=np.float32)
+        self.latest_devices = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='PoseReceiver', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._server.close()
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def _run(self):
+        self._server.settimeout(0.1)
+        while not self._stop_event.is_set():
+            try:
+                client, _ = self._server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client.settimeout(0.1)
+            self._serve(client)
+            client.close()
+
+    def _serve(self, client):
+        decoder = PoseDecoder()
+        buf = bytearray(65536)
+        view = memoryview(buf)
+        while not self._stop_event.is_set():
+            try:
+                nbytes = client.recv_into(view)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            if nbytes == 0:
+                # when disconnected, wait for a new connection like PythonCaller.cs
+                return
+            packets = decoder.feed(view[:nbytes])
+            if not packets:
+                continue
+            for header, devices in packets:
+                sequence = int(header['sequence'])
+                if self.last_sequence is not None and sequence != (self.last_sequence + 1) & 0xFFFFFFFF:
+                    self.sequence_gaps += 1
+                self.last_sequence = sequence
+            self.packets += len(packets)
+            header, devices = packets[-1]
+            hmd = devices[devices['device_index'] == 0]
+            if len(hmd):
+                self.rotation[:] = hmd[0]['rotation']
+                self.position[:] = hmd[0]['position']
+            self.latest_devices = devices
+            if self._echo:
+                client.sendall(b''.join(h.tobytes() for h, _ in packets))
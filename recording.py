@@ -0,0 +1,439 @@
+'''
+Session recording and deterministic replay.
+
+A SessionRecorder writes gaze samples, HMD poses and (optionally) captured
+frames of a session to a directory of append-only binary files:
+
+    session.json   metadata: frame size, compression, record dtypes, counts
+    gaze.bin       GAZE_RECORD_DTYPE records
+    poses.bin      POSE_RECORD_DTYPE records
+    frames.idx     FRAME_RECORD_DTYPE records, one per frame in frames.bin
+    frames.bin     raw (height, width) uint8 frames, or zlib streams
+
+Every file is a flat array of fixed-size records that np.memmap can open
+directly, and a frame's index record is only written after its data, so a
+recording cut short by a crash stays readable. All writes happen on a background
+thread: the frame loop only copies frames into pooled buffers and queues them,
+and drops (and counts) records rather than wait when the writer falls behind.
+
+SessionReader memory-maps a recording. ReplayFrameSource feeds its frames to an
+ImageProcessor, as fast as possible or at the recorded pace, and ReplayEyeTracker
+serves the recorded gaze samples up to the frame being replayed; ReplaySession
+wires the two together with a replay clock, so processing a recording is
+deterministic.
+'''
+
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from frame_sources import FramePool, FrameSource
+
+RECORDING_VERSION = 1
+
+GAZE_RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+])
+
+POSE_RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('position', '<f8', (3,)),
+    ('rotation', '<f8', (4,)),
+])
+
+# gaze is the (uncalibrated) gaze the frame was processed with, one row per eye;
+# frames processed with a single gaze repeat it in both rows
+FRAME_RECORD_DTYPE = np.dtype([
+    ('index', '<u8'),
+    ('timestamp', '<f8'),
+    ('gaze', '<f8', (2, 2)),
+    ('offset', '<u8'),
+    ('size', '<u8'),
+])
+
+_STOP = object()
+
+
+class SessionRecorder(object):
+    '''
+    Records a session to a directory on a background writer thread. The
+    record_*() methods never block; they return False if the record had to be
+    dropped because the writer is behind.
+    '''
+
+    def __init__(self, path, width=None, height=None, record_frames=False, compression=None,
+                 compression_level=1, queue_size=256, frame_buffers=4):
+        '''
+        path: directory to create for the recording
+        width, height: frame size, required when record_frames is set
+        compression: None to store raw frames, or 'zlib' (compression_level 1 is
+            the fastest setting)
+        queue_size: records that may wait for the writer before new ones are dropped
+        frame_buffers: frames that may wait for the writer; each holds a full copy
+        '''
+        if compression not in (None, 'zlib'):
+            raise ValueError("Unknown frame compression: %s" % compression)
+        if record_frames and (width is None or height is None):
+            raise ValueError("width and height are required to record frames")
+        self._path = path
+        self._width = width
+        self._height = height
+        self.record_frames = record_frames
+        self._compression = compression
+        self._compression_level = compression_level
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pool = FramePool((height, width), np.uint8, frame_buffers) if record_frames else None
+        self._thread = None
+        self._files = {}
+        self._frame_offset = 0
+        self.gaze_samples = 0
+        self.poses = 0
+        self.frames = 0
+        self.dropped = 0
+        self.bytes_written = 0
+        self.error = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def start(self):
+        os.makedirs(self._path)
+        self._write_metadata(complete=False)
+        names = ['gaze.bin', 'poses.bin'] + (['frames.idx', 'frames.bin'] if self.record_frames else [])
+        for name in names:
+            self._files[name] = open(os.path.join(self._path, name), 'ab')
+        self._thread = threading.Thread(target=self._run, name='SessionRecorder', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Write out everything queued so far and close the recording. Raises the
+        writer's error if it failed (the recording then stays marked incomplete).
+        '''
+        if self._thread is None:
+            return
+        # a writer that failed has exited and no longer drains the queue
+        while self._thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self._thread.join()
+        self._thread = None
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        self._write_metadata(complete=self.error is None)
+        if self.error is not None:
+            raise self.error
+
+    def record_gaze(self, samples):
+        ''' Queue an (n, 3) array of (timestamp, x, y) gaze samples '''
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        if len(samples) == 0:
+            return True
+        records = np.empty(len(samples), dtype=GAZE_RECORD_DTYPE)
+        records['timestamp'], records['x'], records['y'] = samples.T
+        return self._put(('gaze.bin', records))
+
+    def record_pose(self, timestamp, position, rotation):
+        ''' Queue one HMD pose: position (3,), quaternion rotation (w, x, y, z) '''
+        record = np.empty(1, dtype=POSE_RECORD_DTYPE)
+        record['timestamp'] = timestamp
+        record['position'] = position
+        record['rotation'] = rotation
+        return self._put(('poses.bin', record))
+
+    def record_frame(self, frame):
+        '''
+        Queue a copy of a frame_sources.Frame. The copy goes into one of the
+        recorder's own buffers, so the frame can be released right away.
+        '''
+        buf = self._pool.acquire(block=False)
+        if buf is None:
+            self.dropped += 1
+            return False
+        np.copyto(buf, frame.data)
+        record = np.zeros(1, dtype=FRAME_RECORD_DTYPE)
+        record['index'] = frame.index
+        record['timestamp'] = frame.timestamp
+        record['gaze'] = frame.gaze
+        if not self._put(('frames.bin', (buf, record))):
+            self._pool.release(buf)
+            return False
+        return True
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            name, payload = item
+            try:
+                if name == 'frames.bin':
+                    self._write_frame(*payload)
+                else:
+                    self._files[name].write(payload.tobytes())
+                    self.bytes_written += payload.nbytes
+                    if name == 'gaze.bin':
+                        self.gaze_samples += len(payload)
+                    else:
+                        self.poses += len(payload)
+            except OSError as err:
+                self.error = err
+                break
+        for f in self._files.values():
+            f.flush()
+
+    def _write_frame(self, buf, record):
+        try:
+            if self._compression == 'zlib':
+                # zlib releases the GIL while compressing
+                data = zlib.compress(buf, self._compression_level)
+            else:
+                data = buf
+            self._files['frames.bin'].write(data)
+        finally:
+            self._pool.release(buf)
+        size = len(data) if self._compression else buf.nbytes
+        record['offset'] = self._frame_offset
+        record['size'] = size
+        self._frame_offset += size
+        self._files['frames.idx'].write(record.tobytes())
+        self.bytes_written += size + record.nbytes
+        self.frames += 1
+
+    def _write_metadata(self, complete):
+        write_metadata(self._path, self._width, self._height, self.record_frames, self._compression,
+                       complete, {'gaze': self.gaze_samples, 'poses': self.poses,
+                                  'frames': self.frames, 'dropped': self.dropped})
+
+
+def write_metadata(path, width, height, frames, compression, complete, counts, **extra):
+    ''' Write the session.json of a recording; extra items are stored along with the rest '''
+    metadata = {
+        'version': RECORDING_VERSION,
+        'width': width,
+        'height': height,
+        'frames': frames,
+        'compression': compression,
+        'dtypes': {
+            'gaze': GAZE_RECORD_DTYPE.descr,
+            'poses': POSE_RECORD_DTYPE.descr,
+            'frames': FRAME_RECORD_DTYPE.descr,
+        },
+        'complete': complete,
+        'counts': counts,
+    }
+    metadata.update(extra)
+    with open(os.path.join(path, 'session.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def _map_records(path, dtype):
+    ''' Memory-map the complete records of an append-only file (empty if missing) '''
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    n = size // dtype.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(n,))
+
+
+class SessionReader(object):
+    '''
+    Read-only, memory-mapped view of a recording made by SessionRecorder.
+    gaze, poses and frame_records are structured record arrays.
+    '''
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'session.json')) as f:
+            self.metadata = json.load(f)
+        if self.metadata['version'] != RECORDING_VERSION:
+            raise ValueError("Unsupported recording version %d" % self.metadata['version'])
+        self._path = path
+        self.width = self.metadata['width']
+        self.height = self.metadata['height']
+        self.compression = self.metadata['compression']
+        self.gaze = _map_records(os.path.join(path, 'gaze.bin'), GAZE_RECORD_DTYPE)
+        self.poses = _map_records(os.path.join(path, 'poses.bin'), POSE_RECORD_DTYPE)
+        self.frame_records = _map_records(os.path.join(path, 'frames.idx'), FRAME_RECORD_DTYPE)
+        self._frame_data = None
+        if len(self.frame_records):
+            self._frame_data = np.memmap(os.path.join(path, 'frames.bin'), dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.frame_records)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def frame_bytes(self):
+        return self.width * self.height
+
+    def frame_block(self, start, stop):
+        '''
+        Frames start to stop as a read-only (n, height, width) view of the mapped
+        file, or None if they are compressed or not stored back to back.
+        '''
+        records = self.frame_records[start:stop]
+        if self.compression is not None or len(records) == 0:
+            return None
+        offsets = records['offset'].astype(np.int64)
+        first = int(offsets[0])
+        if (np.any(records['size'] != self.frame_bytes)
+                or np.any(offsets != first + np.arange(len(records)) * self.frame_bytes)):
+            return None
+        data = self._frame_data[first:first + len(records) * self.frame_bytes]
+        return data.reshape(len(records), self.height, self.width)
+
+    def frame(self, i, out=None):
+        '''
+        Return frame i as a (height, width) uint8 array. Uncompressed frames are
+        returned as a read-only view of the mapped file unless out is given.
+        '''
+        record = self.frame_records[i]
+        start = int(record['offset'])
+        data = self._frame_data[start:start + int(record['size'])]
+        if self.compression == 'zlib':
+            frame = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+        else:
+            frame = data
+        frame = frame.reshape(self.height, self.width)
+        if out is None:
+            return frame
+        np.copyto(out, frame)
+        return out
+
+    def close(self):
+        self.gaze = self.poses = self.frame_records = self._frame_data = None
+
+
+class ReplayFrameSource(FrameSource):
+    '''
+    Frame source reading the frames of a recording in order. With realtime=True
+    frames are paced to their recorded timestamps; otherwise they are delivered
+    as fast as they are read. Reading past the end raises EOFError, or starts
+    over with loop=True.
+    '''
+
+    def __init__(self, reader, realtime=False, loop=False):
+        if isinstance(reader, str):
+            reader = SessionReader(reader)
+        if len(reader) == 0:
+            raise ValueError("Recording has no frames: %s" % reader.path)
+        super(ReplayFrameSource, self).__init__(reader.width, reader.height)
+        self._reader = reader
+        self._realtime = realtime
+        self._loop = loop
+        self._position = 0
+        self._started = None
+
+    @property
+    def position(self):
+        ''' Index (into the recording) of the next frame to be read '''
+        return self._position
+
+    @property
+    def next_timestamp(self):
+        ''' Recorded capture time of the next frame '''
+        return float(self._reader.frame_records[self._position % len(self._reader)]['timestamp'])
+
+    def seek(self, position):
+        self._position = position
+        self._started = None
+
+    def _read_into(self, out):
+        if self._position >= len(self._reader):
+            if not self._loop:
+                raise EOFError("End of recording")
+            self.seek(0)
+        if self._realtime:
+            record_time = self.next_timestamp - float(self._reader.frame_records[0]['timestamp'])
+            if self._started is None:
+                self._started = time.perf_counter() - record_time
+            delay = self._started + record_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self._reader.frame(self._position, out)
+        self._position += 1
+        return out.nbytes
+
+
+class ReplayEyeTracker(object):
+    '''
+    Serves the recorded gaze samples with the same interface as
+    Experiment.EyeTracker. Only samples recorded up to clock() are visible.
+    '''
+
+    def __init__(self, reader, clock):
+        self._gaze = np.column_stack([reader.gaze['timestamp'], reader.gaze['x'], reader.gaze['y']])
+        self._clock = clock
+
+    def _visible(self):
+        return np.searchsorted(self._gaze[:, 0], self._clock(), side='right')
+
+    def get_gaze_pos(self):
+        n = self._visible()
+        if n == 0:
+            return (np.nan, np.nan)
+        return (self._gaze[n - 1, 1], self._gaze[n - 1, 2])
+
+    def latest(self):
+        n = self._visible()
+        if n == 0:
+            return None
+        t, x, y = self._gaze[n - 1]
+        return (t, x, y)
+
+    def since(self, t):
+        n = self._visible()
+        first = np.searchsorted(self._gaze[:n, 0], t, side='right')
+        return self._gaze[first:n].copy()
+
+
+class ReplaySession(object):
+    '''
+    Frame source, eye tracker and clock for replaying a recording through an
+    ImageProcessor:
+
+        replay = ReplaySession(path)
+        processor = ImageProcessor(replay.width, replay.height, eye_tracker=replay.eye_tracker,
+                                   frame_source=replay.frame_source, clock=replay.clock,
+                                   calibration=transform).start()
+
+    The clock reads the recorded capture time of the frame about to be read, so
+    gaze sampling and prediction see exactly what they saw during recording.
+    '''
+
+    def __init__(self, path, realtime=False, loop=False):
+        self.reader = SessionReader(path)
+        self.width = self.reader.width
+        self.height = self.reader.height
+        self.frame_source = ReplayFrameSource(self.reader, realtime, loop)
+        self.eye_tracker = ReplayEyeTracker(self.reader, self.clock)
+
+    def __len__(self):
+        return len(self.reader)
+
+    def clock(self):
+        return self.frame_source.next_timestamp
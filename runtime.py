@@ -0,0 +1,455 @@
+'''
+asyncio frame loop with deadline-aware pacing.
+
+The legacy loop (commented out at the bottom of the VRInterface section of
+Experiment.py) runs update() and send() back to back as fast as the blocking
+calls allow and polls the keyboard in between. FrameRuntime instead runs one
+frame per display period (90 Hz for the Vive): gaze intake, pose fetch and
+send, capture, processing and display, each a plain callable, as in
+pipeline.FramePipeline. Before capture and before processing it compares the
+time left until the frame's deadline with running estimates of what the
+remaining stages cost, and rather than miss the deadline it
+
+    skips capture (the previous frame stays up),
+    processes the frame degraded (e.g. with the previous gaze, so the warp
+    maps come from the cache), or
+    drops the captured frame.
+
+Frames that still finish late are counted as missed deadlines, and the
+schedule moves on to the next display period instead of trying to catch up.
+Keyboard and other control handlers run as asyncio tasks between stages, so
+they never block the frame loop.
+
+With a SimulatedClock the whole runtime runs in virtual time: stages "take
+time" by calling clock.advance(), and sleeping advances the clock instead of
+waiting, so pacing decisions are deterministic and run as fast as possible.
+'''
+
+import asyncio
+import inspect
+import selectors
+import time
+
+
+class SimulatedClock(object):
+    '''
+    Virtual time source, a callable like time.perf_counter. Time only moves when
+    advance() is called or when the event loop from new_event_loop() has nothing
+    to do but wait for a timer, which it then jumps to.
+    '''
+
+    def __init__(self, start=0.0):
+        self._now = float(start)
+
+    def __call__(self):
+        return self._now
+
+    def advance(self, seconds):
+        ''' Let seconds of virtual time pass, e.g. to simulate the cost of a stage '''
+        if seconds > 0:
+            self._now += seconds
+
+    def new_event_loop(self):
+        ''' An asyncio event loop whose time() is this clock '''
+        return _SimulatedEventLoop(self)
+
+
+class _SimulatedSelector(selectors.BaseSelector):
+    '''
+    Selector that never waits on a timeout: it polls the real selector and, if
+    nothing is ready, advances the clock by the timeout the loop asked for.
+    Waiting without a timeout (no timers pending) still blocks on the real
+    selector, e.g. for callbacks from other threads.
+    '''
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def select(self, timeout=None):
+        if timeout is None:
+            return self._selector.select(None)
+        ready = self._selector.select(0)
+        if not ready:
+            self._clock.advance(timeout)
+        return ready
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def close(self):
+        self._selector.close()
+
+
+class _SimulatedEventLoop(asyncio.SelectorEventLoop):
+
+    def __init__(self, clock):
+        super(_SimulatedEventLoop, self).__init__(_SimulatedSelector(clock))
+        self._clock = clock
+
+    def time(self):
+        return self._clock()
+
+
+class _StageEstimate(object):
+    ''' Exponential moving average of a stage's duration '''
+
+    def __init__(self, smoothing=0.1):
+        self._smoothing = smoothing
+        self.value = 0.0
+        self.count = 0
+
+    def record(self, duration):
+        if self.count == 0:
+            self.value = duration
+        else:
+            self.value += self._smoothing * (duration - self.value)
+        self.count += 1
+
+
+def _no_op(*args):
+    return None
+
+
+class FrameRuntime(object):
+    '''
+    Runs the frame stages on an asyncio event loop, one frame per display period:
+
+        runtime = FrameRuntime(capture=..., process=..., display=..., release=...)
+        runtime.on_key('enter')
+        runtime.run()
+
+    All stages are called on the event loop's thread; a stage may also return an
+    awaitable, which is awaited. See experiment_runtime() for the stages of the
+    experiment itself.
+    '''
+
+    def __init__(self, gaze=None, pose=None, capture=None, process=None, display=None, release=None,
+                 rate=90.0, clock=None, drop_late=True, degrade=True, margin=0.0005,
+                 probe_interval=30, executor=None, is_pressed=None, key_poll_interval=0.02):
+        '''
+        gaze: callable taking in gaze at the start of the frame
+        pose: callable fetching and sending the head pose
+        capture: callable returning a new frame, or None if none is available
+        process: callable (frame, degraded) returning the frame to display, or None
+            if it had to drop (and release) it; with degraded set it should take a
+            cheaper path
+        display: callable showing a frame, or called with None to keep the
+            previous frame up
+        release: callable returning a frame's buffer once the next frame is up
+            (or when a frame is dropped)
+        rate: display rate in Hz; frame k must be shown by start + (k + 1) / rate
+        clock: time source, time.perf_counter by default; a SimulatedClock runs
+            the loop in virtual time
+        drop_late: skip capture, degrade or drop frames that would miss their
+            deadline; False processes every frame whatever its timing
+        degrade: try degraded processing before dropping a frame
+        margin: seconds kept in reserve when checking a frame's budget
+        probe_interval: after this many frames without a capture (or without full
+            processing), do it anyway, so a stage whose estimate went up is timed
+            again instead of being skipped for good
+        executor: a concurrent.futures executor to run capture and processing on,
+            keeping the loop free for control tasks meanwhile; None runs them on
+            the loop's thread
+        is_pressed: function(key) -> bool used to poll keys registered with on_key(),
+            keyboard.is_pressed by default
+        '''
+        self._gaze = gaze or _no_op
+        self._pose = pose or _no_op
+        self._capture = capture or _no_op
+        self._process = process or (lambda frame, degraded: frame)
+        self._display = display or _no_op
+        self._release = release or _no_op
+        self._period = 1.0 / rate
+        self._clock = clock if clock is not None else time.perf_counter
+        self._drop_late = drop_late
+        self._degrade = degrade
+        self._margin = margin
+        self._probe_interval = probe_interval
+        # frames since the last capture and since the last full processing
+        self._since_capture = 0
+        self._since_process = 0
+        self._executor = executor
+        self._is_pressed = is_pressed
+        self._key_poll_interval = key_poll_interval
+        self._keys = {}
+        self._task_factories = []
+        self._loop = None
+        self._stop_event = None
+        self._stop_requested = False
+        self._estimates = dict((stage, _StageEstimate())
+                               for stage in ('capture', 'process', 'degraded', 'display'))
+        self._shown = None
+        self.counts = {
+            'frames': 0,            # display periods run
+            'displayed': 0,         # new frames shown
+            'repeated': 0,          # periods that kept the previous frame up
+            'skipped_captures': 0,  # no time left to capture and process
+            'degraded': 0,          # processed on the degraded path
+            'dropped': 0,           # captured but no time left to process
+            'missed_deadlines': 0,  # frames shown after their deadline
+            'missed_periods': 0,    # display periods lost to late frames
+        }
+
+    def on_key(self, key, callback=None):
+        '''
+        Call callback (default: stop()) when key goes down. Keys are polled on
+        their own task every key_poll_interval seconds. Register before run().
+        '''
+        self._keys[key] = callback if callback is not None else self.stop
+
+    def add_task(self, coroutine_function):
+        '''
+        Run coroutine_function(runtime) as a task alongside the frame loop, e.g. to
+        handle control events; it is cancelled when the runtime stops. Register
+        before run().
+        '''
+        self._task_factories.append(coroutine_function)
+
+    def stop(self):
+        ''' Stop after the current frame; may be called from any thread '''
+        self._stop_requested = True
+        loop = self._loop
+        if loop is not None and self._stop_event is not None:
+            loop.call_soon_threadsafe(self._stop_event.set)
+
+    @property
+    def estimates(self):
+        ''' Current duration estimates (seconds) of the capture, process, degraded process and display stages '''
+        return dict((stage, estimate.value) for stage, estimate in self._estimates.items())
+
+    def summary(self):
+        ''' The counters, with the miss rate and the current stage estimates in milliseconds '''
+        frames = self.counts['frames']
+        summary = dict(self.counts)
+        summary['missed_rate'] = self.counts['missed_deadlines'] / frames if frames else 0.0
+        summary['estimates_ms'] = dict((stage, value * 1e3) for stage, value in self.estimates.items())
+        return summary
+
+    def run(self, duration=None, frames=None):
+        '''
+        Run the frame loop until stop() is called, or for duration seconds or a
+        number of frames. Blocks; uses a new event loop (the clock's, for a
+        SimulatedClock). Returns summary().
+        '''
+        new_event_loop = getattr(self._clock, 'new_event_loop', asyncio.new_event_loop)
+        loop = new_event_loop()
+        try:
+            loop.run_until_complete(self.run_async(duration, frames))
+        finally:
+            loop.close()
+        return self.summary()
+
+    async def run_async(self, duration=None, frames=None):
+        ''' Coroutine version of run(), for use inside an existing event loop '''
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        if self._stop_requested:
+            self._stop_event.set()
+        tasks = [asyncio.ensure_future(factory(self)) for factory in self._task_factories]
+        if self._keys:
+            tasks.append(asyncio.ensure_future(self._poll_keys()))
+        try:
+            await self._frame_loop(duration, frames)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self._shown is not None:
+                self._release(self._shown)
+                self._shown = None
+            self._loop = None
+            self._stop_event = None
+            self._stop_requested = False
+
+    async def _frame_loop(self, duration, frames):
+        clock = self._clock
+        period = self._period
+        start = clock()
+        end = start + duration if duration is not None else None
+        deadline = start + period
+        while not self._stop_event.is_set():
+            if frames is not None and self.counts['frames'] >= frames:
+                break
+            if end is not None and deadline > end:
+                break
+            await self._call(self._gaze)
+            await self._call(self._pose)
+            # let control tasks run between stages
+            await asyncio.sleep(0)
+            frame = await self._produce_frame(deadline)
+            t0 = clock()
+            await self._call(self._display, frame)
+            self._estimates['display'].record(clock() - t0)
+            if frame is not None:
+                self.counts['displayed'] += 1
+                if self._shown is not None:
+                    self._release(self._shown)
+                self._shown = frame
+            else:
+                self.counts['repeated'] += 1
+            self.counts['frames'] += 1
+
+            now = clock()
+            if now > deadline:
+                # shown in a later period; continue on the next period boundary
+                late = int((now - deadline) // period) + 1
+                self.counts['missed_deadlines'] += 1
+                self.counts['missed_periods'] += late
+                deadline += late * period
+            delay = deadline - clock()
+            deadline += period
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _produce_frame(self, deadline):
+        '''
+        Capture and process a frame if the time left allows it. Returns the frame to
+        show, or None to keep the previous one up.
+        '''
+        clock = self._clock
+        estimates = self._estimates
+        display = estimates['display'].value + self._margin
+        process = estimates['process'].value
+        if self._degrade:
+            # until the degraded path has been timed, assume it fits
+            cheapest = min(process, estimates['degraded'].value)
+        else:
+            cheapest = process
+        # skipping (or dropping) only helps when a fresh frame can make the next deadline;
+        # when the work takes longer than a period anyway, do it and let the frame be late
+        needed = estimates['capture'].value + cheapest + display
+        fits_period = needed <= self._period
+        if (self._drop_late and fits_period and self._since_capture < self._probe_interval
+                and deadline - clock() < needed):
+            self._since_capture += 1
+            self.counts['skipped_captures'] += 1
+            return None
+        self._since_capture = 0
+
+        t0 = clock()
+        frame = await self._call_blocking(self._capture)
+        if frame is None:
+            return None
+        estimates['capture'].record(clock() - t0)
+        await asyncio.sleep(0)
+
+        degraded = False
+        if self._drop_late:
+            left = deadline - clock() - display
+            if left < process and self._since_process < self._probe_interval:
+                self._since_process += 1
+                degraded_cost = estimates['degraded'].value
+                # the degraded path is tried once even before it has an estimate
+                if self._degrade and (estimates['degraded'].count == 0 or left >= degraded_cost
+                                      or (not fits_period and degraded_cost < process)):
+                    degraded = True
+                elif fits_period:
+                    self.counts['dropped'] += 1
+                    self._release(frame)
+                    return None
+        t0 = clock()
+        frame = await self._call_blocking(self._process, frame, degraded)
+        estimates['degraded' if degraded else 'process'].record(clock() - t0)
+        if degraded:
+            self.counts['degraded'] += 1
+        else:
+            self._since_process = 0
+        return frame
+
+    async def _call(self, stage, *args):
+        result = stage(*args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _call_blocking(self, stage, *args):
+        if self._executor is None:
+            return await self._call(stage, *args)
+        return await self._loop.run_in_executor(self._executor, stage, *args)
+
+    async def _poll_keys(self):
+        is_pressed = self._is_pressed
+        if is_pressed is None:
+            import keyboard
+            is_pressed = keyboard.is_pressed
+        down = dict((key, False) for key in self._keys)
+        while True:
+            for key, callback in self._keys.items():
+                pressed = bool(is_pressed(key))
+                if pressed and not down[key]:
+                    result = callback()
+                    if inspect.isawaitable(result):
+                        await result
+                down[key] = pressed
+            await asyncio.sleep(self._key_poll_interval)
+
+
+class _ExperimentStages(object):
+    '''
+    Frame stages of the experiment: a started VRInterface (not pipelined), its
+    ImageProcessor and optionally a PositionSender.
+    '''
+
+    def __init__(self, vr, sender=None):
+        self._vr = vr
+        self._processor = vr.image_processor
+        self._sender = sender
+        self._last_gaze = None
+
+    def gaze(self):
+        self._processor.update_gaze()
+
+    def pose(self):
+        self._vr.update_pose()
+        if self._sender is not None:
+            self._sender.send(self._vr.get_head_rotation(), self._vr.get_head_position())
+
+    def capture(self):
+        # a buffer is always free: at most one frame is shown and one in flight
+        return self._processor.capture_frame(block=False)
+
+    def process(self, frame, degraded):
+        # degraded: reuse the previous frame's gaze, so warp maps come from the cache
+        # (foveated frames were read around their own gaze, so they keep it)
+        if degraded and self._last_gaze is not None and frame.roi is None:
+            frame.gaze = self._last_gaze
+        frame = self._processor.process_frame(frame, block=False)
+        if frame is not None:
+            self._last_gaze = frame.gaze
+        return frame
+
+    def display(self, frame):
+        if frame is None:
+            self._vr.show_frame(None)
+        else:
+            self._vr.show_frame(frame.data, frame.timestamp)
+
+
+def experiment_runtime(vr, sender=None, stop_key='enter', **kwargs):
+    '''
+    FrameRuntime running the experiment: each frame takes in gaze, fetches the head
+    pose and sends it through sender (a started PositionSender), then captures,
+    processes and shows a frame through vr (a started, non-pipelined
+    VRInterface). stop_key (None for none) stops the loop, like the legacy loop's
+    'enter'. Other keyword arguments are passed to FrameRuntime.
+    '''
+    stages = _ExperimentStages(vr, sender)
+    runtime = FrameRuntime(gaze=stages.gaze, pose=stages.pose, capture=stages.capture,
+                           process=stages.process, display=stages.display,
+                           release=vr.image_processor.release_frame, **kwargs)
+    if stop_key is not None:
+        runtime.on_key(stop_key)
+    return runtime
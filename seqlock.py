@@ -0,0 +1,159 @@
+'''
+Single-writer sequence lock over shared memory.
+
+A SeqlockSlot holds one fixed-size payload in a multiprocessing.shared_memory
+block, preceded by a 64-bit sequence counter. The writer makes the counter odd,
+copies the payload in and makes it even again; a reader copies the payload out
+and retries if the counter was odd or changed meanwhile. Neither side takes a
+lock or makes a syscall, so readers can poll the newest value every frame.
+
+Layout of the shared block:
+    uint64 sequence  (odd while a write is in progress)
+    uint64 payload size in bytes
+    payload
+'''
+
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_HEADER_SIZE = 16
+
+
+def _tracks_attached_blocks():
+    ''' True if attaching to a block registers it with this process's resource tracker '''
+    return sys.version_info < (3, 13) and sys.platform != 'win32'
+
+
+def attach_shared_memory(name):
+    '''
+    Open an existing shared memory block without leaving it registered with this
+    process's resource tracker, which would otherwise unlink the block (owned by
+    another process) when this one exits.
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if _tracks_attached_blocks():
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SeqlockSlot(object):
+    '''
+    One seqlock-protected payload slot. Create it with create=True in the writing
+    process and attach to it by name from readers.
+    '''
+
+    def __init__(self, name=None, size=None, create=False):
+        '''
+        name: shared memory block name (None picks a unique one when creating)
+        size: payload capacity in bytes, required when creating
+        create: create (and own) the block instead of attaching to it; a block
+            of that name left behind by a process that died is taken over
+        '''
+        reused = False
+        if create:
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=_HEADER_SIZE + size)
+            except FileExistsError:
+                # left behind by a run that was killed (only fixed names can clash)
+                self._shm = self._take_over(name, size)
+                reused = self._shm is not None
+                if not reused:
+                    self._shm = shared_memory.SharedMemory(name=name, create=True, size=_HEADER_SIZE + size)
+            self._owner = True
+        else:
+            self._shm = attach_shared_memory(name)
+            self._owner = False
+        header = np.ndarray((2,), dtype=np.uint64, buffer=self._shm.buf)
+        if reused:
+            # keep the sequence going for readers still attached, finishing any half done write
+            header[0] += header[0] & 1
+        elif create:
+            header[0] = 0
+            header[1] = size
+        self._sequence = header[0:1]
+        self._payload = np.ndarray((int(header[1]),), dtype=np.uint8,
+                                   buffer=self._shm.buf, offset=_HEADER_SIZE)
+        self.retries = 0
+
+    @staticmethod
+    def _take_over(name, size):
+        '''
+        Open the existing block called name as its new owner. Returns it if it has
+        the same payload size, so readers attached to it keep working; otherwise
+        unlinks it and returns None.
+        '''
+        shm = shared_memory.SharedMemory(name=name)
+        if int(np.ndarray((2,), dtype=np.uint64, buffer=shm.buf)[1]) == size:
+            return shm
+        shm.unlink()
+        shm.close()
+        return None
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def size(self):
+        ''' Payload capacity in bytes '''
+        return len(self._payload)
+
+    @property
+    def sequence(self):
+        ''' Number of completed writes (the counter is twice that while idle) '''
+        return int(self._sequence[0]) // 2
+
+    def write(self, data):
+        '''
+        Publish data (bytes-like or uint8 array no larger than the payload). Only one
+        process may write to a slot.
+        '''
+        data = np.frombuffer(data, dtype=np.uint8)
+        self._sequence[0] += 1
+        self._payload[:len(data)] = data
+        self._sequence[0] += 1
+
+    def read(self, out, last_sequence=None, max_retries=1000):
+        '''
+        Copy a consistent snapshot of the payload into out (a uint8 array of at least
+        the payload size). Returns the sequence number of the snapshot, or None
+        if nothing has been written yet, if it equals last_sequence (no new data),
+        or if a consistent copy could not be taken within max_retries attempts.
+        '''
+        for _ in range(max_retries):
+            before = int(self._sequence[0])
+            if before & 1:
+                self.retries += 1
+                continue
+            if before == 0 or before // 2 == last_sequence:
+                return None
+            out[:len(self._payload)] = self._payload
+            if int(self._sequence[0]) == before:
+                return before // 2
+            self.retries += 1
+        return None
+
+    def recover(self):
+        '''
+        Finish the sequence of a write left half done by a writer that died, so
+        readers stop retrying. Only call this while no writer is attached.
+        '''
+        if int(self._sequence[0]) & 1:
+            self._sequence[0] += 1
+
+    def close(self):
+        self._sequence = None
+        self._payload = None
+        self._shm.close()
+        if self._owner:
+            if _tracks_attached_blocks():
+                # a reader in a child process shares this process's resource tracker,
+                # so attaching may have unregistered the block there
+                from multiprocessing import resource_tracker
+                resource_tracker.register(self._shm._name, 'shared_memory')
+            self._shm.unlink()
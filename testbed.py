@@ -19,35 +19,166 @@ to the user's viewport as desired.  Two approaches to fixing this are to:
 
 This approach is much more robust and less inclined to focus-errors during an experiment than the
 current approach of using the VR HMD as a monitor and manually moving windows into the Subject view.
+
+The gaze dependent stabilization (ImageProcessor's 'mask' and 'warp' modes) is done in the
+fragment shader, driven by uniforms set once per frame with Displayer.set_stabilization(), so a
+texture received from Spout can be stabilized and submitted without reading it back to the CPU.
+
+Displayer(headless=True) renders into an offscreen context (see HeadlessContext) instead of a
+window and the headset, e.g. on Mesa's software rasterizer; benchmark.py gpu_stabilization uses
+it to compare the shader against the CPU path. PyOpenGL binds to a platform when it is first
+imported, so PYOPENGL_PLATFORM ('egl' or 'osmesa') must be set before this module is imported.
 '''
 
+import ctypes
+import os
 
-import pygame
 from OpenGL.GL import * #@UnusedWildImport squelch warning
 from OpenGL import * #@UnusedWildImport
+from OpenGL.raw.GL.VERSION.GL_1_0 import glGetTexImage as _raw_glGetTexImage
 import numpy as np
-import cv2
-import openvr
+
+from frame_sources import DecodedFrameCache, DisplayFramePrefetcher
+
+# value of the mode uniform for each ImageProcessor stabilization
+_MODES = {None: 0, 'mask': 1, 'warp': 2}
+
+
+class HeadlessContext(object):
+    '''
+    Offscreen OpenGL 3.3 core context with no window, using EGL (with a pbuffer
+    surface) or OSMesa. With Mesa and LIBGL_ALWAYS_SOFTWARE=1 this runs on the
+    llvmpipe software rasterizer, so it needs neither a GPU nor a display.
+    '''
+
+    def __init__(self, width, height, platform=None):
+        '''
+        platform: 'egl' or 'osmesa'; defaults to PYOPENGL_PLATFORM, which has to match
+        '''
+        self._width = width
+        self._height = height
+        self._platform = platform or os.environ.get('PYOPENGL_PLATFORM', 'egl')
+        self._display = self._surface = self._context = None
+
+    def start(self):
+        if self._platform == 'egl':
+            self._start_egl()
+        elif self._platform == 'osmesa':
+            self._start_osmesa()
+        else:
+            raise ValueError("Unsupported headless platform: %s" % self._platform)
+        return self
+
+    def _start_egl(self):
+        from OpenGL import EGL
+        self._EGL = EGL
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError("Could not initialize EGL")
+        config_attributes = (EGL.EGLint * 13)(
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8, EGL.EGL_ALPHA_SIZE, 8,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE)
+        config = EGL.EGLConfig()
+        n_configs = EGL.EGLint()
+        if not EGL.eglChooseConfig(display, config_attributes, ctypes.pointer(config), 1,
+                                   ctypes.pointer(n_configs)) or n_configs.value == 0:
+            raise RuntimeError("No EGL config supports offscreen OpenGL rendering")
+        surface = EGL.eglCreatePbufferSurface(display, config, (EGL.EGLint * 5)(
+            EGL.EGL_WIDTH, self._width, EGL.EGL_HEIGHT, self._height, EGL.EGL_NONE))
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, (EGL.EGLint * 7)(
+            EGL.EGL_CONTEXT_MAJOR_VERSION, 3, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+            EGL.EGL_NONE))
+        if context == EGL.EGL_NO_CONTEXT or not EGL.eglMakeCurrent(display, surface, surface, context):
+            raise RuntimeError("Could not create an OpenGL 3.3 core context with EGL")
+        self._display, self._surface, self._context = display, surface, context
+
+    def _start_osmesa(self):
+        from OpenGL import arrays, osmesa
+        self._osmesa = osmesa
+        context = osmesa.OSMesaCreateContextAttribs(arrays.GLintArray.asArray([
+            osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+            osmesa.OSMESA_DEPTH_BITS, 24,
+            osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+            osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+            osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+            0]), None)
+        if not context:
+            raise RuntimeError("Could not create an OpenGL 3.3 core context with OSMesa")
+        # the default framebuffer; Displayer renders into its own
+        self._surface = arrays.GLubyteArray.zeros((self._height, self._width, 4))
+        if not osmesa.OSMesaMakeCurrent(context, self._surface, GL_UNSIGNED_BYTE, self._width, self._height):
+            raise RuntimeError("Could not make the OSMesa context current")
+        self._context = context
+
+    def close(self):
+        if self._context is None:
+            return
+        if self._platform == 'egl':
+            EGL = self._EGL
+            EGL.eglMakeCurrent(self._display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+            EGL.eglDestroyContext(self._display, self._context)
+            EGL.eglDestroySurface(self._display, self._surface)
+            EGL.eglTerminate(self._display)
+        else:
+            self._osmesa.OSMesaDestroyContext(self._context)
+        self._context = None
+
 
 class Displayer():
-    def __init__(self):
-        self._width = 1920
-        self._height = 1080
-        self._init_vr()
-        self._cap = cv2.VideoCapture("sample_vid.mp4")
-        self._init_window_context()
+    def __init__(self, width=2048, height=1280, eyes=1, headless=False, source='PATH TO FILE HERE',
+                 cache_bytes=64 << 20):
+        '''
+        width, height: size of the rendered view (and of the frames it is given)
+        eyes: number of side by side eye viewports in a frame, as in ImageProcessor(binocular=True)
+        headless: render into a HeadlessContext without opening OpenVR, a window or the
+            testbed image; frames are then given with upload() or as a texture to update()
+        source: image or video file shown when no texture is given to update()
+        cache_bytes: memory (bytes) for decoded, resized source frames; the default
+            holds 6 frames of 2048x1280 RGBA
+        Nothing is created until start() is called.
+        '''
+        self._width = width
+        self._height = height
+        self._eyes = eyes
+        self._headless = headless
+        self._source = source
+        self._cache_bytes = cache_bytes
+        self._frames = None
+        self._uploaded = None
+        self._context = None
+        self._fbo = None
+        
+    def start(self):
+        if self._headless:
+            self._context = HeadlessContext(self._width, self._height).start()
+        else:
+            # the headset and the window only exist on the experiment machine
+            import openvr
+            self._openvr = openvr
+            self._init_vr()
+            self._frames = DisplayFramePrefetcher(self._source, self._width, self._height,
+                                                  cache=DecodedFrameCache(self._cache_bytes)).start()
+            self._init_window_context()
         self._init_vertex_objects()
         glUseProgram(self._load_shaders())
+        self._init_uniforms()
         self._init_tex_coord_buffer()
         self._init_texture()
         self._init_framebuffer()
-        self.update()
-        self._position_vr_overlay   
+        if not self._headless:
+            self.update()
+        return self
 
     def _init_vr(self):
         # initialize vr interface
+        openvr = self._openvr
         openvr.init(openvr.VRApplication_Scene)
-        self._width, self._height =(2048, 1280)#openvr.IVRSystem().getRecommendedRenderTargetSize()
+        #openvr.IVRSystem().getRecommendedRenderTargetSize()
         print("VR Interace Open")
         self._overlay = openvr.IVROverlay().createOverlay("VR_Overlay", "VROverlay")
         
@@ -73,27 +204,55 @@ class Displayer():
         "}\n"
         
         
+        # Works in texel coordinates of the frame (x to the right, y = array row), like
+        # ImageProcessor. mode 0 shows the frame, 1 blanks mask_rect (x, y, width, height)
+        # of each eye's viewport, 2 shifts each viewport's content by offset pixels with
+        # bilinear interpolation and black borders, as cv2.remap does in WarpEngine.
         FRAGMENT_SHADER_CODE = ""\
         "#version 330 core\n"\
         "in vec2 uv;\n"\
-        "out layout(location = 0) vec3 color;\n"\
+        "layout(location = 0) out vec3 color;\n"\
         "uniform sampler2D tex_sampler;\n"\
+        "uniform int mode;\n"\
+        "uniform float eye_width;\n"\
+        "uniform vec4 mask_rect[2];\n"\
+        "uniform vec2 offset[2];\n"\
+        "vec3 eye_texel(vec2 p, int eye) {\n"\
+            "if (p.x < 0.0 || p.y < 0.0 || p.x >= eye_width || p.y >= float(textureSize(tex_sampler, 0).y))\n"\
+                "return vec3(0.0);\n"\
+            "return texelFetch(tex_sampler, ivec2(p.x + float(eye) * eye_width, p.y), 0).rgb;\n"\
+        "}\n"\
         "void main() {\n"\
-            "color = texture(tex_sampler, uv).rgb;\n"\
+            "vec2 p = floor(gl_FragCoord.xy);\n"\
+            "int eye = min(int(p.x / eye_width), 1);\n"\
+            "vec2 local = vec2(p.x - float(eye) * eye_width, p.y);\n"\
+            "if (mode == 1) {\n"\
+                "vec4 r = mask_rect[eye];\n"\
+                "bool inside = all(greaterThanEqual(local, r.xy)) && all(lessThan(local, r.xy + r.zw));\n"\
+                "color = inside ? vec3(0.0) : eye_texel(local, eye);\n"\
+            "} else if (mode == 2) {\n"\
+                "vec2 src = local - offset[eye];\n"\
+                "vec2 p0 = floor(src);\n"\
+                "vec2 f = src - p0;\n"\
+                "color = mix(mix(eye_texel(p0, eye), eye_texel(p0 + vec2(1.0, 0.0), eye), f.x),\n"\
+                            "mix(eye_texel(p0 + vec2(0.0, 1.0), eye), eye_texel(p0 + vec2(1.0, 1.0), eye), f.x), f.y);\n"\
+            "} else {\n"\
+                "color = texture(tex_sampler, uv).rgb;\n"\
+            "}\n"\
         "}\n"
         
         print("Compiling Vertex Shader")
         glShaderSource(vtx_shader, VERTEX_SHADER_CODE)
         glCompileShader(vtx_shader)
-        if glGetShaderiv(vtx_shader, GL_INFO_LOG_LENGTH) > 0:
-            print("Could not compile vertex shader")
+        if not glGetShaderiv(vtx_shader, GL_COMPILE_STATUS):
+            print("Could not compile vertex shader", glGetShaderInfoLog(vtx_shader))
             return None
     
         print("Compiling Fragment Shader")
         glShaderSource(frg_shader, FRAGMENT_SHADER_CODE)
         glCompileShader(frg_shader)
-        if glGetShaderiv(frg_shader, GL_INFO_LOG_LENGTH) > 0:
-            print("Could not compile fragment shader")
+        if not glGetShaderiv(frg_shader, GL_COMPILE_STATUS):
+            print("Could not compile fragment shader", glGetShaderInfoLog(frg_shader))
             return None
     
        
@@ -103,8 +262,8 @@ class Displayer():
         glAttachShader(pid, vtx_shader)
         glAttachShader(pid, frg_shader)
         glLinkProgram(pid)
-        if glGetProgramiv(pid, GL_INFO_LOG_LENGTH) > 0:
-            print("Could not link shaders into program")
+        if not glGetProgramiv(pid, GL_LINK_STATUS):
+            print("Could not link shaders into program", glGetProgramInfoLog(pid))
             return None
        
             
@@ -117,9 +276,38 @@ class Displayer():
         self._pid = pid
         return pid
         
+    def _init_uniforms(self):
+        pid = self._pid
+        self._mode_loc = glGetUniformLocation(pid, "mode")
+        self._mask_rect_loc = glGetUniformLocation(pid, "mask_rect")
+        self._offset_loc = glGetUniformLocation(pid, "offset")
+        glUniform1i(glGetUniformLocation(pid, "tex_sampler"), 0)
+        glUniform1f(glGetUniformLocation(pid, "eye_width"), float(self._width // self._eyes))
+        # uploaded as a whole every frame; rows past self._eyes are unused
+        self._mask_rects = np.zeros((2, 4), dtype=np.float32)
+        self._offsets = np.zeros((2, 2), dtype=np.float32)
+        self.set_stabilization(None)
+        
+    def set_stabilization(self, stabilization, mask_rects=None, offsets=None):
+        '''
+        Set the per-frame stabilization uniforms used by the next update().
+        stabilization: None to show frames unchanged, 'mask' or 'warp'
+        mask_rects: per eye (x, y, width, height) rectangle to blank, in eye viewport pixels
+        offsets: per eye (dx, dy) shift of the viewport content, in pixels
+        ImageProcessor.stabilization_uniforms(gaze) returns the last two for a gaze sample.
+        '''
+        glUniform1i(self._mode_loc, _MODES[stabilization])
+        if mask_rects is not None:
+            self._mask_rects[:len(mask_rects)] = mask_rects
+            glUniform4fv(self._mask_rect_loc, 2, self._mask_rects)
+        if offsets is not None:
+            self._offsets[:len(offsets)] = offsets
+            glUniform2fv(self._offset_loc, 2, self._offsets)
+        
     # set up context & window
     
     def _init_window_context(self):
+        import pygame
         pygame.init()
         pygame.display.set_mode((self._width, self._height), pygame.OPENGL | pygame.DOUBLEBUF )
         pygame.display.set_caption("Window Title Here")
@@ -127,10 +315,10 @@ class Displayer():
  
     # intialize vertex buffer
     
-    def _draw(self):
+    def _draw(self, texture):
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         # draw vertices
-        glBindTexture(GL_TEXTURE_2D, self._tex_id)
+        glBindTexture(GL_TEXTURE_2D, texture)
         glDrawArrays(GL_TRIANGLES, 0, 6)
         
     def _init_tex_coord_buffer(self):
@@ -161,13 +349,26 @@ class Displayer():
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, 0)
 
-    def update(self):
-        self._update_texture()
+    def update(self, texture=None):
+        '''
+        Render a frame through the stabilization shader into the view texture and, unless
+        headless, submit it to the headset. Nothing is read back to the CPU.
+        texture: id of a GL texture holding the frame, e.g. the one Spout receives into;
+            by default the frame texture is drawn, after loading the testbed image into it
+            when not headless
+        '''
+        if texture is None:
+            if not self._headless:
+                self._update_texture()
+            texture = self._tex_id
         glBindFramebuffer(GL_FRAMEBUFFER, self._fbo)
         glViewport(0, 0, self._width, self._height)
-        self._draw()
+        self._draw(texture)
         glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if self._headless:
+            return
 
+        openvr = self._openvr
         glBindTexture(GL_TEXTURE_2D, self._view_tex)
 #         openvr.IVROverlay().setOverlayFlag(
 #             self._overlay,
@@ -237,18 +438,34 @@ class Displayer():
                 ctypes.c_voidp(0)
             )
      
-    def _update_texture(self):
-#         _, img = self._cap.read()
-        img = cv2.imread("PATH TO FILE HERE")
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2RGBA)
-        img = cv2.resize(img,(self._width,self._height))
-
+    def upload(self, frame):
+        ''' Upload a (height, width) uint8 luminance frame, e.g. from a FrameSource, into the frame texture '''
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glBindTexture(GL_TEXTURE_2D, self._tex_id)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self._width, self._height, GL_RED, GL_UNSIGNED_BYTE, frame)
         
-        img = np.asarray(img,dtype=np.uint8)
+    def read_view(self, out):
+        '''
+        Read the rendered view back into the (height, width) uint8 array out and return it.
+        Only for checking the output; the frame loop never needs it.
+        '''
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glBindTexture(GL_TEXTURE_2D, self._view_tex)
+        _raw_glGetTexImage(GL_TEXTURE_2D, 0, GL_RED, GL_UNSIGNED_BYTE, out.ctypes.data_as(ctypes.c_void_p))
+        return out
+     
+    def _update_texture(self):
+        # frames arrive decoded and resized; if there is no new one, keep the current texture
+        img = self._frames.next()
+        if img is None or img is self._uploaded:
+            return
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
         glBindTexture(GL_TEXTURE_2D, self._tex_id)
-        glTexImage2D(GL_TEXTURE_2D, 0 , GL_RGBA8, self._width, self._height, 0, GL_RGBA, GL_UNSIGNED_BYTE, img.tobytes())
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self._width, self._height, GL_RGBA, GL_UNSIGNED_BYTE, img)
+        self._uploaded = img
     
     def _position_vr_overlay(self):        # initialize overlay & setup transform to fix overlay to display viewport
+        openvr = self._openvr
         Transform_Type= (ctypes.c_float * 4) * 3
         transform = Transform_Type()
         transform[0][0]  = 1
@@ -274,14 +491,30 @@ class Displayer():
               0,
               self._hmd_transform)
       
-    def __del__(self):
-        glBindFramebuffer( GL_FRAMEBUFFER, 0)
-        glDeleteFramebuffers(1, self._fb)
+    def close(self):
+        if self._frames is not None:
+            self._frames.stop()
+            self._frames = None
+        if self._fbo is not None:
+            glBindFramebuffer( GL_FRAMEBUFFER, 0)
+            glDeleteFramebuffers(1, [self._fbo])
+            glDeleteTextures([self._tex_id, self._view_tex])
+            self._fbo = None
+        if self._headless:
+            if self._context is not None:
+                self._context.close()
+            return
         try:
-            openvr.shutdown()
+            self._openvr.shutdown()
             print('VR Interface Closed Successfully.')
         except: Exception("Could not properly close VR")
       
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+      
     def _init_framebuffer(self):
     
         self._fbo = glGenFramebuffers(1)
@@ -311,12 +544,17 @@ class Displayer():
             glBindFramebuffer(GL_FRAMEBUFFER, 0)
             raise Exception("Incomplete framebuffer")
         
+        if self._headless:
+            return
+        openvr = self._openvr
         glBindTexture(GL_TEXTURE_2D, self._view_tex)
         self._overlay_tex = openvr.Texture_t()
         self._overlay_tex.handle = self._view_tex
         self._overlay_tex.eType = openvr.TextureType_OpenGL
         self._overlay_tex.eColorSpace = openvr.ColorSpace_Auto
         
-disp = Displayer() 
-disp.update()
+
+if __name__ == '__main__':
+    disp = Displayer().start()
+    disp.update()
  
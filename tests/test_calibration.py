@@ -0,0 +1,135 @@
+import time
+
+import cv2
+import numpy as np
+
+import fakes
+from calibration import NINE_POINTS, Calibration, CalibrationStore, CalibrationTargets
+from Experiment import ImageProcessor
+from frame_sources import SyntheticFrameSource
+from gaze import GAZE_RECORD_DTYPE
+
+WIDTH, HEIGHT = 640, 360
+POINTS = ((.5, .5), (.2, .2), (.8, .2), (.2, .8), (.8, .8))
+
+
+def test_rls_converges_to_the_least_squares_fit():
+    rng = np.random.default_rng(0)
+    gazes = rng.uniform(0, 1, (200, 2))
+    weights = np.array([[1.2, 0.1], [-0.05, 0.8], [0.03, -0.02], [0.1, 0.0], [0.0, -0.1], [0.05, 0.05]])
+    features = np.column_stack([gazes, np.ones(len(gazes)), gazes[:, 0] ** 2,
+                                gazes[:, 0] * gazes[:, 1], gazes[:, 1] ** 2])
+    targets = features @ weights + rng.normal(0, 0.002, (len(gazes), 2))
+    calibration = Calibration('poly2')
+    # one fixation at a time, as calibrate() feeds them
+    for gaze, target in zip(gazes, targets):
+        calibration.update(gaze, target)
+    expected = np.linalg.lstsq(features, targets, rcond=None)[0]
+    np.testing.assert_allclose(calibration.weights, expected, atol=1e-3)
+    assert calibration.samples == len(gazes)
+    assert calibration.errors(gazes, targets).mean() < 0.005
+
+
+def test_affine_fit_recovers_the_mapping_from_nine_points():
+    transform = np.array([[0.9, 0.1], [-0.1, 1.1]])
+    gazes = np.array(NINE_POINTS) * 0.8 + 0.1
+    targets = gazes @ transform + (0.02, -0.03)
+    calibration = Calibration().fit(gazes, targets)
+    np.testing.assert_allclose(calibration.map((0.3, 0.7)), np.array([0.3, 0.7]) @ transform + (0.02, -0.03),
+                               atol=1e-4)
+
+
+def test_store_round_trip(tmp_path):
+    store = CalibrationStore(str(tmp_path))
+    assert store.load('s01', 'vive pro') is None
+    left, right = Calibration(), Calibration('poly2', forgetting=0.98)
+    left.update((0.4, 0.6), (0.45, 0.55))
+    right.update([(0.2, 0.3), (0.7, 0.8)], [(0.25, 0.3), (0.7, 0.85)])
+    store.save('s01', 'vive pro', [left, right])
+    loaded = store.load('s01', 'vive pro')
+    assert [c.model for c in loaded] == ['affine', 'poly2']
+    for original, copy in zip((left, right), loaded):
+        assert copy.to_dict() == original.to_dict()
+        # the covariance is kept, so a loaded calibration refines like the original
+        original.update((0.5, 0.5), (0.52, 0.49))
+        copy.update((0.5, 0.5), (0.52, 0.49))
+        np.testing.assert_array_equal(copy.weights, original.weights)
+
+
+def test_binocular_targets_are_drawn_in_each_viewport():
+    targets = CalibrationTargets(WIDTH, HEIGHT, eyes=2)
+    image = targets.show((.25, .5))
+    targets.show((.75, .5))
+    shown = np.argwhere(image[:, :, 1] == 0)
+    eye_width = WIDTH // 2
+    # one square per eye, at 3/4 of each viewport's width; the first ones are erased
+    for eye in range(2):
+        xs = shown[(shown[:, 1] >= eye * eye_width) & (shown[:, 1] < (eye + 1) * eye_width), 1]
+        assert abs(xs.mean() - eye * eye_width - 0.75 * eye_width) <= 1
+
+
+class BinocularTracker(object):
+    ''' Binocular EyeTracker interface serving a settable per-eye gaze '''
+
+    binocular = True
+
+    def __init__(self):
+        self.gaze = np.full((2, 2), 0.5)
+
+    def get_gaze_pos(self):
+        return tuple(self.gaze.mean(axis=0))
+
+    def since(self, t):
+        return np.array([[0.0] + list(self.gaze.mean(axis=0))])
+
+    def records_since(self, t):
+        records = np.zeros(1, dtype=GAZE_RECORD_DTYPE)
+        records['gaze'] = self.gaze
+        records['valid'] = True
+        return records
+
+
+def test_binocular_calibration_fits_each_eye_in_its_viewport(monkeypatch):
+    # each eye's true mapping from its gaze to its viewport: screen = gaze @ matrix + offset
+    matrices = [np.array([[1.1, 0.05], [0.0, 0.9]]), np.array([[0.9, 0.0], [0.05, 1.05]])]
+    offsets = [np.array([0.02, -0.01]), np.array([-0.03, 0.02])]
+
+    def gaze_for(eye, screen):
+        return np.linalg.solve(matrices[eye].T, np.asarray(screen) - offsets[eye])
+
+    tracker = BinocularTracker()
+    eye_width = WIDTH // 2
+
+    def imshow(name, image):
+        # the subject looks at the target as each eye sees it
+        ys, xs = np.nonzero((image[:, :, 0] == 255) & (image[:, :, 1] == 0))
+        for eye in range(2):
+            mine = (xs >= eye * eye_width) & (xs < (eye + 1) * eye_width)
+            seen = (xs[mine].mean() - eye * eye_width) / eye_width, 1 - ys[mine].mean() / HEIGHT
+            tracker.gaze[eye] = gaze_for(eye, seen)
+
+    for name in ('namedWindow', 'resizeWindow', 'moveWindow', 'waitKey'):
+        monkeypatch.setattr(cv2, name, lambda *args: None)
+    monkeypatch.setattr(cv2, 'imshow', imshow)
+    processor = ImageProcessor(WIDTH, HEIGHT, eye_tracker=tracker, binocular=True,
+                               frame_source=SyntheticFrameSource(WIDTH, HEIGHT), workers=0)
+    processor.calibrate(POINTS, loops=1)
+    for eye, calibration in enumerate(processor.calibrations):
+        for point in ((.3, .6), (.7, .4)):
+            np.testing.assert_allclose(calibration.map(gaze_for(eye, point)), point, atol=0.01)
+
+
+def test_fixation_gaze_is_per_eye_with_a_binocular_tracker():
+    tracker, sender = fakes.start_fake_eye_tracker(200.0, packet_format='binocular')
+    try:
+        processor = ImageProcessor(WIDTH, HEIGHT, eye_tracker=tracker, calibration=np.eye(2),
+                                   binocular=True, frame_source=SyntheticFrameSource(WIDTH, HEIGHT),
+                                   workers=0)
+        time.sleep(0.3)
+        gaze = processor._fixation_gaze(0.2)
+        # the fake eyes are 0.01 apart horizontally
+        assert gaze.shape == (2, 2)
+        assert abs(gaze[1, 0] - gaze[0, 0] - 0.01) < 0.003
+    finally:
+        sender.stop()
+        tracker.stop()
@@ -0,0 +1,105 @@
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from frame_sources import DecodedFrameCache, VideoFrameSource
+
+WIDTH, HEIGHT = 64, 48
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = str(tmp_path / 'clip.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30.0, (WIDTH, HEIGHT))
+    if not writer.isOpened():
+        pytest.skip("no MJPG video writer")
+    for i in range(5):
+        writer.write(np.full((HEIGHT, WIDTH, 3), i * 40, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+class FakeCapture(object):
+    ''' cv2.VideoCapture stand-in whose read() runs a callable '''
+
+    def __init__(self, read):
+        self.read = read
+
+    def isOpened(self):
+        return True
+
+    def get(self, prop):
+        return 0
+
+    def set(self, prop, value):
+        return True
+
+    def release(self):
+        pass
+
+
+def test_reads_frames_and_ends(video):
+    source = VideoFrameSource(WIDTH, HEIGHT, video, loop=False).start()
+    out = np.empty((HEIGHT, WIDTH), dtype=np.uint8)
+    for i in range(5):
+        source.read(out)
+        assert abs(int(out.mean()) - i * 40) < 8
+    with pytest.raises(EOFError):
+        source.read(out)
+    source.close()
+
+
+def test_decoder_errors_reach_the_reader(monkeypatch):
+    def read(image=None):
+        raise RuntimeError("decoder failed")
+
+    monkeypatch.setattr(cv2, 'VideoCapture', lambda path: FakeCapture(read))
+    source = VideoFrameSource(WIDTH, HEIGHT, 'broken.avi').start()
+    with pytest.raises(RuntimeError, match="decoder failed"):
+        source.read(np.empty((HEIGHT, WIDTH), dtype=np.uint8))
+    source.close()
+
+
+def test_close_wakes_a_waiting_reader(monkeypatch):
+    released = threading.Event()
+
+    def read(image=None):
+        # a decoder stuck on a slow stream
+        released.wait(5.0)
+        return False, None
+
+    monkeypatch.setattr(cv2, 'VideoCapture', lambda path: FakeCapture(read))
+    source = VideoFrameSource(WIDTH, HEIGHT, 'stuck.avi').start()
+    errors = []
+
+    def reader():
+        try:
+            source.read(np.empty((HEIGHT, WIDTH), dtype=np.uint8))
+        except EOFError as err:
+            errors.append(err)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    closer = threading.Thread(target=source.close, daemon=True)
+    closer.start()
+    released.set()
+    thread.join(5.0)
+    closer.join(5.0)
+    assert not thread.is_alive() and errors
+
+
+def test_decoded_frame_cache_is_bounded_by_bytes():
+    cache = DecodedFrameCache(max_bytes=3 * 1000)
+    for i in range(5):
+        cache.put(('clip', i), np.zeros(1000, dtype=np.uint8))
+    # the three newest fit; least recently used go first
+    assert len(cache) == 3 and cache.nbytes == 3000
+    assert cache.get(('clip', 1)) is None
+    assert cache.get(('clip', 2)) is not None
+    cache.put(('clip', 5), np.zeros(1000, dtype=np.uint8))
+    assert cache.get(('clip', 3)) is None and cache.get(('clip', 2)) is not None
+    # a frame larger than the whole cache is still kept, on its own
+    cache.put(('still', 0), np.zeros(5000, dtype=np.uint8))
+    assert len(cache) == 1 and cache.get(('still', 0)) is not None
@@ -0,0 +1,78 @@
+import socket
+import time
+
+import numpy as np
+
+import fakes
+from gaze import GAZE_PACKET_DTYPE, GazeBuffer, GazeReceiver
+
+
+def test_ring_buffer_latest_and_since_across_the_wrap():
+    buffer = GazeBuffer(8)
+    assert buffer.latest() is None
+    assert buffer.since(-np.inf).shape == (0, 3)
+    for start in range(0, 20, 3):
+        t = np.arange(start, start + 3, dtype=np.float64)
+        buffer.push(t, t / 100, -t)
+    # 21 samples pushed, the last 8 kept, oldest first
+    assert buffer.count == 21 and len(buffer) == 8
+    assert buffer.latest() == (20.0, 0.2, -20.0)
+    np.testing.assert_array_equal(buffer.since(-np.inf)[:, 0], np.arange(13, 21))
+    np.testing.assert_array_equal(buffer.since(16.0)[:, 0], np.arange(17, 21))
+    assert len(buffer.since(20.0)) == 0
+    # a batch larger than the ring keeps its tail
+    buffer.push(np.arange(100, 120.0), np.zeros(20), np.zeros(20))
+    np.testing.assert_array_equal(buffer.since(-np.inf)[:, 0], np.arange(112, 120))
+
+
+def test_latest_and_since_with_the_fake_sender():
+    tracker, sender = fakes.start_fake_eye_tracker(200.0, buffer_size=64)
+    try:
+        deadline = time.perf_counter() + 5.0
+        while tracker.receiver.packets_received < 100 and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        # the ring has wrapped: since() returns at most its capacity, in timestamp order
+        samples = tracker.since(-np.inf)
+        assert len(samples) == 64
+        assert np.all(np.diff(samples[:, 0]) > 0)
+        assert tracker.latest()[0] >= samples[-1, 0]
+        cutoff = samples[-10, 0]
+        newer = tracker.since(cutoff)
+        assert len(newer) >= 9 and np.all(newer[:, 0] > cutoff)
+        # the sender traces a circle of radius 0.25 around the center
+        np.testing.assert_allclose(np.hypot(samples[:, 1] - 0.5, samples[:, 2] - 0.5), 0.25, atol=1e-6)
+    finally:
+        sender.stop()
+        tracker.stop()
+
+
+def receive(packets_per_send, sends, sample_rate=120.0):
+    ''' Send legacy packets in bursts through a socket pair; return the buffered samples '''
+    ours, theirs = socket.socketpair()
+    buffer = GazeBuffer(256)
+    receiver = GazeReceiver(theirs, buffer, poll_interval=0.01, sample_rate=sample_rate).start()
+    packets = np.zeros(packets_per_send, dtype=GAZE_PACKET_DTYPE)
+    for i in range(sends):
+        packets['x'] = np.arange(packets_per_send) + i * packets_per_send
+        ours.sendall(packets.tobytes())
+        deadline = time.perf_counter() + 2.0
+        while buffer.count < (i + 1) * packets_per_send and time.perf_counter() < deadline:
+            time.sleep(0.001)
+    receiver.stop()
+    ours.close()
+    theirs.close()
+    return buffer.since(-np.inf)
+
+
+def test_batched_legacy_packets_are_spread_at_the_sample_period():
+    samples = receive(8, 1)
+    assert len(samples) == 8
+    np.testing.assert_allclose(np.diff(samples[:, 0]), 1 / 120.0)
+    np.testing.assert_array_equal(samples[:, 1], np.arange(8))
+
+
+def test_legacy_timestamps_always_increase():
+    # bursts arriving closer together than their spread are squeezed in after the previous one
+    samples = receive(16, 5, sample_rate=10.0)
+    assert len(samples) == 80
+    assert np.all(np.diff(samples[:, 0]) > 0)
@@ -0,0 +1,67 @@
+import threading
+import time
+
+import numpy as np
+
+import fakes
+from instrumentation import Instrumentation
+
+
+def wait_for_samples(tracker, n, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while len(tracker.since(-np.inf)) < n and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+
+def test_binocular_records_and_receive_timings_cross_the_process():
+    instrumentation = Instrumentation()
+    tracker, sender = fakes.start_fake_eye_tracker(200.0, packet_format='binocular', service=True,
+                                                   instrumentation=instrumentation)
+    try:
+        wait_for_samples(tracker, 40)
+        assert tracker.binocular
+        records = tracker.records_since(-np.inf)
+        assert len(records) >= 40
+        assert np.all(np.diff(records['timestamp']) > 0)
+        # the fake eyes are 0.01 apart horizontally
+        valid = records['valid'].all(axis=1)
+        np.testing.assert_allclose(records['gaze'][valid, 1, 0] - records['gaze'][valid, 0, 0], 0.01, atol=1e-6)
+        assert len(tracker.records_since(records['timestamp'][-2])) >= 1
+        gaze = tracker.get_binocular_gaze()
+        assert gaze.shape == (2, 2)
+        assert abs(gaze[1, 0] - gaze[0, 0] - 0.01) < 1e-6
+        assert instrumentation.histogram('gaze_receive').count > 0
+    finally:
+        sender.stop()
+        tracker.stop()
+
+
+def test_concurrent_readers_see_consistent_snapshots():
+    tracker, sender = fakes.start_fake_eye_tracker(1000.0, service=True, capacity=256)
+    errors = []
+
+    def read(stop):
+        try:
+            while not stop.is_set():
+                samples = tracker.since(-np.inf)
+                # a ring overwritten while it is copied would go back in time somewhere
+                assert np.all(np.diff(samples[:, 0]) > 0)
+                np.testing.assert_allclose(np.hypot(samples[:, 1] - 0.5, samples[:, 2] - 0.5), 0.25, atol=1e-6)
+                tracker.latest()
+        except AssertionError as err:
+            errors.append(err)
+
+    try:
+        wait_for_samples(tracker, 10)
+        stop = threading.Event()
+        readers = [threading.Thread(target=read, args=(stop,)) for _ in range(3)]
+        for reader in readers:
+            reader.start()
+        time.sleep(1.0)
+        stop.set()
+        for reader in readers:
+            reader.join()
+        assert not errors
+    finally:
+        sender.stop()
+        tracker.stop()
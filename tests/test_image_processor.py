@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+import Experiment
+from Experiment import ImageProcessor
+from frame_sources import FrameSource, SyntheticFrameSource
+
+WIDTH, HEIGHT = 640, 360
+
+
+class ScriptedTracker(object):
+    ''' EyeTracker interface serving a settable gaze; (nan, nan) means no sample yet '''
+
+    def __init__(self):
+        self.gaze = (np.nan, np.nan)
+
+    def get_gaze_pos(self):
+        return self.gaze
+
+    def latest(self):
+        return None if np.isnan(self.gaze[0]) else (0.0,) + tuple(self.gaze)
+
+    def since(self, t):
+        return np.zeros((0, 3))
+
+
+def make_processor(tracker, **kwargs):
+    return ImageProcessor(WIDTH, HEIGHT, eye_tracker=tracker,
+                          frame_source=SyntheticFrameSource(WIDTH, HEIGHT, speed=0),
+                          calibration=np.eye(2), workers=0, **kwargs).start()
+
+
+@pytest.mark.parametrize('options', [
+    {'stabilization': 'mask'},
+    {'stabilization': 'warp'},
+    {'stabilization': 'mask', 'binocular': True},
+    {'stabilization': 'warp', 'incremental': True},
+    {'stabilization': 'warp', 'foveated': True, 'roi_size': 128},
+    {'stabilization': 'mask', 'foveated': True, 'roi_size': 128},
+])
+def test_frames_without_gaze_are_shown_unprocessed(options):
+    processor = make_processor(ScriptedTracker(), **options)
+    captured = np.empty((HEIGHT, WIDTH), dtype=np.uint8)
+    SyntheticFrameSource(WIDTH, HEIGHT, speed=0).read(captured)
+    image = processor.get_processed_image()
+    if options.get('foveated'):
+        # the periphery is upsampled, so only its size is comparable
+        assert image.shape == captured.shape
+    else:
+        np.testing.assert_array_equal(image, captured)
+
+
+def test_last_valid_gaze_is_kept():
+    tracker = ScriptedTracker()
+    processor = make_processor(tracker, stabilization='mask')
+    tracker.gaze = (0.5, 0.5)
+    masked = processor.get_processed_image().copy()
+    assert (masked == 0).any()
+    # e.g. a blink or a dropped connection: keep blanking where the eye last was
+    tracker.gaze = (np.nan, np.nan)
+    np.testing.assert_array_equal(processor.get_processed_image(), masked)
+
+
+def test_untracked_eye_keeps_its_last_gaze():
+    tracker = ScriptedTracker()
+    processor = make_processor(tracker, stabilization='mask', binocular=True)
+    assert processor._valid_gaze(np.array([[0.2, 0.3], [0.6, 0.7]])) is not None
+    gaze = processor._valid_gaze(np.array([[0.4, 0.5], [np.nan, np.nan]]))
+    np.testing.assert_array_equal(gaze, [[0.4, 0.5], [0.6, 0.7]])
+
+
+@pytest.mark.parametrize('options', [
+    {'stabilization': 'warp'},
+    {'stabilization': 'warp', 'incremental': True},
+    {'stabilization': 'mask', 'foveated': True, 'roi_size': 128},
+])
+def test_process_frame_drops_the_frame_when_no_buffer_frees_up(options):
+    tracker = ScriptedTracker()
+    tracker.gaze = (0.5, 0.5)
+    processor = make_processor(tracker, **options)
+    frame = processor.capture_frame()
+    # e.g. the display stage of a pipeline holding the other buffers
+    held = [processor._pool.acquire() for _ in range(processor._pool.available())]
+    assert processor.process_frame(frame, timeout=0.01) is None
+    for buf in held:
+        processor._pool.release(buf)
+    # the dropped frame's buffer went back to its pool
+    assert processor.capture_frame(block=False) is not None
+
+
+class StaticSource(FrameSource):
+    ''' A still image from a source that reports no sequence, like Spout '''
+
+    def _read_into(self, out):
+        out[:] = 128
+        return out.nbytes
+
+
+def test_incremental_without_a_sequence(monkeypatch):
+    checksums = []
+    monkeypatch.setattr(Experiment, 'frame_checksum', lambda data: checksums.append(1) or 0)
+    tracker = ScriptedTracker()
+    tracker.gaze = (0.5, 0.5)
+    options = dict(eye_tracker=tracker, frame_source=StaticSource(WIDTH, HEIGHT),
+                   calibration=np.eye(2), workers=0, incremental=True)
+
+    processor = ImageProcessor(WIDTH, HEIGHT, stabilization='mask', **options).start()
+    for _ in range(6):
+        processor.get_processed_image()
+    assert checksums == []
+    assert processor.update_counts['full'] == 6
+
+    processor = ImageProcessor(WIDTH, HEIGHT, stabilization='warp', **options).start()
+    for _ in range(12):
+        processor.get_processed_image()
+    assert len(checksums) == 12
+    # same image at the same offsets: output buffers are reused instead of remapped
+    assert processor.update_counts['unchanged'] > 0
@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+
+from pose_protocol import PoseEncoder, SharedMemoryPoseReader, SharedMemoryPoseTransport
+
+
+def test_shared_memory_transport_takes_over_a_block_left_by_a_killed_run():
+    name = 'vr_pose_test_%d' % os.getpid()
+    killed = SharedMemoryPoseTransport(name).connect()
+    # the previous run never got to close() its transport
+    transport = SharedMemoryPoseTransport(name).connect()
+    reader = SharedMemoryPoseReader(name)
+    try:
+        assert transport.connected
+        transport.submit(PoseEncoder().encode([0], [(1.0, 0.0, 0.0, 0.0)], [(0.1, 1.7, -0.2)]))
+        header, devices = reader.poll()
+        np.testing.assert_allclose(devices['position'][0], (0.1, 1.7, -0.2), rtol=1e-6)
+    finally:
+        reader.close()
+        transport.close()
+        killed._slot._owner = False
+        killed.close()
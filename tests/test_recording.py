@@ -0,0 +1,113 @@
+import errno
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from Experiment import ImageProcessor
+from frame_sources import SyntheticFrameSource
+from recording import ReplaySession, SessionReader, SessionRecorder
+
+WIDTH, HEIGHT = 320, 180
+
+
+class SampledTracker(object):
+    ''' EyeTracker interface serving the samples added to it, timestamped when added '''
+
+    def __init__(self):
+        self.samples = np.zeros((0, 3))
+
+    def add(self, x, y):
+        self.samples = np.vstack([self.samples, (time.perf_counter(), x, y)])
+
+    def get_gaze_pos(self):
+        return tuple(self.samples[-1, 1:]) if len(self.samples) else (np.nan, np.nan)
+
+    def latest(self):
+        return tuple(self.samples[-1]) if len(self.samples) else None
+
+    def since(self, t):
+        return self.samples[self.samples[:, 0] > t]
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+@pytest.mark.parametrize('stabilization', ['mask', 'warp'])
+def test_replay_reproduces_the_recorded_session(tmp_path, compression, stabilization):
+    path = str(tmp_path / 'session')
+    # enough frame buffers that the writer never has to drop one
+    recorder = SessionRecorder(path, WIDTH, HEIGHT, record_frames=True, compression=compression,
+                               frame_buffers=12).start()
+    tracker = SampledTracker()
+    processor = ImageProcessor(WIDTH, HEIGHT, eye_tracker=tracker, frame_source=SyntheticFrameSource(WIDTH, HEIGHT),
+                               calibration=np.eye(2), stabilization=stabilization,
+                               recorder=recorder, workers=0).start()
+    shown = []
+    for i in range(12):
+        # the first frame comes before any gaze; then one or two samples per frame
+        for k in range(i % 2 + (i > 0)):
+            tracker.add(0.3 + 0.03 * i, 0.6 - 0.02 * i + 0.01 * k)
+        shown.append(processor.get_processed_image().copy())
+        recorder.record_pose(time.perf_counter(), (0.0, 1.7, 0.01 * i), (1.0, 0.0, 0.0, 0.0))
+    recorder.stop()
+    assert recorder.dropped == 0
+
+    reader = SessionReader(path)
+    assert reader.metadata['complete']
+    assert len(reader) == 12 and len(reader.poses) == 12
+    np.testing.assert_array_equal(np.column_stack([reader.gaze['timestamp'], reader.gaze['x'], reader.gaze['y']]),
+                                  tracker.samples)
+    np.testing.assert_allclose(reader.poses['position'][:, 2], 0.01 * np.arange(12))
+    assert np.isnan(reader.frame_records['gaze'][0]).all()
+    np.testing.assert_array_equal(reader.frame_records['gaze'][1:, 0, 0], 0.3 + 0.03 * np.arange(1, 12))
+
+    replay = ReplaySession(path)
+    replayed = ImageProcessor(replay.width, replay.height, eye_tracker=replay.eye_tracker,
+                              frame_source=replay.frame_source, clock=replay.clock, calibration=np.eye(2),
+                              stabilization=stabilization, workers=0).start()
+    for i, image in enumerate(shown):
+        np.testing.assert_array_equal(replayed.get_processed_image(), image, err_msg="frame %d" % i)
+    with pytest.raises(EOFError):
+        replayed.get_processed_image()
+
+
+class FullDisk(object):
+    ''' A file whose writes fail as on a full disk '''
+
+    def write(self, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_stop_after_a_write_error_does_not_deadlock(tmp_path):
+    path = str(tmp_path / 'session')
+    recorder = SessionRecorder(path, queue_size=4).start()
+    recorder._files['gaze.bin'] = FullDisk()
+    recorder.record_gaze([[0.0, 0.5, 0.5]])
+    recorder._thread.join(2.0)
+    assert not recorder._thread.is_alive()
+    # the writer is gone, so the queue fills up
+    for i in range(8):
+        recorder.record_gaze([[i, 0.5, 0.5]])
+    errors = []
+
+    def stop():
+        try:
+            recorder.stop()
+        except OSError as err:
+            errors.append(err)
+
+    stopper = threading.Thread(target=stop, daemon=True)
+    stopper.start()
+    stopper.join(5.0)
+    assert not stopper.is_alive()
+    assert errors and errors[0].errno == errno.ENOSPC
+    with open(os.path.join(path, 'session.json')) as f:
+        assert not json.load(f)['complete']
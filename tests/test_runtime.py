@@ -0,0 +1,116 @@
+from runtime import FrameRuntime, SimulatedClock
+
+RATE = 100.0   # a 10 ms display period
+
+
+class Stages(object):
+    '''
+    Frame stages that take simulated time: each stage costs a fixed number of
+    milliseconds, plus a hiccup on chosen frames. Frames are numbered buffers.
+    '''
+
+    def __init__(self, clock, capture=1.0, process=6.0, degraded=2.0, display=1.0,
+                 gaze_hiccups=(), capture_hiccups=(), hiccup=5.0):
+        self.clock = clock
+        self.costs = {'capture': capture, 'process': process, 'degraded': degraded, 'display': display}
+        self.gaze_hiccups = set(gaze_hiccups)
+        self.capture_hiccups = set(capture_hiccups)
+        self.hiccup = hiccup
+        self.frame = 0
+        self.captured = []
+        self.released = []
+        self.runtime = None
+
+    def _take(self, milliseconds):
+        self.clock.advance(milliseconds / 1e3)
+
+    def gaze(self):
+        self.frame = self.runtime.counts['frames']
+        if self.frame in self.gaze_hiccups:
+            self._take(self.hiccup)
+
+    def capture(self):
+        self._take(self.costs['capture'] + (self.hiccup if self.frame in self.capture_hiccups else 0))
+        self.captured.append(self.frame)
+        return self.frame
+
+    def process(self, frame, degraded):
+        self._take(self.costs['degraded' if degraded else 'process'])
+        return frame
+
+    def display(self, frame):
+        self._take(self.costs['display'])
+
+    def release(self, frame):
+        self.released.append(frame)
+
+
+def make_runtime(stages, **kwargs):
+    runtime = FrameRuntime(gaze=stages.gaze, capture=stages.capture, process=stages.process,
+                           display=stages.display, release=stages.release, rate=RATE,
+                           clock=stages.clock, **kwargs)
+    stages.runtime = runtime
+    return runtime
+
+
+def test_frames_that_fit_are_all_shown_on_time():
+    clock = SimulatedClock()
+    stages = Stages(clock)
+    counts = make_runtime(stages).run(frames=50)
+    assert counts['displayed'] == 50
+    assert counts['missed_deadlines'] == counts['skipped_captures'] == counts['dropped'] == 0
+    # 50 periods of virtual time, without waiting for them
+    assert abs(clock() - 0.5) < 1e-9
+    assert sorted(stages.released) == stages.captured
+
+
+def test_late_starts_skip_capture_and_slow_captures_drop_the_frame():
+    stages = Stages(SimulatedClock(), gaze_hiccups=(10, 20), capture_hiccups=(15, 25, 35))
+    counts = make_runtime(stages, degrade=False).run(frames=50)
+    assert counts['skipped_captures'] == 2
+    assert counts['dropped'] == 3
+    assert counts['degraded'] == 0
+    assert counts['missed_deadlines'] == 0
+    assert counts['displayed'] == 45 and counts['repeated'] == 5
+    # skipped frames were never captured; dropped ones were released
+    assert 10 not in stages.captured and 20 not in stages.captured
+    assert sorted(stages.released) == stages.captured
+
+
+def test_slow_captures_are_processed_degraded_instead_of_dropped():
+    stages = Stages(SimulatedClock(), capture_hiccups=(15, 25, 35))
+    counts = make_runtime(stages).run(frames=50)
+    assert counts['degraded'] == 3
+    assert counts['dropped'] == 0
+    assert counts['missed_deadlines'] == 0
+    assert counts['displayed'] == 50
+
+
+def test_work_longer_than_a_period_misses_every_deadline():
+    # 27 ms of work per frame and no cheaper path: skipping cannot help, so every
+    # frame is shown two periods late
+    stages = Stages(SimulatedClock(), process=25.0)
+    counts = make_runtime(stages, degrade=False).run(frames=20)
+    assert counts['displayed'] == 20
+    assert counts['skipped_captures'] == counts['dropped'] == 0
+    assert counts['missed_deadlines'] == 20
+    assert counts['missed_periods'] == 40
+    assert counts['missed_rate'] == 1.0
+
+
+def test_a_cheap_degraded_path_catches_up_with_slow_processing():
+    stages = Stages(SimulatedClock(), process=25.0)
+    counts = make_runtime(stages, probe_interval=10).run(frames=50)
+    # only the first frame (before process had an estimate) and the probes of the
+    # full path every probe_interval degraded frames are late
+    assert counts['degraded'] == 45
+    assert counts['missed_deadlines'] == 5
+
+
+def test_without_drop_late_every_frame_is_processed_in_full():
+    stages = Stages(SimulatedClock(), gaze_hiccups=(10, 20), capture_hiccups=(15, 25))
+    counts = make_runtime(stages, drop_late=False).run(frames=30)
+    assert counts['displayed'] == 30
+    assert counts['skipped_captures'] == counts['dropped'] == counts['degraded'] == 0
+    # a 5 ms hiccup on top of 8 ms of work overruns the period
+    assert counts['missed_deadlines'] == 4
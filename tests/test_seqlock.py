@@ -0,0 +1,119 @@
+import multiprocessing
+
+import numpy as np
+
+from seqlock import SeqlockSlot
+
+
+class WriteDuringCopy(object):
+    ''' Read target whose first copy is overlapped by a write, as if the writer were preempted mid-read '''
+
+    def __init__(self, slot, size, data):
+        self.array = np.zeros(size, dtype=np.uint8)
+        self._slot = slot
+        self._data = data
+
+    def __setitem__(self, index, value):
+        self.array[index] = value
+        if self._data is not None:
+            data, self._data = self._data, None
+            self._slot.write(data)
+
+
+def test_torn_read_is_retried():
+    slot = SeqlockSlot(size=64, create=True)
+    try:
+        slot.write(np.full(64, 1, dtype=np.uint8))
+        out = WriteDuringCopy(slot, 64, np.full(64, 2, dtype=np.uint8))
+        # the first copy saw the sequence change; the retry copies the new payload
+        assert slot.read(out) == 2
+        assert slot.retries == 1
+        assert np.all(out.array == 2)
+    finally:
+        slot.close()
+
+
+def test_read_gives_up_on_a_write_in_progress():
+    slot = SeqlockSlot(size=16, create=True)
+    reader = SeqlockSlot(slot.name)
+    try:
+        out = np.zeros(16, dtype=np.uint8)
+        assert reader.read(out) is None
+        slot.write(np.full(16, 7, dtype=np.uint8))
+        assert reader.read(out) == 1
+        assert reader.read(out, last_sequence=1) is None
+        # a writer that died mid-write leaves the sequence odd
+        slot._sequence[0] += 1
+        assert reader.read(out, max_retries=10) is None
+        assert reader.retries == 10
+        # recovering completes it as a write of the same payload
+        slot.recover()
+        assert reader.read(out) == 2
+        assert np.all(out == 7)
+    finally:
+        reader.close()
+        slot.close()
+
+
+def write_uniform_payloads(name, writes):
+    slot = SeqlockSlot(name)
+    payload = np.empty(slot.size, dtype=np.uint8)
+    for k in range(writes):
+        payload.fill(k % 251)
+        slot.write(payload)
+    slot.close()
+
+
+def test_snapshots_are_consistent_under_a_concurrent_writer():
+    # each payload is one repeated byte, so a torn copy would mix two values
+    slot = SeqlockSlot(size=1 << 20, create=True)
+    try:
+        writer = multiprocessing.get_context('spawn').Process(target=write_uniform_payloads,
+                                                              args=(slot.name, 2000))
+        writer.start()
+        out = np.empty(slot.size, dtype=np.uint8)
+        snapshots = 0
+        while writer.is_alive() or snapshots == 0:
+            if slot.read(out) is not None:
+                assert np.all(out == out[0])
+                snapshots += 1
+        writer.join()
+        assert writer.exitcode == 0
+    finally:
+        slot.close()
+
+
+def test_a_stale_block_is_taken_over():
+    # a writer killed mid-write leaves its block, with the sequence odd, behind
+    stale = SeqlockSlot(size=32, create=True)
+    stale.write(np.full(32, 3, dtype=np.uint8))
+    stale._sequence[0] += 1
+    reader = SeqlockSlot(stale.name)
+    slot = SeqlockSlot(stale.name, 32, create=True)
+    try:
+        out = np.zeros(32, dtype=np.uint8)
+        slot.write(np.full(32, 4, dtype=np.uint8))
+        # readers attached to the old block see the new writer's packets
+        assert reader.read(out) == 3
+        assert np.all(out == 4)
+    finally:
+        reader.close()
+        slot.close()
+        stale._owner = False
+        stale.close()
+
+
+def test_a_stale_block_of_another_size_is_replaced():
+    stale = SeqlockSlot(size=16, create=True)
+    slot = SeqlockSlot(stale.name, 64, create=True)
+    try:
+        assert slot.size == 64
+        slot.write(np.full(64, 5, dtype=np.uint8))
+        reader = SeqlockSlot(slot.name)
+        out = np.zeros(64, dtype=np.uint8)
+        assert reader.read(out) == 1 and np.all(out == 5)
+        reader.close()
+    finally:
+        slot.close()
+        stale._owner = False
+        stale.close()
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from Experiment import ImageProcessor
+from frame_sources import SyntheticFrameSource
+
+# PyOpenGL picks its platform on first import; Mesa's software rasterizer needs no GPU
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+os.environ.setdefault('LIBGL_ALWAYS_SOFTWARE', '1')
+pytest.importorskip('OpenGL')
+
+import testbed  # noqa: E402
+
+WIDTH, HEIGHT = 640, 360
+# the center, and near the corners, where the mask square is clipped
+GAZES = ((0.5, 0.5), (0.05, 0.9), (0.97, 0.02), (0.3, 0.7))
+
+
+class FixedTracker(object):
+    ''' EyeTracker interface serving a settable gaze '''
+
+    def __init__(self):
+        self.gaze = (0.5, 0.5)
+
+    def get_gaze_pos(self):
+        return self.gaze
+
+    def latest(self):
+        return (0.0,) + tuple(self.gaze)
+
+    def since(self, t):
+        return np.zeros((0, 3))
+
+
+@pytest.fixture(params=[1, 2], ids=['monocular', 'binocular'])
+def eyes_and_displayer(request):
+    displayer = testbed.Displayer(WIDTH, HEIGHT, eyes=request.param, headless=True)
+    try:
+        displayer.start()
+    except Exception as err:
+        pytest.skip("No headless OpenGL context: %s" % err)
+    yield request.param, displayer
+    displayer.close()
+
+
+@pytest.mark.parametrize('stabilization', ['mask', 'warp'])
+def test_shader_matches_image_processor(eyes_and_displayer, stabilization):
+    eyes, displayer = eyes_and_displayer
+    tracker = FixedTracker()
+    processor = ImageProcessor(WIDTH, HEIGHT, eye_tracker=tracker, frame_source=SyntheticFrameSource(WIDTH, HEIGHT),
+                               stabilization=stabilization, calibration=np.eye(2),
+                               binocular=eyes == 2, workers=0).start()
+    gpu = np.empty((HEIGHT, WIDTH), dtype=np.uint8)
+    for gaze in GAZES:
+        tracker.gaze = gaze
+        frame = processor.capture_frame()
+        displayer.upload(frame.data)
+        displayer.set_stabilization(stabilization, **processor.stabilization_uniforms(frame.gaze))
+        displayer.update()
+        displayer.read_view(gpu)
+        frame = processor.process_frame(frame)
+        # cv2.remap interpolates in fixed point, so allow one level of rounding
+        diff = np.abs(frame.data.astype(np.int16) - gpu)
+        assert diff.max() <= 1, "gaze %s: %d pixels differ" % (gaze, np.count_nonzero(diff > 1))
+        processor.release_frame(frame)
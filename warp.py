@@ -0,0 +1,148 @@
+'''
+Retinal stabilization warp engine.
+
+Stabilizing an image on the retina means shifting (or, in general, affinely
+warping) the whole Unity frame with the eye. WarpEngine keeps the per-frame
+cost to a single cv2.remap pass: the identity coordinate grids are computed
+once, a new gaze offset only adds that offset to them, and the resulting maps
+are kept in a bounded LRU cache keyed by the quantized offset, so a fixation
+that returns to a recent position costs no map update at all. Once the cache
+is full, evicted map buffers are reused, so steady-state operation does not
+allocate.
+'''
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def shift(src, dx, dy, out, border_value=0):
+    '''
+    Write src shifted by whole pixels (dx, dy) into out, filling the uncovered
+    border with border_value. This is what WarpEngine.translate computes for
+    whole-pixel offsets, pixel for pixel, as plain slice copies. Returns out.
+    '''
+    height, width = src.shape[:2]
+    dx, dy = int(dx), int(dy)
+    # destination rows and columns that receive content
+    left, right = min(max(dx, 0), width), max(min(width + dx, width), 0)
+    top, bottom = min(max(dy, 0), height), max(min(height + dy, height), 0)
+    if left >= right or top >= bottom:
+        out[:] = border_value
+        return out
+    out[:top] = border_value
+    out[bottom:] = border_value
+    out[top:bottom, :left] = border_value
+    out[top:bottom, right:] = border_value
+    out[top:bottom, left:right] = src[top - dy:bottom - dy, left - dx:right - dx]
+    return out
+
+
+class WarpEngine(object):
+    '''
+    Translates or affinely warps (height, width) frames into caller-supplied output
+    buffers. Maps are stored in OpenCV's fixed-point format (CV_16SC2 plus an
+    interpolation table), which halves their size and speeds up remap.
+    '''
+
+    def __init__(self, width, height, cache_size=8, quantization=1.0,
+                 interpolation=cv2.INTER_LINEAR, border_value=0):
+        '''
+        cache_size: number of offset maps kept (each is about 6 bytes per pixel)
+        quantization: offset step in pixels; offsets are rounded to this grid before
+            the cache lookup, so smaller values are more precise but hit less often
+        interpolation: cv2 interpolation flag used by remap/warpAffine
+        border_value: fill value for pixels shifted in from outside the frame
+        '''
+        self._width = width
+        self._height = height
+        self._cache_size = max(int(cache_size), 1)
+        self._quantization = float(quantization)
+        self._interpolation = interpolation
+        self._border_value = border_value
+
+        # identity grids; an offset only needs to be added to these
+        self._base_x = np.arange(width, dtype=np.float32)[np.newaxis, :]
+        self._base_y = np.arange(height, dtype=np.float32)[:, np.newaxis]
+        # float scratch maps, converted to fixed point for each new offset
+        self._map_x = np.empty((height, width), dtype=np.float32)
+        self._map_y = np.empty((height, width), dtype=np.float32)
+
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def shape(self):
+        return (self._height, self._width)
+
+    def quantize(self, dx, dy):
+        ''' Return the cache key for an offset of (dx, dy) pixels '''
+        q = self._quantization
+        return (int(round(dx / q)), int(round(dy / q)))
+
+    def maps_for(self, dx, dy):
+        '''
+        Return the fixed-point (map1, map2) pair that shifts the image content by
+        (dx, dy) pixels, computing and caching it on a miss.
+        '''
+        key = self.quantize(dx, dy)
+        maps = self._cache.get(key)
+        if maps is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return maps
+
+        self.misses += 1
+        if len(self._cache) >= self._cache_size:
+            # recycle the least recently used buffers instead of allocating
+            _, (map1, map2) = self._cache.popitem(last=False)
+        else:
+            map1 = np.empty((self._height, self._width, 2), dtype=np.int16)
+            map2 = np.empty((self._height, self._width), dtype=np.uint16)
+
+        q = self._quantization
+        # dst(x, y) = src(x - dx, y - dy)
+        np.subtract(self._base_x, key[0] * q, out=self._map_x)
+        np.subtract(self._base_y, key[1] * q, out=self._map_y)
+        cv2.convertMaps(self._map_x, self._map_y, cv2.CV_16SC2,
+                        dstmap1=map1, dstmap2=map2, nninterpolation=False)
+        self._cache[key] = (map1, map2)
+        return (map1, map2)
+
+    def translate(self, src, dx, dy, out, rows=None):
+        '''
+        Write src shifted by (dx, dy) pixels into out (same shape and dtype as src,
+        must not alias it). Returns out.
+        rows: optional slice of output rows to produce; src is still the whole frame
+        '''
+        return self.remap(src, self.maps_for(dx, dy), out, rows)
+
+    def remap(self, src, maps, out, rows=None):
+        '''
+        Apply a (map1, map2) pair returned by maps_for() to src, writing into out
+        (or only its rows slice). This does not touch the cache, so horizontal
+        bands of one frame can be remapped on several threads at once, as long
+        as maps_for() is not called again until they finish. Returns out.
+        '''
+        map1, map2 = maps
+        if rows is not None:
+            map1, map2, out = map1[rows], map2[rows], out[rows]
+        cv2.remap(src, map1, map2, self._interpolation, dst=out,
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=self._border_value)
+        return out
+
+    def warp_affine(self, src, matrix, out):
+        '''
+        Write src warped by the 2x3 affine matrix (mapping source to destination
+        pixel coordinates) into out. Returns out. Affine maps are not cached since
+        their parameters rarely repeat.
+        '''
+        cv2.warpAffine(src, np.asarray(matrix, dtype=np.float64), (self._width, self._height),
+                       dst=out, flags=self._interpolation,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=self._border_value)
+        return out
+
+    def clear(self):
+        self._cache.clear()